@@ -0,0 +1,780 @@
+# aggregates.py
+# Cubo de agregados precalculado al cargar los datos. Las pestañas de distritos,
+# pagos, evolución y CO2 se responden desde aquí en lugar de recorrer la tabla.
+
+import numpy as np
+import pandas as pd
+
+# Dimensiones del cubo (hour y price_bin se derivan de la tabla)
+CUBE_DIMENSIONS = [
+    "pickup_borough",
+    "dropoff_borough",
+    "hour",
+    "payment_type",
+    "passenger_count",
+    "price_bin",
+]
+
+# Métricas numéricas: por cada una se guarda nº de valores, suma y suma de cuadrados
+CUBE_METRICS = [
+    "passenger_count",
+    "fare_amount",
+    "extra",
+    "mta_tax",
+    "tip_amount",
+    "tolls_amount",
+    "improvement_surcharge",
+    "total_amount",
+    "trip_minutes",
+    "trip_distance_km",
+    "avg_speed_kmh",
+    "co2_kg_per_km",
+    "co2_kg_trip",
+    "co2_kg_per_passenger",
+]
+
+# Cortes de total_amount para las barras del waffle: [0, 10], (10, 15], (15, 20], (20, max]
+PRICE_BIN_EDGES = [10, 15, 20]
+
+
+def price_bins(total_amount):
+    """
+    Índice de tramo de precio (0-3) de cada viaje; NaN si el importe es negativo
+    o no existe.
+    """
+    values = np.asarray(total_amount, dtype="float64")
+    bins = np.searchsorted(PRICE_BIN_EDGES, values, side="left").astype("float64")
+    bins[~(values >= 0)] = np.nan
+    return bins
+
+
+class AggregateCube:
+    """
+    Agregados de la tabla por todas las combinaciones observadas de
+    CUBE_DIMENSIONS. Se guarda como un DataFrame disperso (una fila por
+    combinación con viajes) con 'count' y, por métrica, '<m>_n', '<m>_sum' y
+    '<m>_sumsq'. Cualquier agregación por un subconjunto de dimensiones es un
+    groupby sobre este frame, que tiene unos miles de filas en lugar de millones.
+    """
+
+    def __init__(self, df):
+        self._od = {}
+        self._hourly = {}
+        self.metrics = [m for m in CUBE_METRICS if m in df.columns]
+        self.integer_metrics = {
+            m for m in self.metrics if pd.api.types.is_integer_dtype(df[m])
+        }
+        self.maxima = {
+            m: float(np.nanmax(df[m].to_numpy().astype("float64"))) if len(df) else np.nan
+            for m in self.metrics
+        }
+
+        if len(df) == 0 or "tpep_pickup_datetime" not in df.columns:
+            columns = CUBE_DIMENSIONS + ["count"]
+            columns += [f"{m}_{s}" for m in self.metrics for s in ("n", "sum", "sumsq")]
+            self.frame = pd.DataFrame(columns=columns)
+            return
+
+        dimensions = {
+            "hour": df["pickup_hour"]
+            if "pickup_hour" in df.columns
+            else df["tpep_pickup_datetime"].dt.hour,
+            "price_bin": price_bins(df["total_amount"].to_numpy())
+            if "total_amount" in df.columns
+            else np.full(len(df), np.nan),
+        }
+        for dim in CUBE_DIMENSIONS:
+            if dim not in dimensions:
+                dimensions[dim] = (
+                    df[dim] if dim in df.columns else pd.Series(np.nan, index=df.index)
+                )
+
+        # Código de cada dimensión (0 = valor ausente) combinado en una única clave
+        key = np.zeros(len(df), dtype=np.int64)
+        levels = {}
+        for dim in CUBE_DIMENSIONS:
+            codes, uniques = pd.factorize(dimensions[dim], sort=True)
+            levels[dim] = np.asarray(list(uniques) if len(uniques) else [], dtype=object)
+            key = key * (len(uniques) + 1) + (codes + 1)
+
+        cells, inverse = np.unique(key, return_inverse=True)
+        inverse = inverse.ravel()
+        n_cells = len(cells)
+
+        # Decodificar la clave de cada celda a sus valores de dimensión
+        columns = {}
+        remaining = cells.copy()
+        for dim in reversed(CUBE_DIMENSIONS):
+            radix = len(levels[dim]) + 1
+            codes = remaining % radix
+            remaining //= radix
+            values = np.full(n_cells, np.nan, dtype=object)
+            present = codes > 0
+            values[present] = levels[dim][codes[present] - 1]
+            columns[dim] = values
+        frame = pd.DataFrame({dim: columns[dim] for dim in CUBE_DIMENSIONS})
+        for dim in ("hour", "passenger_count", "price_bin"):
+            frame[dim] = pd.to_numeric(frame[dim])
+
+        frame["count"] = np.bincount(inverse, minlength=n_cells)
+        for m in self.metrics:
+            values = df[m].to_numpy().astype("float64")
+            finite = np.isfinite(values)
+            values = np.where(finite, values, 0.0)
+            frame[f"{m}_n"] = np.bincount(inverse, weights=finite, minlength=n_cells).astype(
+                np.int64
+            )
+            frame[f"{m}_sum"] = np.bincount(inverse, weights=values, minlength=n_cells)
+            frame[f"{m}_sumsq"] = np.bincount(inverse, weights=values**2, minlength=n_cells)
+        self.frame = frame
+
+    def nbytes(self):
+        return int(self.frame.memory_usage(deep=True).sum())
+
+    def group(self, by, metrics=(), where=None, dropna=True):
+        """
+        Agrega el cubo por las dimensiones `by` (lista, puede ser vacía).
+        Devuelve un DataFrame con las dimensiones, 'count' y, por métrica,
+        '<m>_n', '<m>_sum', '<m>_mean' y '<m>_std'.
+        `where` filtra antes de agregar: dict dimensión -> valores admitidos
+        (o función que recibe la columna y devuelve una máscara).
+        Con dropna=True, como en un groupby normal, se descartan las celdas
+        con alguna dimensión de `by` ausente.
+        """
+        frame = self.frame
+        if where:
+            mask = np.ones(len(frame), dtype=bool)
+            for dim, allowed in where.items():
+                column = frame[dim]
+                mask &= allowed(column) if callable(allowed) else column.isin(allowed)
+            frame = frame[mask]
+
+        columns = ["count"] + [f"{m}_{s}" for m in metrics for s in ("n", "sum", "sumsq")]
+        if by:
+            result = (
+                frame.groupby(list(by), sort=True, dropna=dropna)[columns].sum().reset_index()
+            )
+        else:
+            result = frame[columns].sum().to_frame().T
+        result["count"] = result["count"].astype(np.int64)
+
+        for m in metrics:
+            n = result[f"{m}_n"].astype("float64")
+            total = result[f"{m}_sum"]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result[f"{m}_mean"] = total / n.where(n > 0)
+                # Varianza muestral (ddof=1), como Series.std
+                variance = (result[f"{m}_sumsq"] - n * result[f"{m}_mean"] ** 2) / (n - 1).where(n > 1)
+            result[f"{m}_std"] = np.sqrt(variance.clip(lower=0))
+            if m in self.integer_metrics:
+                result[f"{m}_sum"] = result[f"{m}_sum"].round().astype(np.int64)
+        return result
+
+    def total(self, metric):
+        """
+        Suma de `metric` sobre toda la tabla.
+        """
+        return float(self.frame[f"{metric}_sum"].sum()) if metric in self.metrics else 0.0
+
+    def hour_prefix_sums(self, metrics=(), by="pickup_borough"):
+        """
+        Sumas por (distrito, hora) con sumas acumuladas sobre la hora (ver
+        HourPrefixSums). Se guardan, así que se calculan una sola vez.
+        """
+        key = (tuple(metrics), by)
+        if key not in self._hourly:
+            self._hourly[key] = HourPrefixSums(self.frame, metrics, by)
+        return self._hourly[key]
+
+    def od_matrix(self, metrics=(), origin="pickup_borough", destination="dropoff_borough"):
+        """
+        Matriz origen-destino de `metrics` (ver ODMatrix) a partir del cubo. Se
+        guarda, así que los mapas de calor y el radar comparten la misma.
+        """
+        key = (tuple(metrics), origin, destination)
+        if key not in self._od:
+            self._od[key] = ODMatrix(self.frame, metrics, origin, destination)
+        return self._od[key]
+
+
+class HourPrefixSums:
+    """
+    Sumas por (distrito, hora del día) de unas métricas, con sumas acumuladas
+    sobre la hora: el total de cualquier rango [h0, h1] por distrito es una
+    resta (prefijo[h1 + 1] - prefijo[h0]). Las filas son los distritos
+    observados más una última para los viajes sin distrito, que solo cuenta
+    cuando no se filtra por distrito. Una consulta cuesta O(horas x distritos).
+    """
+
+    HOURS = 24
+
+    def __init__(self, frame, metrics=(), by="pickup_borough"):
+        self.metrics = list(metrics)
+        codes, uniques = pd.factorize(frame[by], sort=True)
+        self.boroughs = list(uniques)
+        n_rows = len(self.boroughs) + 1
+        codes = np.where(codes < 0, n_rows - 1, codes)
+        hours = pd.to_numeric(frame["hour"]).to_numpy()
+        valid = np.isfinite(hours)
+        slot = codes[valid] * self.HOURS + hours[valid].astype(np.int64)
+
+        def table(column):
+            weights = frame[column].to_numpy()[valid].astype("float64")
+            return np.bincount(slot, weights=weights, minlength=n_rows * self.HOURS).reshape(
+                n_rows, self.HOURS
+            )
+
+        self.count = table("count")
+        self.n = {m: table(f"{m}_n") for m in self.metrics}
+        self.sum = {m: table(f"{m}_sum") for m in self.metrics}
+
+        def prefix(values):
+            return np.concatenate([np.zeros((n_rows, 1)), np.cumsum(values, axis=1)], axis=1)
+
+        self.count_prefix = prefix(self.count)
+        self.n_prefix = {m: prefix(v) for m, v in self.n.items()}
+        self.sum_prefix = {m: prefix(v) for m, v in self.sum.items()}
+
+    def rows(self, boroughs=None):
+        """
+        Filas de los distritos seleccionados (None o vacío = todos, incluidos
+        los viajes sin distrito).
+        """
+        if not boroughs:
+            return np.arange(len(self.boroughs) + 1)
+        lookup = {b: i for i, b in enumerate(self.boroughs)}
+        return np.unique(np.array([lookup[b] for b in boroughs if b in lookup], dtype=np.int64))
+
+    def hourly(self, metric, h0, h1, boroughs=None):
+        """
+        Por cada hora de [h0, h1] con viajes: pickup_hour, sum, mean y count
+        (nº de valores) de `metric` en los distritos seleccionados.
+        """
+        rows = self.rows(boroughs)
+        hours = np.arange(max(h0, 0), min(h1, self.HOURS - 1) + 1)
+        trips = self.count[np.ix_(rows, hours)].sum(axis=0)
+        n = self.n[metric][np.ix_(rows, hours)].sum(axis=0)
+        total = self.sum[metric][np.ix_(rows, hours)].sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(n > 0, total / n, np.nan)
+        present = trips > 0
+        return pd.DataFrame(
+            {
+                "pickup_hour": hours[present],
+                "sum": total[present],
+                "mean": mean[present],
+                "count": n[present].astype(np.int64),
+            }
+        )
+
+    def range_totals(self, metric, h0, h1, boroughs=None):
+        """
+        Suma de `metric` y nº de viajes por distrito con viajes (sin la fila de
+        viajes sin distrito) en el rango de horas [h0, h1], a partir de las
+        sumas acumuladas.
+        """
+        h0, h1 = max(h0, 0), min(h1, self.HOURS - 1)
+        rows = self.rows(boroughs)
+        rows = rows[rows < len(self.boroughs)]
+        if h1 < h0:
+            rows = rows[:0]
+        trips = self.count_prefix[rows, h1 + 1] - self.count_prefix[rows, h0]
+        total = self.sum_prefix[metric][rows, h1 + 1] - self.sum_prefix[metric][rows, h0]
+        present = trips > 0
+        rows, trips, total = rows[present], trips[present], total[present]
+        return pd.DataFrame(
+            {
+                "pickup_borough": np.asarray(self.boroughs, dtype=object)[rows],
+                "sum": total,
+                "count": np.round(trips).astype(np.int64),
+            }
+        )
+
+
+class ODMatrix:
+    """
+    Agregados origen-destino en matrices densas (distritos x distritos): nº de
+    viajes y, por métrica, nº de valores y suma. Se calculan en una sola pasada:
+    los códigos de origen y destino se combinan en un único código y cada
+    matriz es un np.bincount sobre él. Origen y destino comparten el mismo eje
+    (la unión de los distritos observados), así que los marginales de salida y
+    de llegada salen de sumar filas o columnas.
+    """
+
+    def __init__(self, frame, metrics=(), origin="pickup_borough", destination="dropoff_borough"):
+        self.metrics = list(metrics)
+        self.origin, self.destination = origin, destination
+        levels = pd.unique(pd.concat([frame[origin], frame[destination]]).dropna())
+        self.boroughs = sorted(levels)
+        n = len(self.boroughs)
+
+        o_codes = pd.Categorical(frame[origin], categories=self.boroughs).codes
+        d_codes = pd.Categorical(frame[destination], categories=self.boroughs).codes
+        valid = (o_codes >= 0) & (d_codes >= 0)
+        code = o_codes[valid].astype(np.int64) * n + d_codes[valid]
+
+        def matrix(column):
+            weights = frame[column].to_numpy()[valid].astype("float64")
+            return np.bincount(code, weights=weights, minlength=n * n).reshape(n, n)
+
+        self.count = matrix("count").round().astype(np.int64)
+        self.n = {m: matrix(f"{m}_n") for m in self.metrics}
+        self.sum = {m: matrix(f"{m}_sum") for m in self.metrics}
+
+    def mean(self, metric):
+        """
+        Media de `metric` por (origen, destino); NaN donde no hay valores.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.n[metric] > 0, self.sum[metric] / self.n[metric], np.nan)
+
+    def origin_mean(self, metric):
+        """
+        Media de `metric` por distrito de origen (todas las llegadas).
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            n = self.n[metric].sum(axis=1)
+            return np.where(n > 0, self.sum[metric].sum(axis=1) / n, np.nan)
+
+    def destination_mean(self, metric):
+        """
+        Media de `metric` por distrito de destino (todas las salidas).
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            n = self.n[metric].sum(axis=0)
+            return np.where(n > 0, self.sum[metric].sum(axis=0) / n, np.nan)
+
+    def origins(self):
+        """
+        Máscara de los distritos con algún viaje de salida.
+        """
+        return self.count.sum(axis=1) > 0
+
+    def destinations(self):
+        """
+        Máscara de los distritos con algún viaje de llegada.
+        """
+        return self.count.sum(axis=0) > 0
+
+    def table(self, matrix, fill=0):
+        """
+        DataFrame origen x destino de `matrix`, solo con los distritos que tienen
+        viajes en cada eje (como un pivot) y `fill` en las celdas vacías.
+        """
+        rows, cols = self.origins(), self.destinations()
+        boroughs = np.asarray(self.boroughs, dtype=object)
+        values = np.where(np.isnan(matrix), fill, matrix) if matrix.dtype.kind == "f" else matrix
+        return pd.DataFrame(
+            values[np.ix_(rows, cols)],
+            index=pd.Index(boroughs[rows], name=self.origin),
+            columns=pd.Index(boroughs[cols], name=self.destination),
+        )
+
+
+# ----------------------------------------------------------------------
+# --- MATRIZ ORIGEN-DESTINO POR ZONAS (REJILLA FINA) ---
+# ----------------------------------------------------------------------
+
+ZONE_CELL_DEG = 0.01  # lado de cada zona de la rejilla (~1 km en Nueva York)
+ZONE_METRICS = ["trip_minutes", "trip_distance_km"]
+ZONE_TOP_FLOWS = 40  # flujos del mapa de calor por zonas
+ZONE_RADAR_ZONES = 10  # zonas (las de más actividad) del radar por zonas
+
+
+class ZoneODMatrix:
+    """
+    Matriz origen-destino dispersa sobre una rejilla de ZONE_CELL_DEG grados.
+    Se calcula una vez al cargar los datos: cada par (zona de salida, zona de
+    llegada) con viajes es una entrada con su nº de viajes y, por métrica, nº de
+    valores y suma. Los pares se guardan ordenados por clave (para buscarlos con
+    searchsorted) y con un orden por nº de viajes (para los top-K flujos), así
+    que las vistas por zonas no recorren los viajes.
+    """
+
+    def __init__(self, df, cell_deg=ZONE_CELL_DEG, metrics=ZONE_METRICS):
+        self.cell_deg = cell_deg
+        self.metrics = [m for m in metrics if m in df.columns]
+        columns = ["pickup_latitude", "pickup_longitude", "dropoff_latitude", "dropoff_longitude"]
+        coords = [
+            df[c].to_numpy().astype("float64") if c in df.columns else np.full(len(df), np.nan)
+            for c in columns
+        ]
+        valid = np.logical_and.reduce([np.isfinite(c) for c in coords])
+        positions = np.flatnonzero(valid)
+        n = len(positions)
+
+        # Clave de zona: fila y columna de la rejilla global (independiente de los datos)
+        limit = int(np.ceil(360 / cell_deg)) + 1
+        # (primero las salidas y después las llegadas)
+        rows = np.floor(np.concatenate([coords[0][positions], coords[2][positions]]) / cell_deg)
+        cols = np.floor(np.concatenate([coords[1][positions], coords[3][positions]]) / cell_deg)
+        cell_keys = rows.astype(np.int64) * (2 * limit) + (cols.astype(np.int64) + limit)
+        zone_keys, zones = np.unique(cell_keys, return_inverse=True)
+        zones = zones.ravel()
+        self.n_zones = len(zone_keys)
+        self.zone_lat = ((zone_keys // (2 * limit)) + 0.5) * cell_deg
+        self.zone_lon = ((zone_keys % (2 * limit)) - limit + 0.5) * cell_deg
+        origin, destination = zones[:n], zones[n:]
+
+        # Pares origen-destino dispersos (ordenados por clave)
+        pair_keys = origin.astype(np.int64) * max(self.n_zones, 1) + destination
+        self.pairs, inverse = np.unique(pair_keys, return_inverse=True)
+        inverse = inverse.ravel()
+        self.origin = self.pairs // max(self.n_zones, 1)
+        self.destination = self.pairs % max(self.n_zones, 1)
+        self.count = np.bincount(inverse, minlength=len(self.pairs)).astype(np.int64)
+        self.n = {}
+        self.sum = {}
+        for m in self.metrics:
+            values = df[m].to_numpy()[positions].astype("float64")
+            finite = np.isfinite(values)
+            self.n[m] = np.bincount(inverse, weights=finite, minlength=len(self.pairs))
+            self.sum[m] = np.bincount(
+                inverse, weights=np.where(finite, values, 0.0), minlength=len(self.pairs)
+            )
+        self.by_count = np.argsort(-self.count, kind="stable")
+
+        # Nombre de cada zona: su distrito más frecuente y las coordenadas del centro
+        self.labels = self._zone_labels(df, positions, origin, destination)
+
+    def _zone_labels(self, df, positions, origin, destination):
+        if "pickup_borough" not in df.columns or "dropoff_borough" not in df.columns:
+            names = np.full(self.n_zones, "", dtype=object)
+        else:
+            boroughs = pd.concat(
+                [df["pickup_borough"].iloc[positions], df["dropoff_borough"].iloc[positions]],
+                ignore_index=True,
+            )
+            codes, uniques = pd.factorize(boroughs)
+            known = codes >= 0
+            zones = np.concatenate([origin, destination])[known]
+            n_boroughs = max(len(uniques), 1)
+            votes = np.bincount(
+                zones * n_boroughs + codes[known], minlength=self.n_zones * n_boroughs
+            ).reshape(self.n_zones, n_boroughs)
+            names = np.asarray(list(uniques) or [""], dtype=object)[votes.argmax(axis=1)]
+            names[votes.sum(axis=1) == 0] = ""
+        return [
+            f"{name} ({lat:.3f}, {lon:.3f})".strip()
+            for name, lat, lon in zip(names, self.zone_lat, self.zone_lon)
+        ]
+
+    def nbytes(self):
+        arrays = [self.pairs, self.origin, self.destination, self.count, self.by_count]
+        arrays += list(self.n.values()) + list(self.sum.values())
+        return int(sum(a.nbytes for a in arrays))
+
+    def _mean(self, metric, entries):
+        n = self.n[metric][entries]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, self.sum[metric][entries] / n, np.nan)
+
+    def top_flows(self, k=ZONE_TOP_FLOWS):
+        """
+        Los k pares origen-destino con más viajes: DataFrame con origin,
+        destination (nombres de zona), count y '<m>_mean' por métrica.
+        """
+        entries = self.by_count[:k]
+        labels = np.asarray(self.labels, dtype=object)
+        flows = pd.DataFrame(
+            {
+                "origin": labels[self.origin[entries]],
+                "destination": labels[self.destination[entries]],
+                "count": self.count[entries],
+            }
+        )
+        for m in self.metrics:
+            flows[f"{m}_mean"] = self._mean(m, entries)
+        return flows
+
+    def flow_tables(self, metric, k=ZONE_TOP_FLOWS):
+        """
+        Tablas origen x destino (media de `metric` y nº de viajes) de las zonas
+        que aparecen en los k flujos principales, ordenadas por actividad. Los
+        pares sin viajes quedan a 0, como en el mapa de calor por distritos.
+        """
+        if len(self.pairs) == 0:
+            return pd.DataFrame(), pd.DataFrame()
+        entries = self.by_count[:k]
+        origins = self._by_activity(np.unique(self.origin[entries]), axis=0)
+        destinations = self._by_activity(np.unique(self.destination[entries]), axis=1)
+
+        # Buscar cada par de la tabla en la lista dispersa
+        keys = (origins[:, None] * max(self.n_zones, 1) + destinations[None, :]).ravel()
+        found = np.searchsorted(self.pairs, keys)
+        found = np.minimum(found, len(self.pairs) - 1)
+        present = self.pairs[found] == keys
+        means = np.where(present, self._mean(metric, found), np.nan)
+        counts = np.where(present, self.count[found], 0)
+
+        labels = np.asarray(self.labels, dtype=object)
+        index = pd.Index(labels[origins], name="pickup_zone")
+        columns = pd.Index(labels[destinations], name="dropoff_zone")
+        shape = (len(origins), len(destinations))
+        df_mean = pd.DataFrame(np.nan_to_num(means.reshape(shape)), index=index, columns=columns)
+        df_count = pd.DataFrame(counts.reshape(shape), index=index, columns=columns)
+        return df_mean, df_count
+
+    def zone_activity(self, axis):
+        """
+        Nº de viajes de cada zona como salida (axis=0) o como llegada (axis=1).
+        """
+        zones = self.origin if axis == 0 else self.destination
+        return np.bincount(zones, weights=self.count, minlength=self.n_zones)
+
+    def _by_activity(self, zones, axis):
+        activity = self.zone_activity(axis)[zones]
+        return zones[np.argsort(-activity, kind="stable")]
+
+    def zone_means(self, metric, axis):
+        """
+        Media de `metric` por zona de salida (axis=0) o de llegada (axis=1).
+        """
+        zones = self.origin if axis == 0 else self.destination
+        n = np.bincount(zones, weights=self.n[metric], minlength=self.n_zones)
+        total = np.bincount(zones, weights=self.sum[metric], minlength=self.n_zones)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, total / n, np.nan)
+
+    def top_zones(self, k=ZONE_RADAR_ZONES):
+        """
+        Las k zonas con más viajes (salidas + llegadas), de más a menos.
+        """
+        activity = self.zone_activity(0) + self.zone_activity(1)
+        return np.argsort(-activity, kind="stable")[:k]
+
+
+def day_range(t0, n_days, start_date=None, end_date=None):
+    """
+    Índices (primero, último) de los días de [start_date, end_date] contados
+    desde el día t0, recortados a [0, n_days - 1]. None en un extremo = sin límite.
+    Si el fin es anterior al inicio, las dos fechas se intercambian.
+    """
+    if start_date is not None and end_date is not None:
+        if pd.Timestamp(end_date) < pd.Timestamp(start_date):
+            start_date, end_date = end_date, start_date
+    first = 0 if start_date is None else (pd.Timestamp(start_date).normalize() - t0).days
+    last = n_days - 1 if end_date is None else (pd.Timestamp(end_date).normalize() - t0).days
+    return max(first, 0), min(last, n_days - 1)
+
+
+# ----------------------------------------------------------------------
+# --- PIRÁMIDE DE AGREGADOS TEMPORALES (PESTAÑA EVOLUCIÓN) ---
+# ----------------------------------------------------------------------
+
+ROLLUP_METRICS = ["passenger_count", "total_amount", "trip_minutes", "trip_distance_km"]
+ROLLUP_LEVELS = [5, 15, 60, 1440]  # minutos por franja de cada nivel (5 min ... 1 día)
+ROLLUP_MAX_POINTS = 4000  # si una serie tuviera más puntos se usa el nivel siguiente
+
+
+class TimeRollups:
+    """
+    Sumas de ROLLUP_METRICS (y nº de viajes) por franjas de tiempo de 5 min,
+    15 min, 1 hora y 1 día, precalculadas al cargar los datos. Solo el nivel de
+    5 minutos recorre los viajes (un np.bincount por métrica); cada nivel
+    superior se obtiene sumando bloques del anterior, porque todos empiezan a
+    medianoche del primer día y cubren días completos. Las vistas por hora del
+    día y por hora de la semana salen del nivel horario, así que ninguna
+    consulta depende del número de viajes.
+    """
+
+    def __init__(self, df, metrics=ROLLUP_METRICS):
+        self.metrics = [m for m in metrics if m in df.columns]
+        self.integer_metrics = {
+            m for m in self.metrics if pd.api.types.is_integer_dtype(df[m])
+        }
+        self.levels = {}
+        if len(df) == 0 or "tpep_pickup_datetime" not in df.columns:
+            self.t0 = pd.Timestamp.now().normalize()
+            self.n_days = 0
+            for minutes in ROLLUP_LEVELS:
+                self.levels[minutes] = {"count": np.zeros(0)}
+                self.levels[minutes].update({m: np.zeros(0) for m in self.metrics})
+            return
+
+        times = df["tpep_pickup_datetime"]
+        self.t0 = times.min().normalize()
+        elapsed = (times - self.t0).to_numpy(dtype="timedelta64[ns]").view("int64")
+        valid = elapsed >= 0  # descarta NaT
+        base_ns = ROLLUP_LEVELS[0] * 60 * 10**9
+        buckets = elapsed[valid] // base_ns
+        per_day = 1440 // ROLLUP_LEVELS[0]
+        self.n_days = int(buckets.max()) // per_day + 1
+        n_base = self.n_days * per_day
+
+        base = {"count": np.bincount(buckets, minlength=n_base).astype("float64")}
+        for m in self.metrics:
+            values = df[m].to_numpy()[valid].astype("float64")
+            base[m] = np.bincount(
+                buckets, weights=np.where(np.isfinite(values), values, 0.0), minlength=n_base
+            )
+        self.levels[ROLLUP_LEVELS[0]] = base
+
+        # Niveles superiores: suma de bloques consecutivos del nivel anterior
+        for finer, coarser in zip(ROLLUP_LEVELS, ROLLUP_LEVELS[1:]):
+            factor = coarser // finer
+            self.levels[coarser] = {
+                key: values.reshape(-1, factor).sum(axis=1)
+                for key, values in self.levels[finer].items()
+            }
+
+    def nbytes(self):
+        return int(sum(v.nbytes for level in self.levels.values() for v in level.values()))
+
+    def day_range(self, start_date=None, end_date=None):
+        return day_range(self.t0, self.n_days, start_date, end_date)
+
+    def _values(self, key, level, d0, d1):
+        per_day = 1440 // level
+        values = self.levels[level][key][d0 * per_day : (d1 + 1) * per_day]
+        if key in self.integer_metrics:
+            values = values.round().astype(np.int64)
+        return values
+
+    def level_for(self, minutes, d0, d1):
+        """
+        Nivel más fino a partir de `minutes` con el que la serie de [d0, d1] no
+        pasa de ROLLUP_MAX_POINTS puntos.
+        """
+        n_days = max(d1 - d0 + 1, 1)
+        for level in ROLLUP_LEVELS:
+            if level >= minutes and n_days * 1440 // level <= ROLLUP_MAX_POINTS:
+                return level
+        return ROLLUP_LEVELS[-1]
+
+    def series(self, metric, level, d0, d1):
+        """
+        Serie temporal de `metric` con franjas de `level` minutos en los días
+        [d0, d1]: DataFrame con bucket (inicio de la franja), value y count.
+        """
+        per_day = 1440 // level
+        starts = self.t0 + pd.to_timedelta(
+            np.arange(d0 * per_day, (d1 + 1) * per_day) * level, unit="min"
+        )
+        return pd.DataFrame(
+            {
+                "bucket": starts,
+                "value": self._values(metric, level, d0, d1),
+                "count": self._values("count", level, d0, d1).astype(np.int64),
+            }
+        )
+
+    def hour_of_day(self, metric, d0, d1):
+        """
+        Suma de `metric` y nº de viajes por hora del día (0-23) en los días [d0, d1].
+        """
+        values = self._values(metric, 60, d0, d1).reshape(-1, 24).sum(axis=0)
+        trips = self._values("count", 60, d0, d1).reshape(-1, 24).sum(axis=0)
+        return pd.DataFrame(
+            {"hour": np.arange(24), "value": values, "count": trips.astype(np.int64)}
+        )
+
+    def hour_of_week(self, metric, d0, d1):
+        """
+        Suma de `metric` por día de la semana (0 = lunes) y hora: matriz 7 x 24.
+        """
+        values = self._values(metric, 60, d0, d1).reshape(-1, 24)
+        weekdays = (self.t0.weekday() + np.arange(d0, d1 + 1)) % 7
+        table = np.zeros((7, 24), dtype=values.dtype)
+        np.add.at(table, weekdays[: len(values)], values)
+        return table
+
+
+# ----------------------------------------------------------------------
+# --- FLUJOS DE PAGO (SANKEY FILTRABLE) ---
+# ----------------------------------------------------------------------
+
+SANKEY_METRICS = [
+    "fare_amount",
+    "extra",
+    "tip_amount",
+    "tolls_amount",
+    "improvement_surcharge",
+    "total_amount",
+]
+
+
+class PaymentFlows:
+    """
+    Sumas de SANKEY_METRICS (y nº de viajes) por (día, hora, distrito de
+    recogida, tipo de pago) en un array denso, calculado al cargar los datos
+    con un np.bincount por métrica sobre el código combinado. Los distritos y
+    tipos de pago llevan una posición extra para los valores ausentes, que solo
+    cuenta cuando no se filtra por esa dimensión. Cualquier combinación de
+    filtros es una suma sobre un trozo del array, sin recorrer viajes.
+    """
+
+    HOURS = 24
+
+    def __init__(self, df, metrics=SANKEY_METRICS):
+        self.metrics = [m for m in metrics if m in df.columns]
+        self.boroughs, self.payment_types = [], []
+        if len(df) == 0 or "tpep_pickup_datetime" not in df.columns:
+            self.t0 = pd.Timestamp.now().normalize()
+            self.n_days = 0
+            self.sums = np.zeros((len(self.metrics), 0, self.HOURS, 1, 1))
+            self.count = np.zeros((0, self.HOURS, 1, 1))
+            return
+
+        pickup = df["tpep_pickup_datetime"]
+        self.t0 = pickup.min().normalize()
+        days = (
+            df["pickup_day"].to_numpy()
+            if "pickup_day" in df.columns
+            else (pickup.dt.normalize() - self.t0).dt.days.to_numpy()
+        ).astype(np.int64)
+        hours = (
+            df["pickup_hour"] if "pickup_hour" in df.columns else pickup.dt.hour
+        ).to_numpy().astype(np.int64)
+        self.n_days = int(days.max()) + 1
+
+        def codes(column):
+            if column not in df.columns:
+                return np.zeros(len(df), dtype=np.int64), []
+            values, uniques = pd.factorize(df[column], sort=True)
+            return np.where(values < 0, len(uniques), values).astype(np.int64), list(uniques)
+
+        borough_codes, self.boroughs = codes("pickup_borough")
+        payment_codes, self.payment_types = codes("payment_type")
+        shape = (self.n_days, self.HOURS, len(self.boroughs) + 1, len(self.payment_types) + 1)
+        code = np.ravel_multi_index((days, hours, borough_codes, payment_codes), shape)
+        size = int(np.prod(shape))
+
+        self.count = np.bincount(code, minlength=size).astype("float64").reshape(shape)
+        sums = []
+        for m in self.metrics:
+            values = df[m].to_numpy().astype("float64")
+            values = np.where(np.isfinite(values), values, 0.0)
+            sums.append(np.bincount(code, weights=values, minlength=size).reshape(shape))
+        self.sums = np.stack(sums) if sums else np.zeros((0,) + shape)
+
+    def nbytes(self):
+        return int(self.sums.nbytes + self.count.nbytes)
+
+    def day_range(self, start_date=None, end_date=None):
+        return day_range(self.t0, self.n_days, start_date, end_date)
+
+    @staticmethod
+    def _positions(selected, levels):
+        # None o vacío = todos (incluida la posición de valores ausentes)
+        if not selected:
+            return np.arange(len(levels) + 1)
+        lookup = {value: i for i, value in enumerate(levels)}
+        return np.unique(np.array([lookup[v] for v in selected if v in lookup], dtype=np.int64))
+
+    def totals(self, d0, d1, h0=0, h1=23, boroughs=None, payment_types=None):
+        """
+        Suma de cada métrica y nº de viajes con los filtros dados (días [d0, d1],
+        horas [h0, h1], distritos de recogida y tipos de pago). Devuelve un dict
+        métrica -> suma, con el nº de viajes en "count".
+        """
+        b = self._positions(boroughs, self.boroughs)
+        p = self._positions(payment_types, self.payment_types)
+        days = slice(max(d0, 0), d1 + 1)
+        hours = slice(max(h0, 0), min(h1, self.HOURS - 1) + 1)
+
+        count = self.count[days, hours][:, :, b][:, :, :, p].sum()
+        sums = self.sums[:, days, hours][:, :, :, b][:, :, :, :, p].sum(axis=(1, 2, 3, 4))
+        totals = {m: float(v) for m, v in zip(self.metrics, sums)}
+        totals["count"] = int(round(count))
+        return totals
@@ -0,0 +1,34 @@
+// assets/dashExtensions_default.js
+// Funciones para la capa GeoJSON de viajes del mapa. dash-leaflet las referencia
+// desde Python como {"variable": "dashExtensions.default.<nombre>"}.
+
+window.dashExtensions = window.dashExtensions || {};
+window.dashExtensions.default = Object.assign({}, window.dashExtensions.default, {
+    // Cada feature es un viaje suelto (propiedad "i": índice del viaje) o un grupo
+    // (propiedad "n": número de viajes). Los iconos y el modo llegan en `hideout`.
+    tripPoint: function (feature, latlng, context) {
+        const props = feature.properties || {};
+        const hideout = context.hideout || {};
+        const kind = props.k || hideout.mode || "pickups";
+
+        if (props.n) {
+            const size = 30 + 8 * Math.min(Math.floor(Math.log10(props.n)), 4);
+            const cluster = L.marker(latlng, {
+                icon: L.divIcon({
+                    className: "trip-cluster trip-cluster-" + kind,
+                    html: "<div><span>" + props.n + "</span></div>",
+                    iconSize: [size, size],
+                }),
+            });
+            cluster.bindTooltip(props.n + " viajes");
+            return cluster;
+        }
+
+        const marker = L.marker(latlng, {icon: L.icon(hideout.icons[kind])});
+        marker.bindTooltip(kind === "dropoffs" ? "Llegada" : "Salida");
+        if (props.popup) {
+            marker.bindPopup(props.popup);
+        }
+        return marker;
+    },
+});
@@ -0,0 +1,103 @@
+# benchmarks/bench_serialize.py
+# Compara la serialización vectorizada de la ventana de viajes (queries.serialize_trips)
+# con el bucle por filas (iterrows) que usaba antes map_master.
+#
+# Uso: python benchmarks/bench_serialize.py [--sizes 10000 100000 1000000]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from queries import serialize_trips  # noqa: E402
+
+
+def make_trips(n, seed=0):
+    """
+    Genera una ventana sintética de n viajes con los tipos del modo compacto
+    y algunos nulos en las métricas opcionales.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2016-03-01 10:00:00")
+    df = pd.DataFrame(
+        {
+            "tpep_pickup_datetime": start
+            + pd.to_timedelta(np.sort(rng.integers(0, 3600, n)), unit="s"),
+            "pickup_latitude": (40.75 + rng.normal(0, 0.03, n)).astype("float32"),
+            "pickup_longitude": (-73.98 + rng.normal(0, 0.03, n)).astype("float32"),
+            "dropoff_latitude": (40.75 + rng.normal(0, 0.04, n)).astype("float32"),
+            "dropoff_longitude": (-73.98 + rng.normal(0, 0.04, n)).astype("float32"),
+            "passenger_count": rng.integers(0, 7, n).astype("int8"),
+            "total_amount": rng.gamma(3, 5, n).round(2).astype("float32"),
+            "trip_minutes": rng.gamma(2, 6, n).astype("float32"),
+            "trip_distance_km": rng.gamma(2, 2, n).astype("float32"),
+        },
+        index=rng.permutation(n * 2)[:n],
+    )
+    df.loc[df.index[::97], "total_amount"] = np.nan
+    return df
+
+
+def serialize_trips_loop(filtered_df):
+    """
+    Versión anterior (por filas) de la serialización de map_master.
+    """
+    filtered_df = filtered_df.reset_index(drop=False)
+    store_all = []
+    for _, row in filtered_df.iterrows():
+        idx = int(row["index"])
+        store_all.append(
+            {
+                "index": idx,
+                "pickup_latitude": float(row["pickup_latitude"]),
+                "pickup_longitude": float(row["pickup_longitude"]),
+                "dropoff_latitude": float(row["dropoff_latitude"]),
+                "dropoff_longitude": float(row["dropoff_longitude"]),
+                "passenger_count": row.get("passenger_count", None),
+                "total_amount": (
+                    float(row.get("total_amount", 0))
+                    if pd.notna(row.get("total_amount", None))
+                    else None
+                ),
+                "trip_minutes": (
+                    float(row.get("trip_minutes", 0))
+                    if pd.notna(row.get("trip_minutes", None))
+                    else None
+                ),
+                "trip_distance_km": (
+                    float(row.get("trip_distance_km", 0))
+                    if pd.notna(row.get("trip_distance_km", None))
+                    else None
+                ),
+                "tpep_pickup_datetime": str(row["tpep_pickup_datetime"]),
+            }
+        )
+    return store_all
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'filas':>10} {'iterrows (s)':>14} {'vectorizado (s)':>16} {'speedup':>9}")
+    for n in args.sizes:
+        df = make_trips(n)
+        new, t_new = timed(serialize_trips, df)
+        old, t_old = timed(serialize_trips_loop, df)
+        assert new == old, "La serialización vectorizada no coincide con el bucle"
+        print(f"{n:>10,} {t_old:>14.3f} {t_new:>16.3f} {t_old / t_new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# cache.py
+# Caché LRU en memoria del proceso, compartida entre usuarios y limitada por tamaño.
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Caché LRU thread-safe. Cada entrada declara su tamaño aproximado en bytes y,
+    cuando la suma supera `max_bytes`, se expulsan las entradas menos usadas.
+    Lleva contadores de aciertos, fallos y expulsiones.
+    """
+
+    def __init__(self, name, max_bytes, sizeof=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 1)
+        self._items = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                # No cabe ni sola: no se guarda (pero no expulsa al resto)
+                return value
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def get_or_compute(self, key, compute):
+        """
+        Devuelve el valor cacheado o lo calcula con `compute()` y lo guarda.
+        El cálculo se hace fuera del lock: dos peticiones simultáneas de la misma
+        clave pueden calcularlo ambas, pero nunca se bloquean entre sí.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            return value
+        return self.put(key, compute())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+            }
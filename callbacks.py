@@ -3,6 +3,9 @@
 
 from dash import Input, Output, State, callback_context, ALL, no_update
 import dash
+import os
+import threading
+import time
 import pandas as pd
 import numpy as np
 
@@ -11,9 +14,26 @@ import dash_leaflet as dl
 from dash.exceptions import PreventUpdate
 from dash import html, dcc
 import json
+from plotly.io.json import to_json_plotly
 
 # Importar variables de datos y layout
-from data import data, green_icon, red_icon, ICON_MAP
+from data import (
+    data,
+    pickup_index,
+    trip_lookup,
+    green_icon,
+    red_icon,
+    ICON_MAP,
+    build_trip_popup,
+    trip_popup_html,
+    cube,
+    payment_flows,
+    rollups,
+    zone_od,
+    DATASET_VERSION,
+    DATASET_META,
+    borough_dropdown,
+)
 from layout import (
     viajes_content,
     distritos_content,
@@ -22,31 +42,721 @@ from layout import (
     emisiones_de_carbono_content,
 )
 from my_plots import *
+from queries import TripWindow, serialize_trips, zoom_from_bounds
+from aggregates import PRICE_BIN_EDGES, ZONE_RADAR_ZONES, ZONE_TOP_FLOWS
+from cache import LRUCache
+from stats import sketch_violin_summary, violin_summary
+from sketches import SketchIndex
 
 DEFAULT_PAYMENT_TYPE = "Otros"
 
-# def create_markers(df, marker_type, icon):
-#     """
-#     Genera una lista de dl.Marker desde un DataFrame, usando el
-#     índice del DataFrame como 'index' en el ID del marcador.
-#     """
-#     markers = []
-#     lat_col = 'pickup_latitude' if marker_type == 'pickup' else 'dropoff_latitude'
-#     lon_col = 'pickup_longitude' if marker_type == 'pickup' else 'dropoff_longitude'
-#     tooltip = "Salida" if marker_type == 'pickup' else "Llegada"
-
-#     for idx, row in df.iterrows():
-#         marker = dl.Marker(
-#             position=(row[lat_col], row[lon_col]),
-#             icon=icon,
-#             children=[dl.Tooltip(tooltip)],
-#             # ID de coincidencia de patrones. El 'index' es el índice
-#             # original del DataFrame 'data', no la posición (iloc).
-#             id={'type': f'{marker_type}_marker', 'index': idx}
-#         )
-#         markers.append(marker)
-#     return markers
-# SAMPLE_LIMIT = 500
+# Caché de ventanas temporales del mapa, compartida por todos los usuarios del proceso
+WINDOW_CACHE_MB = int(os.environ.get("UBER_WINDOW_CACHE_MB", "256"))
+window_cache = LRUCache("ventanas", WINDOW_CACHE_MB * 2**20, sizeof=lambda w: w.nbytes())
+
+# Caché de figuras ya serializadas (JSON) de los callbacks que solo dependen de los datos
+FIGURE_CACHE_MB = int(os.environ.get("UBER_FIGURE_CACHE_MB", "32"))
+figure_cache = LRUCache("figuras", FIGURE_CACHE_MB * 2**20, sizeof=len)
+
+# Render de los viajes en el mapa: "geojson" (una única capa GeoJSON, por defecto)
+# o "markers" (un componente dl.Marker por viaje)
+MAP_RENDER_MODE = os.environ.get("UBER_MAP_RENDER", "geojson").strip().lower()
+GEOJSON_DECIMALS = 5  # ~1 m de precisión en las coordenadas enviadas
+TRIP_POINT_JS = {"variable": "dashExtensions.default.tripPoint"}
+
+
+def get_trip_window(start_ts, end_ts):
+    """
+    Devuelve la ventana [start_ts, end_ts] (viajes serializados + índices
+    espaciales) desde la caché, calculándola solo si no estaba.
+    """
+    key = (pd.Timestamp(start_ts).isoformat(), pd.Timestamp(end_ts).isoformat())
+    return window_cache.get_or_compute(
+        key, lambda: TripWindow(pickup_index.window(start_ts, end_ts))
+    )
+
+
+# Sketches de cuantiles por modo: se construyen la primera vez que se piden
+_sketch_indexes = {}
+_sketch_lock = threading.Lock()
+
+
+def get_sketch_index(mode):
+    mode = "dropoffs" if mode == "dropoffs" else "pickups"
+    index = _sketch_indexes.get(mode)
+    if index is None:
+        with _sketch_lock:
+            index = _sketch_indexes.get(mode)
+            if index is None:
+                index = SketchIndex(data, mode)
+                _sketch_indexes[mode] = index
+    return index
+
+
+def viewport_violin_summary(handle, column):
+    """
+    Resumen del violín de `column` para los viajes de un handle del viewport,
+    fusionando los sketches de las celdas/franjas (sin leer los viajes).
+    """
+    index = get_sketch_index(handle.get("mode"))
+    if column not in index.metrics:
+        return violin_summary(resolve_handle(handle)[column].to_numpy())
+    hist = index.query(column, handle["start"], handle["end"], handle.get("bounds"))
+    return sketch_violin_summary(hist, index.bin_values(column), index.alpha)
+
+
+def get_trip_record(trip_id, start_ts=None, end_ts=None):
+    """
+    Viaje serializado a partir de su id, buscado directamente por posición en la
+    tabla (sin recorrer ni serializar la ventana). Si se da el intervalo, devuelve
+    None cuando la recogida cae fuera de él.
+    """
+    pos = trip_lookup.position(trip_id)
+    if pos is None:
+        return None
+    if start_ts is not None and end_ts is not None:
+        picked_up = pickup_index.times[pos]
+        if not (
+            pd.Timestamp(start_ts).to_datetime64()
+            <= picked_up
+            <= pd.Timestamp(end_ts).to_datetime64()
+        ):
+            return None
+    return serialize_trips(data.iloc[pos : pos + 1])[0]
+
+
+# --- "Handle" de los viajes visibles (filtered-data-store) ---
+# El store no lleva los viajes sino cómo obtenerlos en el servidor: la ventana
+# temporal, el modo y los bounds del mapa, o el id del viaje aislado. Su tamaño
+# no depende del número de viajes visibles.
+
+
+def viewport_handle(start_ts, end_ts, mode, bounds, count):
+    return {
+        "start": pd.Timestamp(start_ts).isoformat(),
+        "end": pd.Timestamp(end_ts).isoformat(),
+        "mode": mode,
+        "bounds": bounds,
+        "count": int(count),
+    }
+
+
+def trip_handle(trip_id):
+    return {"trip": int(trip_id), "count": 1}
+
+
+def resolve_handle(handle):
+    """
+    Viajes (vista sobre la tabla) a los que apunta un handle de filtered-data-store.
+    Devuelve un DataFrame vacío si el handle no es válido.
+    """
+    if not isinstance(handle, dict):
+        return data.iloc[0:0]
+    if "trip" in handle:
+        pos = trip_lookup.position(handle["trip"])
+        return data.iloc[0:0] if pos is None else data.iloc[pos : pos + 1]
+    try:
+        window = get_trip_window(handle["start"], handle["end"])
+    except (KeyError, ValueError, TypeError):
+        return data.iloc[0:0]
+    positions = window.visible_positions(handle.get("mode"), handle.get("bounds"))
+    return window.df.iloc[positions]
+
+
+def trip_marker(record, mode):
+    """
+    Marcador individual de un viaje (salida o llegada según el modo), sin popup:
+    el popup se genera bajo demanda al seleccionar el viaje.
+    """
+    idx = int(record["index"])
+    if mode == "dropoffs":
+        return dl.Marker(
+            id={"type": "dropoff-marker", "index": idx},
+            position=(float(record["dropoff_latitude"]), float(record["dropoff_longitude"])),
+            icon=red_icon,
+            children=[dl.Tooltip("Llegada")],
+        )
+    return dl.Marker(
+        id={"type": "pickup-marker", "index": idx},
+        position=(float(record["pickup_latitude"]), float(record["pickup_longitude"])),
+        icon=green_icon,
+        children=[dl.Tooltip("Salida")],
+    )
+
+
+def cluster_marker(clusters, k, mode):
+    """
+    Burbuja con el número de viajes de un grupo. El 'index' del id lleva la caja
+    del grupo ("lat_min,lon_min,lat_max,lon_max") para poder hacer zoom sobre
+    ella al pulsarla sin volver a calcular la agrupación.
+    """
+    count = int(clusters["count"][k])
+    box = ",".join(
+        f"{float(clusters[key][k]):.6f}" for key in ("lat_min", "lon_min", "lat_max", "lon_max")
+    )
+    # Tamaño de la burbuja según el orden de magnitud del contador
+    size = 30 + 8 * min(int(np.log10(count)), 4)
+    kind = "dropoffs" if mode == "dropoffs" else "pickups"
+    return dl.DivMarker(
+        id={"type": "cluster-marker", "index": f"{k}:{box}"},
+        position=(float(clusters["lat"][k]), float(clusters["lon"][k])),
+        iconOptions={
+            "className": f"trip-cluster trip-cluster-{kind}",
+            "html": f"<div><span>{count}</span></div>",
+            "iconSize": [size, size],
+        },
+        children=[dl.Tooltip(f"{count} viajes")],
+    )
+
+
+def trip_point(lat, lon, properties):
+    """
+    Feature GeoJSON de tipo punto, con las coordenadas redondeadas para
+    reducir el tamaño de la respuesta.
+    """
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [round(float(lon), GEOJSON_DECIMALS), round(float(lat), GEOJSON_DECIMALS)],
+        },
+        "properties": properties,
+    }
+
+
+def trips_layer(features, mode):
+    """
+    Capa GeoJSON única con todos los puntos del mapa. El estilo, los tooltips y
+    los popups los pone la función `tripPoint` de assets/dashExtensions_default.js.
+    """
+    return dl.GeoJSON(
+        id={"type": "trips-layer", "index": 0},
+        data={"type": "FeatureCollection", "features": features},
+        pointToLayer=TRIP_POINT_JS,
+        hideout={
+            "mode": "dropoffs" if mode == "dropoffs" else "pickups",
+            "icons": {"pickups": green_icon, "dropoffs": red_icon},
+        },
+    )
+
+
+def build_cluster_children(window, mode, bounds, zoom):
+    """
+    Hijos del mapa para una ventana: capa base, marcadores sueltos y burbujas de
+    grupo al zoom actual. Devuelve (children, nº de sueltos, nº de grupos).
+    """
+    singles, clusters = window.clusters(mode, bounds, zoom)
+    n_clusters = len(clusters["count"])
+    children = [dl.TileLayer()]
+
+    if MAP_RENDER_MODE == "markers":
+        children += [trip_marker(r, mode) for r in window.records(singles)]
+        children += [cluster_marker(clusters, k, mode) for k in range(n_clusters)]
+        return children, len(singles), n_clusters
+
+    lat_key, lon_key = (
+        ("dropoff_latitude", "dropoff_longitude")
+        if mode == "dropoffs"
+        else ("pickup_latitude", "pickup_longitude")
+    )
+    features = []
+    for r in window.records(singles):
+        features.append(trip_point(r[lat_key], r[lon_key], {"i": int(r["index"])}))
+    for k in range(n_clusters):
+        box = [
+            round(float(clusters[key][k]), 6)
+            for key in ("lat_min", "lon_min", "lat_max", "lon_max")
+        ]
+        features.append(
+            trip_point(
+                clusters["lat"][k], clusters["lon"][k], {"n": int(clusters["count"][k]), "b": box}
+            )
+        )
+    children.append(trips_layer(features, mode))
+    return children, len(singles), n_clusters
+
+
+def build_selected_children(sel):
+    """
+    Hijos del mapa con un único viaje aislado: su salida y su llegada, con el
+    popup del viaje (generado solo para él).
+    """
+    idx = int(sel["index"])
+
+    if MAP_RENDER_MODE == "markers":
+        popup_content = build_trip_popup(idx)
+        pickup_marker = dl.Marker(
+            id={"type": "pickup-marker", "index": idx},
+            position=(
+                float(sel["pickup_latitude"]),
+                float(sel["pickup_longitude"]),
+            ),
+            icon=green_icon,
+            children=[dl.Tooltip("Salida"), dl.Popup(popup_content)],
+        )
+        dropoff_marker = dl.Marker(
+            id={"type": "dropoff-marker", "index": idx},
+            position=(
+                float(sel["dropoff_latitude"]),
+                float(sel["dropoff_longitude"]),
+            ),
+            icon=red_icon,
+            children=[dl.Tooltip("Salida"), dl.Popup(popup_content)],
+        )
+        return [dl.TileLayer(), pickup_marker, dropoff_marker]
+
+    popup = trip_popup_html(idx)
+    features = [
+        trip_point(
+            sel["pickup_latitude"],
+            sel["pickup_longitude"],
+            {"i": idx, "k": "pickups", "popup": popup},
+        ),
+        trip_point(
+            sel["dropoff_latitude"],
+            sel["dropoff_longitude"],
+            {"i": idx, "k": "dropoffs", "popup": popup},
+        ),
+    ]
+    return [dl.TileLayer(), trips_layer(features, "pickups")]
+
+
+# ----------------------------------------------------------------------
+# --- FIGURAS QUE SOLO DEPENDEN DE LOS DATOS (CACHEADAS) ---
+# ----------------------------------------------------------------------
+# Distritos, Sankey, waffle y lollipop solo dependen de la tabla estática y de un
+# dropdown. Sus salidas se guardan ya serializadas en una caché LRU compartida por
+# todos los usuarios, con la versión del dataset en la clave.
+
+
+def cached_output(name, build, *args):
+    """
+    Devuelve la salida de `build(*args)` desde la caché de figuras, calculándola
+    solo la primera vez. Se guarda el JSON ya serializado (figuras y componentes)
+    y se devuelve decodificado, así que cada petición recibe su propia copia.
+    """
+    key = (name, DATASET_VERSION, args)
+    payload = figure_cache.get_or_compute(key, lambda: to_json_plotly(build(*args)))
+    return json.loads(payload)
+
+
+def build_distritos_graph(selected_metric):
+    plotly_style = {
+        "template": "plotly_dark",
+        "margin": dict(t=50, l=25, r=25, b=25),
+    }
+
+    # Comprobar datos
+    if (
+        data.empty
+        or "pickup_borough" not in data.columns
+        or "dropoff_borough" not in data.columns
+    ):
+        fig = go.Figure()
+        fig.add_annotation(
+            text="Datos de distrito ('pickup_borough'/'dropoff_borough') no encontrados.",
+            xref="paper",
+            yref="paper",
+            x=0.5,
+            y=0.5,
+            showarrow=False,
+            font=dict(size=16, color="#AAAAAA"),
+        )
+        fig.update_layout(title="Error: Datos Incompletos", **plotly_style)
+        return fig, "Error en la Carga de Datos"
+
+    # Todas las agregaciones salen del cubo precalculado (no se recorre la tabla)
+
+    # ---------------------------------------
+    # --- OPCIONES DE MAPA DE CALOR ---
+    # ---------------------------------------
+    if selected_metric in ["distance", "time"]:
+
+        if selected_metric == "distance":
+            metric_col = "trip_distance_km"
+            header_text = "Matriz de Distancia Promedio (km) entre Distritos"
+            color_scale = "Blues"
+            text_format = ".2f"
+        else:
+            metric_col = "trip_minutes"
+            header_text = "Matriz de Tiempo Promedio (min) entre Distritos"
+            color_scale = "Greens"
+            text_format = ".1f"
+
+        # Matriz origen-destino (media y nº de viajes) en una sola pasada
+        od = cube.od_matrix(["trip_minutes", "trip_distance_km"])
+        df_pivot = od.table(od.mean(metric_col))
+        df_count = od.table(od.count)
+
+        fig = tab1_heatmap_distritos(df_pivot, df_count, text_format, color_scale, metric_col)
+        return fig, header_text
+
+    # ---------------------------------------
+    # --- OPCIÓN DE PIRÁMIDE (TIME vs DISTANCE) ---
+    # ---------------------------------------
+    elif selected_metric == "pyramid":
+
+        header_text = "Doble Pirámide de Flujo: Métrica Promedio por Distrito (Salida vs. Llegada)"
+
+        # Marginales de salida y de llegada de la misma matriz origen-destino
+        od = cube.od_matrix(["trip_minutes", "trip_distance_km"])
+        boroughs = pd.Series(od.boroughs, dtype=object)
+        df_pickup = pd.DataFrame(
+            {
+                "borough": boroughs,
+                "avg_time": od.origin_mean("trip_minutes"),
+                "avg_distance": od.origin_mean("trip_distance_km"),
+            }
+        )
+        df_dropoff = pd.DataFrame(
+            {
+                "borough": boroughs,
+                "avg_time": od.destination_mean("trip_minutes"),
+                "avg_distance": od.destination_mean("trip_distance_km"),
+            }
+        )
+
+        # Eje Y: distritos con viajes de salida, en orden alfabético
+        borough_order = boroughs[od.origins()].tolist()
+        fig = tab2_radar_tiempo_distancia(df_pickup, df_dropoff, borough_order, header_text)
+        return fig, header_text
+
+    # ---------------------------------------
+    # --- VISTAS POR ZONAS (REJILLA DE ~1 KM) ---
+    # ---------------------------------------
+    # Salen de la matriz OD dispersa por zonas calculada al cargar los datos
+    elif selected_metric in ["zone_distance", "zone_time"]:
+
+        if selected_metric == "zone_distance":
+            metric_col = "trip_distance_km"
+            header_text = f"Distancia Promedio (km) de los {ZONE_TOP_FLOWS} Flujos Principales entre Zonas"
+            color_scale = "Blues"
+            text_format = ".2f"
+        else:
+            metric_col = "trip_minutes"
+            header_text = f"Tiempo Promedio (min) de los {ZONE_TOP_FLOWS} Flujos Principales entre Zonas"
+            color_scale = "Greens"
+            text_format = ".1f"
+
+        df_pivot, df_count = zone_od.flow_tables(metric_col, ZONE_TOP_FLOWS)
+        fig = tab1_heatmap_distritos(df_pivot, df_count, text_format, color_scale, metric_col)
+        return fig, header_text
+
+    elif selected_metric == "zone_pyramid":
+
+        header_text = f"Tiempo vs Distancia Promedio en las {ZONE_RADAR_ZONES} Zonas con más Viajes (Salida vs. Llegada)"
+
+        zones = zone_od.top_zones(ZONE_RADAR_ZONES)
+        borough_order = [zone_od.labels[z] for z in zones]
+        df_pickup = pd.DataFrame(
+            {
+                "borough": borough_order,
+                "avg_time": zone_od.zone_means("trip_minutes", 0)[zones],
+                "avg_distance": zone_od.zone_means("trip_distance_km", 0)[zones],
+            }
+        )
+        df_dropoff = pd.DataFrame(
+            {
+                "borough": borough_order,
+                "avg_time": zone_od.zone_means("trip_minutes", 1)[zones],
+                "avg_distance": zone_od.zone_means("trip_distance_km", 1)[zones],
+            }
+        )
+        fig = tab2_radar_tiempo_distancia(df_pickup, df_dropoff, borough_order, header_text)
+        return fig, header_text
+
+    # En caso de que se seleccione un valor no manejado
+    fig = go.Figure()
+    fig.update_layout(title="Selecciona una opción válida", **plotly_style)
+    return fig, "Selección Inválida"
+
+
+def build_sankey_graph(d0=None, d1=None, h0=0, h1=23, boroughs=(), payment_types=()):
+    # --- Lógica de Datos Sankey ---
+    # Sumas de los flujos con los filtros (días, horas, boroughs de pickup y tipos
+    # de pago), desde las tablas precalculadas de flujos de pago: una suma sobre
+    # un trozo del array en lugar de recorrer las columnas
+    if d0 is None or d1 is None:
+        d0, d1 = payment_flows.day_range()
+    totals = payment_flows.totals(d0, d1, h0, h1, boroughs, payment_types)
+    if d1 < d0 or totals["count"] == 0:
+        fig = go.Figure()
+        fig.add_annotation(
+            text="No hay viajes con esos filtros.",
+            xref="paper",
+            yref="paper",
+            x=0.5,
+            y=0.5,
+            showarrow=False,
+            font=dict(size=14, color="#AAAAAA"),
+        )
+        fig.update_layout(template="plotly_dark")
+        return fig
+
+    # 1. Calcular sumas de los flujos de entrada
+    s_fare = totals.get("fare_amount", 0.0)
+    s_extra = totals.get("extra", 0.0)
+    s_tip = totals.get("tip_amount", 0.0)
+
+    # # El "Total Bruto" es la suma de los componentes que fluyen a él
+    # s_total_bruto = s_fare + s_extra + s_tip
+    # # (Nota: Omitimos mta_tax según la especificación)
+
+    # 2. Calcular sumas de los flujos de salida (Deducciones)
+    s_tolls = totals.get("tolls_amount", 0.0)
+    s_surcharge = totals.get("improvement_surcharge", 0.0)
+
+    # 3. Calcular Ganancia Neta (PROFIT)
+    # Usamos total_amount (que incluye TODO) menos las deducciones especificadas
+    s_profit = totals.get("total_amount", 0.0) - s_tolls - s_surcharge
+
+    # Definición de Nodos y Flujos
+    labels = [
+        # Nodos de Origen (Col 1)
+        "Tarifa (fare_amount)",  # 0
+        "Extras (extra)",  # 1
+        "Propina (tip_amount)",  # 2
+        # Nodo Intermedio (Col 2)
+        "Total Bruto",  # 3
+        # Nodos de Destino (Col 3 y 4)
+        "Peajes (tolls)",  # 4
+        "Recargo (surcharge)",  # 5
+        "GANANCIA NETA (Profit)",  # 6
+    ]
+
+    sources = [0, 1, 2, 3, 3, 3]  # Índices de 'labels'
+    targets = [3, 3, 3, 4, 5, 6]  # Índices de 'labels'
+    values = [s_fare, s_extra, s_tip, s_tolls, s_surcharge, s_profit]
+
+    # --- Creación de la Figura ---
+    fig = tab3_sankey_flujo(labels, sources, targets, values)
+
+    return fig
+
+
+def build_waffle_plot():
+    # Los cortes son fijos y coinciden con la dimensión price_bin del cubo
+    q1, q2, q3 = PRICE_BIN_EDGES
+    q_max = cube.maxima.get("total_amount", np.nan)
+    bin_labels = [
+        f"$0.00 - ${q1:.2f}",
+        f"${q1 + 0.01:.2f} - ${q2:.2f}",
+        f"${q2 + 0.01:.2f} - ${q3:.2f}",
+        f"${q3 + 0.01:.2f} - ${q_max:.2f}",
+    ]
+    # Nº de viajes por tramo de precio y tipo de pago, desde el cubo
+    df_waffle = cube.group(["price_bin", "payment_type"], dropna=False)
+    tipos_conocidos = set(ICON_MAP.keys())
+    df_waffle["payment_type_str"] = df_waffle["payment_type"].where(
+        df_waffle["payment_type"].isin(tipos_conocidos), DEFAULT_PAYMENT_TYPE
+    )
+    overall_frequency = df_waffle.groupby("payment_type_str")["count"].sum()
+
+    df_waffle = df_waffle.dropna(subset=["price_bin"])
+    df_waffle["price_bin"] = pd.Categorical.from_codes(
+        df_waffle["price_bin"].astype(int), categories=bin_labels
+    )
+    df_grouped = (
+        df_waffle.groupby(["price_bin", "payment_type_str"], observed=False)["count"]
+        .sum()
+        .unstack(fill_value=0)
+    )
+    df_norm = df_grouped.div(df_grouped.sum(axis=1), axis=0).fillna(0)
+
+    bin_counts = df_grouped.sum(axis=1)
+    max_count = bin_counts.max()
+    proportional_heights = (bin_counts / max_count * 100).round().astype(int)
+
+    # Orden de apilamiento: Más frecuente abajo.
+    # PERO, como el gráfico se invierte, para que el MÁS FRECUENTE esté ABAJO VISUALMENTE
+    # (aunque la barra se llene de arriba abajo), seguiremos el mismo orden
+    # de sorted_types_by_volume para los bloques coloreados, y la inversión
+    # visual se hará al colocar los empty blocks.
+    sorted_types_by_volume = overall_frequency.sort_values(
+        ascending=False
+    ).index.tolist()
+
+    # --- Redondeo por mayor resto, vectorizado para todas las barras ---
+    shares = df_norm.reindex(columns=sorted_types_by_volume, fill_value=0).to_numpy()
+    heights = proportional_heights.to_numpy()
+    exact = shares * heights[:, None]
+    blocks = np.floor(exact).astype(np.int64)
+    missing = heights - blocks.sum(axis=1)
+    # Posición de cada tipo al ordenar los restos de mayor a menor (empates: el primero)
+    rank = np.argsort(np.argsort(-(exact - blocks), axis=1, kind="stable"), axis=1)
+    blocks += rank < missing[:, None]
+
+    # --- Figura: un único heatmap, sin un componente por bloque ---
+    fig = tab3_waffle_plot(
+        blocks,
+        shares,
+        sorted_types_by_volume,
+        list(df_norm.index),
+        bin_counts.to_numpy(),
+        sorted(ICON_MAP.keys()),
+    )
+    return dcc.Graph(figure=fig, config={"displayModeBar": False})
+
+
+# Granularidades de la pestaña de evolución: minutos por franja y etiqueta del eje
+GRANULARITY_MINUTES = {"5min": 5, "15min": 15, "hour": 60, "day": 1440}
+LEVEL_LABELS = {5: "Franja de 5 min", 15: "Franja de 15 min", 60: "Hora", 1440: "Día"}
+
+
+def build_lollipop_chart(selected_metric, granularity="hour_of_day", d0=None, d1=None):
+    # Todas las vistas salen de la pirámide de agregados temporales (ver
+    # aggregates.TimeRollups): el coste no depende del número de viajes
+    if d0 is None or d1 is None:
+        d0, d1 = rollups.day_range()
+
+    # (Paso 3: Definir etiquetas para el gráfico)
+    metric_labels = {
+        'passenger_count': 'Número Total de Pasajeros',
+        'total_amount': 'Ingresos Totales ($)',
+        'trip_minutes': 'Minutos Totales de Viaje',
+        'trip_distance_km': 'Distancia Total Recorrida (km)'
+    }
+    y_label = metric_labels.get(selected_metric, 'Valor')
+
+    if selected_metric not in rollups.metrics or d1 < d0:
+        fig = go.Figure()
+        fig.add_annotation(
+            text="No hay viajes en ese rango de fechas.",
+            xref="paper",
+            yref="paper",
+            x=0.5,
+            y=0.5,
+            showarrow=False,
+            font=dict(size=16, color="#AAAAAA"),
+        )
+        fig.update_layout(template="plotly_dark")
+        return fig
+
+    if granularity == "hour_of_week":
+        table = rollups.hour_of_week(selected_metric, d0, d1)
+        return tab5_hour_of_week(table, y_label, f"{y_label} por Día de la Semana y Hora")
+
+    if granularity in GRANULARITY_MINUTES:
+        # Nivel más cercano a la granularidad pedida (uno más grueso si el
+        # rango de fechas daría demasiados puntos)
+        level = rollups.level_for(GRANULARITY_MINUTES[granularity], d0, d1)
+        series = rollups.series(selected_metric, level, d0, d1)
+        bucket_label = LEVEL_LABELS[level]
+        chart_title = f"{y_label} por {bucket_label}"
+        return tab5_timeline(
+            series["bucket"].to_numpy(),
+            series["value"].to_numpy(),
+            y_label,
+            chart_title,
+            bucket_label,
+        )
+
+    # Suma de la métrica seleccionada por hora del día (horas con viajes)
+    df_grouped = rollups.hour_of_day(selected_metric, d0, d1)
+    df_grouped = df_grouped[df_grouped["count"] > 0].reset_index(drop=True)
+    chart_title = f'{y_label} por Hora del Día'
+
+    y_values = df_grouped["value"]
+    x_values = df_grouped['hour']
+    fig = tab5_stem_pop(x_values, y_values, y_label, chart_title)
+    return fig
+
+
+# Métricas de la pestaña de CO2 (sumas por borough y hora precalculadas)
+CO2_METRICS = ["co2_kg_trip", "co2_kg_per_km", "co2_kg_per_passenger"]
+
+
+def co2_metrics(metric_col=None):
+    """
+    Métricas de CO2 presentes en el cubo (más `metric_col` si no es una de ellas).
+    """
+    metrics = [m for m in CO2_METRICS if m in cube.metrics]
+    if metric_col in cube.metrics and metric_col not in metrics:
+        metrics.append(metric_col)
+    return metrics
+
+
+# ----------------------------------------------------------------------
+# --- PRECALENTAMIENTO EN SEGUNDO PLANO ---
+# ----------------------------------------------------------------------
+# Al arrancar, un hilo calcula las figuras por defecto de cada pestaña (y los
+# sketches de salidas y llegadas del mapa) para que el primer usuario no pague la
+# agregación. /ready responde 503 hasta que termina (desactivar con UBER_WARMUP=0).
+
+WARMUP_ENABLED = os.environ.get("UBER_WARMUP", "1") != "0"
+WARMUP_DISTRITOS = ["distance", "time", "pyramid", "zone_distance", "zone_time", "zone_pyramid"]  # opciones de distritos-dropdown
+WARMUP_METRICS = ["passenger_count", "total_amount", "trip_minutes", "trip_distance_km"]
+
+warmup_state = {"done": 0, "total": 0, "errors": [], "seconds": None}
+warmup_finished = threading.Event()
+
+
+def warmup_tasks():
+    """
+    Lista de (nombre, función) a ejecutar durante el precalentamiento.
+    """
+    tasks = [
+        (f"distritos:{m}", lambda m=m: cached_output("distritos", build_distritos_graph, m))
+        for m in WARMUP_DISTRITOS
+    ]
+    tasks.append(
+        (
+            "sankey",
+            lambda: cached_output(
+                "sankey", build_sankey_graph, *payment_flows.day_range(), 0, 23, (), ()
+            ),
+        )
+    )
+    tasks.append(("waffle", lambda: cached_output("waffle", build_waffle_plot)))
+    tasks += [
+        (
+            f"lollipop:{m}",
+            lambda m=m: cached_output(
+                "lollipop", build_lollipop_chart, m, "hour_of_day", *rollups.day_range()
+            ),
+        )
+        for m in WARMUP_METRICS
+    ]
+    tasks.append(("co2", lambda: cube.hour_prefix_sums(co2_metrics())))
+    tasks += [
+        (f"sketches:{mode}", lambda mode=mode: get_sketch_index(mode))
+        for mode in ("pickups", "dropoffs")
+    ]
+    return tasks
+
+
+def run_warmup():
+    t0 = time.perf_counter()
+    tasks = warmup_tasks()
+    warmup_state["total"] = len(tasks)
+    for name, task in tasks:
+        try:
+            task()
+        except Exception as exc:  # una figura rota no debe dejar el worker sin servir
+            warmup_state["errors"].append(f"{name}: {exc}")
+        warmup_state["done"] += 1
+    warmup_state["seconds"] = round(time.perf_counter() - t0, 3)
+    warmup_finished.set()
+    print(
+        f"Precalentamiento terminado: {warmup_state['done']} tareas en "
+        f"{warmup_state['seconds']:.2f} s ({len(warmup_state['errors'])} errores)"
+    )
+
+
+def start_warmup():
+    """
+    Lanza el precalentamiento en un hilo daemon (una vez por proceso).
+    """
+    if not WARMUP_ENABLED:
+        warmup_finished.set()
+        return None
+    thread = threading.Thread(target=run_warmup, name="precalentamiento", daemon=True)
+    thread.start()
+    return thread
+
+
+def warmup_status():
+    return {"ready": warmup_finished.is_set(), **warmup_state}
 
 
 def register_callbacks(app):
@@ -98,15 +808,20 @@ def register_callbacks(app):
         Output("map", "center"),  # ajustar center al seleccionar
         Output(
             "filtered-data-store", "data"
-        ),  # almacenar SOLO los viajes visibles (para gráficos)
+        ),  # handle de los viajes visibles (se resuelven en el servidor)
         Output("map-info", "children"),  # texto de info resumida
+        Output("selected-trip-store", "data"),  # viaje aislado en el mapa (o None)
         Input("start-time-input", "value"),
         Input("end-time-input", "value"),
         Input("fixed-date-store", "data"),  # fecha fija (YYYY-MM-DD)
         Input("filter-applied-flag", "data"),  # 'pickups' o 'dropoffs'
-        Input("map", "bounds"),  # pan/zoom -> actualizar visibles
+        Input("map", "bounds"),  # pan/zoom -> actualizar visibles y reagrupar
         Input({"type": "pickup-marker", "index": ALL}, "n_clicks"),
         Input({"type": "dropoff-marker", "index": ALL}, "n_clicks"),
+        Input({"type": "cluster-marker", "index": ALL}, "n_clicks"),
+        Input({"type": "trips-layer", "index": ALL}, "clickData"),  # modo GeoJSON
+        State("map", "zoom"),
+        State("selected-trip-store", "data"),
         prevent_initial_call=False,
     )
     def map_master(
@@ -117,22 +832,30 @@ def register_callbacks(app):
         current_bounds,
         pickup_clicks,
         dropoff_clicks,
+        cluster_clicks,
+        layer_clicks,
+        current_zoom,
+        selected_trip,
     ):
         """
         start_time, end_time : "HH:MM" (strings) desde los Inputs type=time
         fixed_date : "YYYY-MM-DD" desde el store
         mode : 'pickups' o 'dropoffs'
         current_bounds : [[lat_min, lon_min], [lat_max, lon_max]] (o None)
+        current_zoom : zoom actual del mapa (o None)
+        selected_trip : índice del viaje aislado tras pulsar un marcador (o None)
         """
         ctx = callback_context
 
         # Detectar qué disparó el callback de forma robusta
         triggered = None
+        trigger_value = None
         if ctx.triggered:
             trig = ctx.triggered[0]  # primer trigger (normalmente el único)
             prop_id = trig.get("prop_id", "")
+            trigger_value = trig.get("value")
             # prop_id puede ser: 'start-time-input.value' o '{"type":"pickup-marker","index":123}.n_clicks'
-            comp_id = prop_id.split(".")[0] if prop_id else ""
+            comp_id = prop_id.rsplit(".", 1)[0] if prop_id else ""
             # Si comp_id es JSON (pattern-matching), convertir a dict
             try:
                 triggered = json.loads(comp_id) if comp_id.startswith("{") else comp_id
@@ -141,13 +864,36 @@ def register_callbacks(app):
         else:
             triggered = None
 
+        # Un marcador recién pintado (n_clicks=None) no es un click
+        if isinstance(triggered, dict) and not trigger_value:
+            raise PreventUpdate
+
+        # Click sobre un viaje o un grupo, tanto en modo marcadores como GeoJSON
+        clicked_index = None
+        cluster_box = None
+        if isinstance(triggered, dict) and triggered.get("type") == "trips-layer":
+            props = (trigger_value or {}).get("properties") or {}
+            if "n" in props:
+                cluster_box = props.get("b")
+            else:
+                clicked_index = props.get("i")
+        elif isinstance(triggered, dict) and triggered.get("type") == "cluster-marker":
+            cluster_box = str(triggered.get("index", "")).split(":", 1)[-1].split(",")
+        elif isinstance(triggered, dict) and "index" in triggered:
+            clicked_index = triggered["index"]
+
+        # Volver a pulsar el viaje ya aislado solo abre su popup (en el navegador)
+        if clicked_index is not None and selected_trip is not None:
+            if int(clicked_index) == int(selected_trip):
+                raise PreventUpdate
+
         # --- Normalizaciones / validaciones ---
         if not fixed_date:
             # No tenemos fecha fija: no procesamos
             raise dash.exceptions.PreventUpdate
 
         # Si faltan horas, pongo defaults basados en dataset
-        min_dt = pd.to_datetime(data["tpep_pickup_datetime"].min())
+        min_dt = DATASET_META["pickup_min"]
         if start_time is None:
             start_time = min_dt.strftime("%H:%M")
         if end_time is None:
@@ -164,157 +910,18 @@ def register_callbacks(app):
         if end_ts <= start_ts:
             end_ts = start_ts + pd.Timedelta(hours=1)
 
-        # Filtrar por intervalo horario
-        df = data.copy()
-        # df['tpep_pickup_datetime'] = pd.to_datetime(df['tpep_pickup_datetime'])
-        filtered_df = df[
-            (df["tpep_pickup_datetime"] >= start_ts)
-            & (df["tpep_pickup_datetime"] <= end_ts)
-        ].reset_index(drop=False)
-        total_after_date = len(filtered_df)
-
-        # Si no hay datos en el intervalo
-        if total_after_date == 0:
-            info = html.Div(
-                [
-                    html.P(
-                        f"Viajes realizados en esta hora: {total_after_date}", className="mb-0 small"
-                    ),
-                    html.P(
-                        "No hay viajes en el intervalo horario seleccionado.",
-                        className="mb-0 small",
-                    ),
-                ]
-            )
-            return [dl.TileLayer()], no_update, no_update, [], info
-
-        # Serializar viajes filtrados en una lista
-        store_all = []
-        for _, row in filtered_df.iterrows():
-            idx = int(row["index"])
-            store_all.append(
-                {
-                    "index": idx,
-                    "pickup_latitude": float(row["pickup_latitude"]),
-                    "pickup_longitude": float(row["pickup_longitude"]),
-                    "dropoff_latitude": float(row["dropoff_latitude"]),
-                    "dropoff_longitude": float(row["dropoff_longitude"]),
-                    "passenger_count": row.get("passenger_count", None),
-                    "total_amount": (
-                        float(row.get("total_amount", 0))
-                        if pd.notna(row.get("total_amount", None))
-                        else None
-                    ),
-                    "trip_minutes": (
-                        float(row.get("trip_minutes", 0))
-                        if pd.notna(row.get("trip_minutes", None))
-                        else None
-                    ),
-                    "trip_distance_km": (
-                        float(row.get("trip_distance_km", 0))
-                        if pd.notna(row.get("trip_distance_km", None))
-                        else None
-                    ),
-                    "tpep_pickup_datetime": str(row["tpep_pickup_datetime"]),
-                }
-            )
-
-        # Helper para comprobar si un punto está en bounds
-        def in_bounds(lat, lon, bounds):
-            if bounds is None:
-                return True
-            try:
-                (lat_min, lon_min), (lat_max, lon_max) = bounds[0], bounds[1]
-                return (
-                    (lat >= min(lat_min, lat_max))
-                    and (lat <= max(lat_min, lat_max))
-                    and (lon >= min(lon_min, lon_max))
-                    and (lon <= max(lon_min, lon_max))
-                )
-            except Exception:
-                return True
-
-        # --- Caso 1: click en marcador (pattern-matching -> triggered es dict) ---
-        if isinstance(triggered, dict) and "type" in triggered and "index" in triggered:
-            clicked_index = int(triggered["index"])
-            sel = next((r for r in store_all if int(r["index"]) == clicked_index), None)
+        # --- Caso 1: click en un viaje (marcador o punto de la capa GeoJSON) ---
+        if clicked_index is not None:
+            # Búsqueda directa por id del viaje: no depende del tamaño de la ventana
+            sel = get_trip_record(clicked_index, start_ts, end_ts)
             if sel is None:
                 # click en marcador que no está en current interval -> no update
                 pass
             else:
                 # Construir pickup + dropoff y ajustar bounds/center
                 idx = int(sel["index"])
-                pickup_marker = dl.Marker(
-                    id={"type": "pickup-marker", "index": idx},
-                    position=(
-                        float(sel["pickup_latitude"]),
-                        float(sel["pickup_longitude"]),
-                    ),
-                    icon=green_icon if "green_icon" in globals() else None,
-                    children=[
-                        dl.Tooltip("Salida"),
-                        dl.Popup(
-                            html.Div(
-                                [
-                                    html.H5(
-                                        "🚖 Información del viaje",
-                                        className="text-dark",
-                                    ),
-                                    html.P(
-                                        f"👤 Pasajeros: {sel.get('passenger_count', 'N/A')}"
-                                    ),
-                                    html.P(
-                                        f"💰 Total: ${float(sel.get('total_amount', 0)):.2f}"
-                                    ),
-                                    html.P(
-                                        f"⏱️ Duración: {float(sel.get('trip_minutes', 0)):.1f} min"
-                                    ),
-                                    html.P(
-                                        f"🛣️ Distancia: {float(sel.get('trip_distance_km', 0)):.2f} km"
-                                    ),
-                                ],
-                                className="text-secondary",
-                                style={"color": "black"},
-                            )
-                        ),
-                    ],
-                )
-                dropoff_marker = dl.Marker(
-                    id={"type": "dropoff-marker", "index": idx},
-                    position=(
-                        float(sel["dropoff_latitude"]),
-                        float(sel["dropoff_longitude"]),
-                    ),
-                    icon=red_icon if "red_icon" in globals() else None,
-                    children=[
-                        dl.Tooltip("Salida"),
-                        dl.Popup(
-                            html.Div(
-                                [
-                                    html.H5(
-                                        "🚖 Información del viaje",
-                                        className="text-dark",
-                                    ),
-                                    html.P(
-                                        f"👤 Pasajeros: {sel.get('passenger_count', 'N/A')}"
-                                    ),
-                                    html.P(
-                                        f"💰 Total: ${float(sel.get('total_amount', 0)):.2f}"
-                                    ),
-                                    html.P(
-                                        f"⏱️ Duración: {float(sel.get('trip_minutes', 0)):.1f} min"
-                                    ),
-                                    html.P(
-                                        f"🛣️ Distancia: {float(sel.get('trip_distance_km', 0)):.2f} km"
-                                    ),
-                                ],
-                                className="text-secondary",
-                                style={"color": "black"},
-                            )
-                        ),
-                    ],
-                )
-                children = [dl.TileLayer(), pickup_marker, dropoff_marker]
+                # El popup se genera solo para el viaje seleccionado
+                children = build_selected_children(sel)
 
                 lat1, lon1 = float(sel["pickup_latitude"]), float(
                     sel["pickup_longitude"]
@@ -336,7 +943,7 @@ def register_callbacks(app):
                 ]
                 center = [(lat_min + lat_max) / 2, (lon_min + lon_max) / 2]
 
-                new_filtered = [sel]
+                new_filtered = trip_handle(idx)
                 info = html.Div(
                     [
                         html.P(f"Viajes realizados en esta hora: 1", className="mb-0 small"),
@@ -354,230 +961,130 @@ def register_callbacks(app):
                     ]
                 )
 
-                return children, bounds, center, new_filtered, info
+                return children, bounds, center, new_filtered, info, idx
 
-        # --- Caso 2: movimiento del mapa (prop_id = 'map.bounds') ---
-        if triggered == "map" or (isinstance(triggered, str) and triggered == "map"):
-            visible = []
-            for r in store_all:
-                lat = (
-                    r["pickup_latitude"]
-                    if mode != "dropoffs"
-                    else r["dropoff_latitude"]
-                )
-                lon = (
-                    r["pickup_longitude"]
-                    if mode != "dropoffs"
-                    else r["dropoff_longitude"]
-                )
-                if in_bounds(lat, lon, current_bounds):
-                    visible.append(r)
-            if len(visible) == 0:
-                info = html.Div(
-                    [
-                        html.P(
-                            f"Viajes realizados en esta hora: {total_after_date}",
-                            className="mb-0 small",
-                        ),
-                        html.P(
-                            "No hay viajes visibles en el área actual.",
-                            className="mb-0 small",
-                        ),
-                    ]
-                )
-                return no_update, no_update, no_update, [], info
+        # Ventana temporal (cacheada): búsqueda binaria sobre la tabla ordenada,
+        # viajes serializados e índice espacial por modo para las consultas por bounds
+        window = get_trip_window(start_ts, end_ts)
+        total_after_date = len(window)
 
-            lat_min = min(
-                [
-                    (
-                        v["pickup_latitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_latitude"]
-                    )
-                    for v in visible
-                ]
-            )
-            lat_max = max(
-                [
-                    (
-                        v["pickup_latitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_latitude"]
-                    )
-                    for v in visible
-                ]
-            )
-            lon_min = min(
-                [
-                    (
-                        v["pickup_longitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_longitude"]
-                    )
-                    for v in visible
-                ]
-            )
-            lon_max = max(
-                [
-                    (
-                        v["pickup_longitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_longitude"]
-                    )
-                    for v in visible
-                ]
-            )
+        # Zoom para la agrupación: el del mapa o, si aún no lo ha enviado, estimado
+        zoom = current_zoom if current_zoom is not None else zoom_from_bounds(current_bounds)
 
+        # Si no hay datos en el intervalo
+        if total_after_date == 0:
             info = html.Div(
                 [
                     html.P(
                         f"Viajes realizados en esta hora: {total_after_date}", className="mb-0 small"
                     ),
                     html.P(
-                        f"Viajes visibles (por bounds): {len(visible)}",
+                        "No hay viajes en el intervalo horario seleccionado.",
                         className="mb-0 small",
                     ),
-                    # html.P(
-                    #     f"Lat range: {lat_min:.4f} — {lat_max:.4f}",
-                    #     className="mb-0 small",
-                    # ),
-                    # html.P(
-                    #     f"Lon range: {lon_min:.4f} — {lon_max:.4f}",
-                    #     className="mb-0 small",
-                    # ),
                 ]
             )
-            return no_update, no_update, no_update, visible, info
-
-        # --- Flujo por cambio de horas o cambio de modo (pickups/dropoffs): reconstruir marcadores ---
-        limited_points = store_all[:300]
+            return [dl.TileLayer()], no_update, no_update, [], info, None
 
-        children = [dl.TileLayer()]
+        # --- Caso 1b: click en un grupo -> zoom a la caja del grupo ---
+        if cluster_box is not None:
+            try:
+                lat_min, lon_min, lat_max, lon_max = (float(v) for v in cluster_box)
+            except (TypeError, ValueError):
+                raise PreventUpdate
+            lat_pad = (lat_max - lat_min) * 0.1 or 0.001
+            lon_pad = (lon_max - lon_min) * 0.1 or 0.001
+            bounds = [
+                [lat_min - lat_pad, lon_min - lon_pad],
+                [lat_max + lat_pad, lon_max + lon_pad],
+            ]
+            center = [(lat_min + lat_max) / 2, (lon_min + lon_max) / 2]
 
-        for r in limited_points:
-            idx = int(r["index"])
-            if mode == "dropoffs":
-                marker = dl.Marker(
-                    id={"type": "dropoff-marker", "index": idx},
-                    position=(
-                        float(r["dropoff_latitude"]),
-                        float(r["dropoff_longitude"]),
+            # Reagrupar ya con el zoom que tendrá el mapa al ajustarse a la caja
+            children, n_singles, n_clusters = build_cluster_children(
+                window, mode, bounds, zoom_from_bounds(bounds)
+            )
+            n_visible = len(window.visible_positions(mode, bounds))
+            info = html.Div(
+                [
+                    html.P(
+                        f"Viajes realizados en esta hora: {total_after_date}", className="mb-0 small"
                     ),
-                    icon=red_icon if "red_icon" in globals() else None,
-                    children=[dl.Tooltip("Llegada")],
-                )
-            else:
-                marker = dl.Marker(
-                    id={"type": "pickup-marker", "index": idx},
-                    position=(
-                        float(r["pickup_latitude"]),
-                        float(r["pickup_longitude"]),
+                    html.P(f"Viajes visibles (por bounds): {n_visible}", className="mb-0 small"),
+                    html.P(
+                        f"En el mapa: {n_singles} viajes sueltos y {n_clusters} grupos",
+                        className="mb-0 small",
                     ),
-                    icon=green_icon if "green_icon" in globals() else None,
-                    children=[
-                        dl.Tooltip("Salida"),
-                        dl.Popup(
-                            html.Div(
-                                [
-                                    html.H5(
-                                        "🚖 Información del viaje",
-                                        className="text-dark",
-                                    ),
-                                    html.P(
-                                        f"👤 Pasajeros: {r.get('passenger_count', 'N/A')}"
-                                    ),
-                                    html.P(
-                                        f"💰 Total: ${float(r.get('total_amount', 0)):.2f}"
-                                    ),
-                                    html.P(
-                                        f"⏱️ Duración: {float(r.get('trip_minutes', 0)):.1f} min"
-                                    ),
-                                    html.P(
-                                        f"🛣️ Distancia: {float(r.get('trip_distance_km', 0)):.2f} km"
-                                    ),
-                                ],
-                                className="text-secondary",
-                                style={"color": "black"},
-                            )
+                ]
+            )
+            handle = viewport_handle(start_ts, end_ts, mode, bounds, n_visible)
+            return children, bounds, center, handle, info, None
+
+        # --- Caso 2: movimiento del mapa (prop_id = 'map.bounds') ---
+        if triggered == "map" or (isinstance(triggered, str) and triggered == "map"):
+            n_visible = len(window.visible_positions(mode, current_bounds))
+            if n_visible == 0:
+                info = html.Div(
+                    [
+                        html.P(
+                            f"Viajes realizados en esta hora: {total_after_date}",
+                            className="mb-0 small",
+                        ),
+                        html.P(
+                            "No hay viajes visibles en el área actual.",
+                            className="mb-0 small",
                         ),
-                    ],
+                    ]
                 )
-            children.append(marker)
+                return no_update, no_update, no_update, [], info, no_update
 
-        # Guardar solo los puntos visibles según current_bounds (si existe)
-        visible = []
-        for r in store_all:
-            lat = r["pickup_latitude"] if mode != "dropoffs" else r["dropoff_latitude"]
-            lon = (
-                r["pickup_longitude"] if mode != "dropoffs" else r["dropoff_longitude"]
-            )
-            if in_bounds(lat, lon, current_bounds):
-                visible.append(r)
+            handle = viewport_handle(start_ts, end_ts, mode, current_bounds, n_visible)
+            lines = [
+                html.P(
+                    f"Viajes realizados en esta hora: {total_after_date}", className="mb-0 small"
+                ),
+                html.P(
+                    f"Viajes visibles (por bounds): {n_visible}",
+                    className="mb-0 small",
+                ),
+            ]
 
-        saved = visible if current_bounds is not None else store_all
+            # Con un viaje aislado no se reagrupa: el mapa sigue mostrando ese viaje
+            if selected_trip is not None:
+                return no_update, no_update, no_update, handle, html.Div(lines), no_update
 
-        lat_min = (
-            min(
-                [
-                    (
-                        v["pickup_latitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_latitude"]
-                    )
-                    for v in saved
-                ]
-            )
-            if saved
-            else 0
-        )
-        lat_max = (
-            max(
-                [
-                    (
-                        v["pickup_latitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_latitude"]
-                    )
-                    for v in saved
-                ]
-            )
-            if saved
-            else 0
-        )
-        lon_min = (
-            min(
-                [
-                    (
-                        v["pickup_longitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_longitude"]
-                    )
-                    for v in saved
-                ]
+            # Reagrupar al nuevo zoom / viewport
+            children, n_singles, n_clusters = build_cluster_children(
+                window, mode, current_bounds, zoom
             )
-            if saved
-            else 0
-        )
-        lon_max = (
-            max(
-                [
-                    (
-                        v["pickup_longitude"]
-                        if mode != "dropoffs"
-                        else v["dropoff_longitude"]
-                    )
-                    for v in saved
-                ]
+            lines.append(
+                html.P(
+                    f"En el mapa: {n_singles} viajes sueltos y {n_clusters} grupos",
+                    className="mb-0 small",
+                )
             )
-            if saved
-            else 0
+            return children, no_update, no_update, handle, html.Div(lines), no_update
+
+        # --- Flujo por cambio de horas o cambio de modo (pickups/dropoffs): reagrupar marcadores ---
+        # Todos los viajes del viewport quedan representados: sueltos si su grupo es
+        # pequeño, o dentro de una burbuja con el número de viajes
+        children, n_singles, n_clusters = build_cluster_children(
+            window, mode, current_bounds, zoom
         )
 
+        # Guardar solo los puntos visibles según current_bounds (si existe)
+        n_visible = len(window.visible_positions(mode, current_bounds))
+        saved = viewport_handle(start_ts, end_ts, mode, current_bounds, n_visible)
+
         info = html.Div(
             [
                 html.P(f"Viajes realizados en esta hora: {total_after_date}", className="mb-0 small"),
                 html.P(
-                    f"Viajes visibles (por bounds): {len(saved)}",
+                    f"Viajes visibles (por bounds): {n_visible}",
+                    className="mb-0 small",
+                ),
+                html.P(
+                    f"En el mapa: {n_singles} viajes sueltos y {n_clusters} grupos",
                     className="mb-0 small",
                 ),
                 # html.P(
@@ -589,7 +1096,7 @@ def register_callbacks(app):
             ]
         )
 
-        return children, no_update, no_update, saved, info
+        return children, no_update, no_update, saved, info, None
 
     # ---------------------------------------------------------------------
     # 4) CALLBACK: GRAFICOS
@@ -601,10 +1108,15 @@ def register_callbacks(app):
         Input("analysis-dropdown", "value"),
         Input("filtered-data-store", "data"),
     )
-    def update_analysis_graph(selected_value, filtered_data_dict):
+    def update_analysis_graph(selected_value, filtered_handle):
 
+        # El store solo trae el handle (con el nº de viajes visibles); los viajes
+        # se leen de la tabla del servidor solo si el gráfico los necesita
+        num_trips = 0
+        if isinstance(filtered_handle, dict):
+            num_trips = int(filtered_handle.get("count") or 0)
 
-        if not filtered_data_dict or len(filtered_data_dict) == 0:
+        if num_trips == 0:
             fig = go.Figure()
             fig.add_annotation(
                 text="No hay datos visibles en el área del mapa.",
@@ -618,11 +1130,9 @@ def register_callbacks(app):
             fig.update_layout(title="Ajuste el Zoom")
             return fig
 
-        filtered_data = pd.DataFrame(filtered_data_dict)
-        num_trips = len(filtered_data)
-
         # Treemap - pasajeros
         if selected_value == "passengers":
+            filtered_data = resolve_handle(filtered_handle)
             passenger_counts = (
                 filtered_data["passenger_count"].value_counts().reset_index()
             )
@@ -634,15 +1144,29 @@ def register_callbacks(app):
             fig = tab1_treemap_pasajeros(passenger_counts, num_trips)
             return fig
 
-        # Violin - tiempo
-        elif selected_value == "trip_time":
-            fig = tab1_violin_plot(filtered_data, num_trips)
-            return fig
-
-        # Violin - distancia
-        elif selected_value == "trip_distance":
-            fig = tab1_violin_distancia(filtered_data, num_trips)
-            return fig
+        # Violin - tiempo / distancia: densidad y cuartiles resumidos en el servidor
+        elif selected_value in ("trip_time", "trip_distance"):
+            column = "trip_minutes" if selected_value == "trip_time" else "trip_distance_km"
+            if "start" in filtered_handle:
+                summary = viewport_violin_summary(filtered_handle, column)
+            else:
+                summary = violin_summary(resolve_handle(filtered_handle)[column].to_numpy())
+            if summary is None:
+                fig = go.Figure()
+                fig.add_annotation(
+                    text="No hay valores válidos para este gráfico.",
+                    xref="paper",
+                    yref="paper",
+                    x=0.5,
+                    y=0.5,
+                    showarrow=False,
+                    font=dict(size=16, color="#AAAAAA"),
+                )
+                fig.update_layout(**plotly_style)
+                return fig
+            if selected_value == "trip_time":
+                return tab1_violin_plot(summary, num_trips)
+            return tab1_violin_distancia(summary, num_trips)
 
         # Default vacío
         fig = go.Figure()
@@ -659,171 +1183,41 @@ def register_callbacks(app):
         Input("distritos-dropdown", "value"),
     )
     def update_distritos_graph(selected_metric):
-
-        plotly_style = {
-            "template": "plotly_dark",
-            "margin": dict(t=50, l=25, r=25, b=25),
-        }
-
-        # Comprobar datos
-        if (
-            data.empty
-            or "pickup_borough" not in data.columns
-            or "dropoff_borough" not in data.columns
-        ):
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Datos de distrito ('pickup_borough'/'dropoff_borough') no encontrados.",
-                xref="paper",
-                yref="paper",
-                x=0.5,
-                y=0.5,
-                showarrow=False,
-                font=dict(size=16, color="#AAAAAA"),
-            )
-            fig.update_layout(title="Error: Datos Incompletos", **plotly_style)
-            return fig, "Error en la Carga de Datos"
-
-        df_trips = data.copy()
-
-        # ---------------------------------------
-        # --- OPCIONES DE MAPA DE CALOR ---
-        # ---------------------------------------
-        if selected_metric in ["distance", "time"]:
-
-            if selected_metric == "distance":
-                metric_col = "trip_distance_km"
-                header_text = "Matriz de Distancia Promedio (km) entre Distritos"
-                color_scale = "Blues"
-                text_format = ".2f"
-            else:
-                metric_col = "trip_minutes"
-                header_text = "Matriz de Tiempo Promedio (min) entre Distritos"
-                color_scale = "Greens"
-                text_format = ".1f"
-
-            # Agrupar y pivotar para el Heatmap (Origen x Destino)
-            df_agg = (
-                df_trips.groupby(["pickup_borough", "dropoff_borough"])[metric_col]
-                .mean()
-                .reset_index()
-            )
-            df_pivot = df_agg.pivot(
-                index="pickup_borough", 
-                columns="dropoff_borough",  
-                values=metric_col,
-            ).fillna(0)
-
-            # Contar número de viajes
-            df_count = (
-                df_trips.groupby(["pickup_borough", "dropoff_borough"]).size().reset_index(name="count")
-            )
-            df_count = df_count.pivot(
-                index="pickup_borough",
-                columns="dropoff_borough",
-                values="count"
-            ).fillna(0)
-
-            fig = tab1_heatmap_distritos(df_pivot, df_count, text_format, color_scale, metric_col)
-            return fig, header_text
-
-        # ---------------------------------------
-        # --- OPCIÓN DE PIRÁMIDE (TIME vs DISTANCE) ---
-        # ---------------------------------------
-        elif selected_metric == "pyramid":
-
-            header_text = "Doble Pirámide de Flujo: Métrica Promedio por Distrito (Salida vs. Llegada)"
-
-            # --- 1. Añadir datos por Origen (Salida) ---
-            df_pickup = (
-                df_trips.groupby("pickup_borough")
-                .agg(
-                    avg_time=("trip_minutes", "mean"),
-                    avg_distance=("trip_distance_km", "mean"),
-                )
-                .reset_index()
-                .rename(columns={"pickup_borough": "borough"})
-            )
-
-            # --- 2. Añadir datos por Destino (Llegada) ---
-            df_dropoff = (
-                df_trips.groupby("dropoff_borough")
-                .agg(
-                    avg_time=("trip_minutes", "mean"),
-                    avg_distance=("trip_distance_km", "mean"),
-                )
-                .reset_index()
-                .rename(columns={"dropoff_borough": "borough"})
-            )
-
-            # Aseguramos que el orden de los distritos (eje Y) es consistente
-            borough_order = sorted(df_pickup["borough"].unique())
-            df_pickup["borough"] = pd.Categorical(
-                df_pickup["borough"], categories=borough_order, ordered=True
-            )
-            df_dropoff["borough"] = pd.Categorical(
-                df_dropoff["borough"], categories=borough_order, ordered=True
-            )
-            df_pickup = df_pickup.sort_values("borough")
-            df_dropoff = df_dropoff.sort_values("borough")
-            fig = tab2_radar_tiempo_distancia(df_pickup, df_dropoff, borough_order, header_text)
-            return fig, header_text
-
-        # En caso de que se seleccione un valor no manejado
-        fig = go.Figure()
-        fig.update_layout(title="Selecciona una opción válida", **plotly_style)
-        return fig, "Selección Inválida"
+        return cached_output("distritos", build_distritos_graph, selected_metric)
 
     # ----------------------------------------------------------------------
     # --- CALLBACK 6: GENERAR GRÁFICO SANKEY (PESTAÑA PAGOS) ---
     # ----------------------------------------------------------------------
-    @app.callback(Output("sankey-graph", "figure"), Input("tabs", "active_tab"))
-    def update_sankey_graph(active_tab):
+    @app.callback(
+        Output("sankey-graph", "figure"),
+        Input("tabs", "active_tab"),
+        Input("sankey-date-range", "start_date"),
+        Input("sankey-date-range", "end_date"),
+        Input("sankey-hour-range", "value"),
+        Input("sankey-borough-dropdown", "value"),
+        Input("sankey-payment-dropdown", "value"),
+    )
+    def update_sankey_graph(
+        active_tab, start_date, end_date, hour_range, boroughs, payment_types
+    ):
         # Solo calcular si la pestaña de pagos está activa
         if active_tab != "tab-pagos" or data.empty:
             raise dash.exceptions.PreventUpdate
 
-        # --- Lógica de Datos Sankey ---
-
-        # 1. Calcular sumas de los flujos de entrada
-        s_fare = data["fare_amount"].sum()
-        s_extra = data["extra"].sum()
-        s_tip = data["tip_amount"].sum()
-
-        # # El "Total Bruto" es la suma de los componentes que fluyen a él
-        # s_total_bruto = s_fare + s_extra + s_tip
-        # # (Nota: Omitimos mta_tax según la especificación)
-
-        # 2. Calcular sumas de los flujos de salida (Deducciones)
-        s_tolls = data["tolls_amount"].sum()
-        s_surcharge = data["improvement_surcharge"].sum()
-
-        # 3. Calcular Ganancia Neta (PROFIT)
-        # Usamos total_amount (que incluye TODO) menos las deducciones especificadas
-        s_profit = data["total_amount"].sum() - s_tolls - s_surcharge
-
-        # Definición de Nodos y Flujos
-        labels = [
-            # Nodos de Origen (Col 1)
-            "Tarifa (fare_amount)",  # 0
-            "Extras (extra)",  # 1
-            "Propina (tip_amount)",  # 2
-            # Nodo Intermedio (Col 2)
-            "Total Bruto",  # 3
-            # Nodos de Destino (Col 3 y 4)
-            "Peajes (tolls)",  # 4
-            "Recargo (surcharge)",  # 5
-            "GANANCIA NETA (Profit)",  # 6
-        ]
-
-        sources = [0, 1, 2, 3, 3, 3]  # Índices de 'labels'
-        targets = [3, 3, 3, 4, 5, 6]  # Índices de 'labels'
-        values = [s_fare, s_extra, s_tip, s_tolls, s_surcharge, s_profit]
-
-        # --- Creación de la Figura ---
-        fig = tab3_sankey_flujo(labels, sources, targets, values)
-
-        return fig
+        # Filtros normalizados (índices de día, tuplas ordenadas) para que la
+        # misma selección siempre use la misma entrada de la caché
+        d0, d1 = payment_flows.day_range(start_date, end_date)
+        h0, h1 = (int(hour_range[0]), int(hour_range[1])) if hour_range else (0, 23)
+        return cached_output(
+            "sankey",
+            build_sankey_graph,
+            d0,
+            d1,
+            h0,
+            h1,
+            tuple(sorted(boroughs or ())),
+            tuple(sorted(payment_types or ())),
+        )
 
     # ----------------------------------------------------------------------
     # --- CALLBACK 7: GENERAR WAFFLE PLOT (GRÁFICO INVERTIDO) ---
@@ -835,142 +1229,7 @@ def register_callbacks(app):
         if active_tab != "tab-pagos" or data.empty:
             raise dash.exceptions.PreventUpdate
 
-        df_waffle = data.copy()
-        # q1 = df_waffle['total_amount'].quantile(0.25)
-        # q2 = df_waffle['total_amount'].quantile(0.50)
-        # q3 = df_waffle['total_amount'].quantile(0.75)
-        q1 = 10
-        q2 = 15
-        q3 = 20
-        q_max = df_waffle["total_amount"].max()
-        bin_labels = [
-            f"$0.00 - ${q1:.2f}",
-            f"${q1 + 0.01:.2f} - ${q2:.2f}",
-            f"${q2 + 0.01:.2f} - ${q3:.2f}",
-            f"${q3 + 0.01:.2f} - ${q_max:.2f}",
-        ]
-        bins = [0, q1, q2, q3, q_max]
-        df_waffle["price_bin"] = pd.cut(
-            df_waffle["total_amount"], bins=bins, labels=bin_labels, include_lowest=True
-        )
-        tipos_conocidos = set(ICON_MAP.keys())
-        df_waffle["payment_type_str"] = df_waffle["payment_type"].apply(
-            lambda x: x if x in tipos_conocidos else DEFAULT_PAYMENT_TYPE
-        )
-        df_grouped = (
-            df_waffle.groupby(["price_bin", "payment_type_str"], observed=False)
-            .size()
-            .unstack(fill_value=0)
-        )
-        df_norm = df_grouped.div(df_grouped.sum(axis=1), axis=0).fillna(0)
-
-        bin_counts = df_grouped.sum(axis=1)
-        max_count = bin_counts.max()
-        proportional_heights = (bin_counts / max_count * 100).round().astype(int)
-
-        # Orden de apilamiento: Más frecuente abajo.
-        # PERO, como el gráfico se invierte, para que el MÁS FRECUENTE esté ABAJO VISUALMENTE
-        # (aunque la barra se llene de arriba abajo), seguiremos el mismo orden
-        # de sorted_types_by_volume para los bloques coloreados, y la inversión
-        # visual se hará al colocar los empty blocks.
-        overall_frequency = df_waffle["payment_type_str"].value_counts()
-        sorted_types_by_volume = overall_frequency.sort_values(
-            ascending=False
-        ).index.tolist()
-
-        # --- 4. Generación de HTML ---
-        legend_items = []
-        legend_order = sorted(ICON_MAP.keys())
-        for payment_type in legend_order:
-            if payment_type in ICON_MAP:
-                legend_items.append(
-                    html.Div(
-                        [
-                            html.Img(
-                                src=ICON_MAP[payment_type], className="waffle-icon"
-                            ),
-                            html.Span(payment_type, className="ms-2"),
-                        ],
-                        className="d-flex align-items-center me-3",
-                    )
-                )
-        legend_div = html.Div(
-            legend_items, className="d-flex flex-wrap mb-4 justify-content-center"
-        )
-
-        waffle_bars_container = html.Div(children=[], className="waffle-bars-container")
-
-        # Iterar sobre cada bin (barra)
-        for bin_label in df_norm.index:
-
-            # --- LÓGICA DE REDONDEO ---
-            total_icons_for_this_bin = proportional_heights.loc[bin_label]
-            row_data_pct = df_norm.loc[bin_label]
-
-            total_trips = bin_counts.loc[bin_label]
-
-            counts = (row_data_pct * total_icons_for_this_bin).fillna(0)
-            num_blocks_floor = counts.apply(lambda x: int(x))
-            remainders = counts - num_blocks_floor
-            diff = total_icons_for_this_bin - num_blocks_floor.sum()
-            indices_to_adjust = remainders.nlargest(diff).index
-            final_counts = num_blocks_floor.copy()
-            for idx in indices_to_adjust:
-                final_counts[idx] += 1
-            # --- FIN REDONDEO ---
-
-            # --- 4. Generación de Bloques (Coloreados + Vacíos) ---
-
-            # Generar los bloques COLOREADOS
-            colored_blocks = []
-            for payment_type in sorted_types_by_volume:
-                if payment_type in final_counts.index:
-                    num_blocks = final_counts[payment_type]
-                    if num_blocks > 0:
-                        percentage = row_data_pct[payment_type]
-                        icon_src = ICON_MAP.get(
-                            payment_type, ICON_MAP[DEFAULT_PAYMENT_TYPE]
-                        )
-
-                        for _ in range(int(num_blocks)):
-                            colored_blocks.append(
-                                html.Img(
-                                    src=icon_src,
-                                    className="waffle-icon",
-                                    title=f"{payment_type}: {percentage:.1%}",
-                                )
-                            )
-
-            # Generar los bloques VACÍOS
-            empty_blocks = []
-            num_empty_blocks = 100 - total_icons_for_this_bin
-            for _ in range(num_empty_blocks):
-                empty_blocks.append(html.Div(className="waffle-icon-empty"))
-
-            # nvertir el orden de concatenación
-            # Los bloques vacíos van PRIMERO en la lista para que se muestren ABAJO.
-            # Los bloques coloreados van DESPUÉS para que se muestren ARRIBA.
-            blocks = empty_blocks + colored_blocks
-
-            # 5. Crear la barra Waffle
-            waffle_bar = html.Div(
-                [
-                    # NUEVO: Etiqueta superior con el número total de viajes
-                    # Se usa formateo con comas para miles (ej. 1,234)
-                    html.P(
-                        f"{int(total_trips):,} viajes", 
-                        className="waffle-label-top",
-                        style={"textAlign": "center", "fontWeight": "bold", "marginBottom": "4px"}
-                    ),
-                    html.Div(blocks, className="waffle-grid-bar"),
-                    html.P(html.B(bin_label), className="waffle-label-bottom"),
-                ],
-                className="waffle-column",
-            )
-
-            waffle_bars_container.children.append(waffle_bar)
-
-        return html.Div([legend_div, waffle_bars_container])
+        return cached_output("waffle", build_waffle_plot)
 
     @app.callback(
         Output("co2-hourly-graph", "figure"),
@@ -990,94 +1249,56 @@ def register_callbacks(app):
             "template": "plotly_dark",
             "margin": dict(t=40, l=20, r=20, b=20),
         }
-        filtered_data_dict = data
-        # Si no hay datos
-        if len(filtered_data_dict) == 0:
-            # Figura vacía con anotación
-            def empty_fig(message="No hay datos para mostrar."):
-                f = go.Figure()
-                f.add_annotation(
-                    text=message,
-                    xref="paper",
-                    yref="paper",
-                    x=0.5,
-                    y=0.5,
-                    showarrow=False,
-                    font=dict(size=14, color="#AAAAAA"),
-                )
-                f.update_layout(**plotly_style)
-                return f
+        # Figura vacía con anotación
+        def empty_fig(message="No hay datos para mostrar."):
+            f = go.Figure()
+            f.add_annotation(
+                text=message,
+                xref="paper",
+                yref="paper",
+                x=0.5,
+                y=0.5,
+                showarrow=False,
+                font=dict(size=14, color="#AAAAAA"),
+            )
+            f.update_layout(**plotly_style)
+            return f
 
+        # Si no hay datos
+        if len(cube.frame) == 0:
             return (
                 empty_fig("No hay datos visibles para las vistas de CO₂."),
-                empty_fig("No hay datos visibles para el mapa."),
                 empty_fig("No hay datos visibles para el treemap."),
             )
 
-        # Construimos DataFrame
-        df = pd.DataFrame(filtered_data_dict)
-
-        # Parsear datetime si es string
-        if not pd.api.types.is_datetime64_any_dtype(df.get("tpep_pickup_datetime")):
-            try:
-                df["tpep_pickup_datetime"] = pd.to_datetime(df["tpep_pickup_datetime"])
-            except Exception:
-                # si falla, devolver vacíos
-                return (
-                    go.Figure().update_layout(**plotly_style),
-                    go.Figure().update_layout(**plotly_style),
-                    go.Figure().update_layout(**plotly_style),
-                )
-
-        # Añadir columna hora de pickup (0-23)
-        df["pickup_hour"] = df["tpep_pickup_datetime"].dt.hour
-
-        # Aplicar filtro horario
+        # Filtros: rango horario (hora de pickup 0-23) y borough (si es multi y
+        # contiene "ALL" lo ignoramos)
         h0, h1 = int(hour_range[0]), int(hour_range[1])
-        df = df[(df["pickup_hour"] >= h0) & (df["pickup_hour"] <= h1)]
-
-        # Filtro por borough (si es multi y contiene "ALL" lo ignoramos)
+        boroughs = None
         if boroughs_selected and not (
             len(boroughs_selected) == 1 and boroughs_selected[0] == "ALL"
         ):
-            df = df[df["pickup_borough"].isin(boroughs_selected)]
+            boroughs = boroughs_selected
 
-        # Si después del filtrado quedó vacío
-        if df.empty:
+        # metric_col es uno de: 'co2_kg_trip', 'co2_kg_per_km', 'co2_kg_per_passenger'
+        if metric_col not in cube.metrics:
+            # intentar mapear nombres si vienen con variaciones
+            metric_col = "co2_kg_trip" if "co2_kg_trip" in cube.metrics else cube.metrics[0]
 
-            def empty_fig(message="No hay datos después del filtrado."):
-                f = go.Figure()
-                f.add_annotation(
-                    text=message,
-                    xref="paper",
-                    yref="paper",
-                    x=0.5,
-                    y=0.5,
-                    showarrow=False,
-                    font=dict(size=14, color="#AAAAAA"),
-                )
-                f.update_layout(**plotly_style)
-                return f
+        # Sumas por (borough, hora) con acumulados sobre la hora: cualquier
+        # combinación de slider y dropdown se responde sin recorrer filas
+        hour_sums = cube.hour_prefix_sums(co2_metrics(metric_col))
 
+        # --- 1) HOURLY BAR: agregar por hora usando la métrica seleccionada ---
+        hourly = hour_sums.hourly(metric_col, h0, h1, boroughs)
+
+        # Si después del filtrado quedó vacío
+        if hourly.empty:
             return (
                 empty_fig("No hay viajes en ese rango horario/borough."),
                 empty_fig("No hay viajes en ese rango horario/borough."),
-                empty_fig("No hay viajes en ese rango horario/borough."),
             )
 
-        # --- 1) HOURLY BAR: agregar por hora usando la métrica seleccionada ---
-        # metric_col es uno de: 'co2_kg_trip', 'co2_kg_per_km', 'co2_kg_per_passenger'
-        if metric_col not in df.columns:
-            # intentar mapear nombres si vienen con variaciones
-            metric_col = "co2_kg_trip" if "co2_kg_trip" in df.columns else df.columns[0]
-
-        hourly = (
-            df.groupby("pickup_hour")[metric_col]
-            .agg(["sum", "mean", "count"])
-            .reset_index()
-        )
-        hourly = hourly.sort_values("pickup_hour")
-
         title_map = {
             "co2_kg_trip": "CO₂ total por hora (kg)",
             "co2_kg_per_km": "CO₂ medio por km por hora (kg/km)",
@@ -1153,18 +1374,13 @@ def register_callbacks(app):
         #     )
         #     co2_map_fig.update_layout(**plotly_style)
 
-        # --- 3) TREEMAP: contribución por pickup_borough -> payment_type ---
-        # Aseguramos columnas
-        if "pickup_borough" not in df.columns:
-            df["pickup_borough"] = "Unknown"
-        treemap_df = (
-            df.groupby(["pickup_borough"])[
-                "co2_kg_trip" if "co2_kg_trip" in df.columns else metric_col
-            ]
-            .sum()
-            .reset_index()
-        )
+        # --- 3) TREEMAP: contribución por pickup_borough ---
+        treemap_metric = "co2_kg_trip" if "co2_kg_trip" in cube.metrics else metric_col
+        treemap_df = hour_sums.range_totals(treemap_metric, h0, h1, boroughs)[
+            ["pickup_borough", "sum"]
+        ]
         treemap_df.columns = ["pickup_borough", "co2_kg_sum"]
+        treemap_df["pickup_borough"] = treemap_df["pickup_borough"].astype(str)
 
         co2_treemap_fig = tab4_co2_treemap(treemap_df)
 
@@ -1180,17 +1396,8 @@ def register_callbacks(app):
         Input("tabs", "active_tab"),
     )
     def populate_boroughs(active_tab):
-        if len(data) == 0:
-            return [{"label": "Todos", "value": "ALL"}], ["ALL"]
-        df = pd.DataFrame(data)
-        if "pickup_borough" not in df.columns:
-            return [{"label": "Unknown", "value": "Unknown"}], ["Unknown"]
-        boroughs = sorted(df["pickup_borough"].dropna().unique().tolist())
-        options = [{"label": "Todos", "value": "ALL"}] + [
-            {"label": b, "value": b} for b in boroughs
-        ]
-        # por defecto seleccionar "ALL"
-        return options, ["ALL"]
+        # Las opciones salen de los metadatos calculados al cargar el dataset
+        return borough_dropdown()
     # ----------------------------------------------------------------------
     # --- CALLBACK 8: ACTUALIZAR GRÁFICO LOLLIPOP DE EVOLUCIÓN ---
     # ----------------------------------------------------------------------
@@ -1198,38 +1405,19 @@ def register_callbacks(app):
         Output("lollipop-chart", "figure"),
         [
             Input("tabs", "active_tab"),
-            Input("metric-selector", "value") # Input del RadioItems
+            Input("metric-selector", "value"), # Input del RadioItems
+            Input("granularity-selector", "value"),
+            Input("evolucion-date-range", "start_date"),
+            Input("evolucion-date-range", "end_date"),
         ]
     )
-    def update_lollipop_chart(active_tab, selected_metric):
+    def update_lollipop_chart(active_tab, selected_metric, granularity, start_date, end_date):
         
         # (Paso 1: Cláusula de guarda)
         if active_tab != "tab-evolucion" or data.empty:
             raise PreventUpdate
-        if not pd.api.types.is_datetime64_any_dtype(data['tpep_pickup_datetime']):
-            df = data.copy()
-            df['tpep_pickup_datetime'] = pd.to_datetime(df['tpep_pickup_datetime'])
-        else:
-            df = data.copy()
-
-        # Extraer la hora
-        df['hour'] = df['tpep_pickup_datetime'].dt.hour
-        
-        # Agrupar por hora y sumar la métrica seleccionada
-        df_grouped = df.groupby('hour', observed=False)[selected_metric].sum().reset_index()
-
-        # (Paso 3: Definir etiquetas para el gráfico)
-        metric_labels = {
-            'passenger_count': 'Número Total de Pasajeros',
-            'total_amount': 'Ingresos Totales ($)',
-            'trip_minutes': 'Minutos Totales de Viaje',
-            'trip_distance_km': 'Distancia Total Recorrida (km)'
-        }
-        
-        y_label = metric_labels.get(selected_metric, 'Valor')
-        chart_title = f'{y_label} por Hora del Día'
 
-        y_values = df_grouped[selected_metric]
-        x_values = df_grouped['hour']
-        fig = tab5_stem_pop(x_values, y_values, y_label, chart_title)
-        return fig
\ No newline at end of file
+        # Las fechas se pasan a índices de día: misma clave de caché para el
+        # mismo rango, lo escriba como lo escriba el DatePickerRange
+        d0, d1 = rollups.day_range(start_date, end_date)
+        return cached_output("lollipop", build_lollipop_chart, selected_metric, granularity, d0, d1)
@@ -7,7 +7,13 @@ import dash_bootstrap_components as dbc
 
 # Importar el layout y la función de registro de callbacks
 from layout import app_layout
-from callbacks import register_callbacks
+from callbacks import (
+    register_callbacks,
+    start_warmup,
+    warmup_status,
+    figure_cache,
+    window_cache,
+)
 
 # --- Crear app ---
 app = Dash(
@@ -22,6 +28,27 @@ app.layout = app_layout
 # Registrar todos los callbacks en la aplicación
 register_callbacks(app)
 
+# Precalcular en segundo plano las figuras por defecto de cada pestaña
+start_warmup()
+
+# Servidor WSGI para ejecutar varios workers (p. ej. gunicorn -w 4 dashboard:server)
+server = app.server
+
+
+# Estadísticas de las cachés del proceso (aciertos, fallos, memoria usada)
+@server.route("/cache-stats")
+def cache_stats():
+    return {"caches": [window_cache.stats(), figure_cache.stats()]}
+
+
+# Disponibilidad del worker: 503 hasta que termina el precalentamiento, para que
+# el balanceador solo envíe tráfico a workers con las figuras ya calculadas
+@server.route("/ready")
+def ready():
+    status = warmup_status()
+    return status, 200 if status["ready"] else 503
+
+
 # --- Ejecutar ---
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8050)
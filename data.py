@@ -1,21 +1,226 @@
 # data.py
 # Responsable de la carga, pre-procesamiento de datos y definiciones de activos.
 
+import os
+import time
+from html import escape
+
 import pandas as pd
 import dash_leaflet as dl
 from dash import html
 
+from aggregates import AggregateCube, PaymentFlows, TimeRollups, ZoneODMatrix
+from queries import TimeIndex, TripLookup
+from storage import (
+    file_hash,
+    find_column_store,
+    open_column_store,
+    read_snapshot,
+    write_column_store,
+    write_snapshot,
+)
+
+CSV_PATH = "uber_dataset_con_distritos.csv"
+
+# Modo compacto: categóricas + float32 + enteros pequeños (desactivar con UBER_COMPACT=0)
+COMPACT_MODE = os.environ.get("UBER_COMPACT", "1") != "0"
+
+# Columnas de texto con pocos valores distintos -> category
+CATEGORICAL_COLUMNS = ["pickup_borough", "dropoff_borough", "payment_type", "RatecodeID"]
+
+# Columnas numéricas que no necesitan float64 (coordenadas, importes, métricas derivadas)
+FLOAT32_COLUMNS = [
+    "pickup_latitude",
+    "pickup_longitude",
+    "dropoff_latitude",
+    "dropoff_longitude",
+    "fare_amount",
+    "extra",
+    "mta_tax",
+    "tip_amount",
+    "tolls_amount",
+    "improvement_surcharge",
+    "total_amount",
+    "trip_minutes",
+    "trip_distance_km",
+    "avg_speed_kmh",
+    "fuel_g_per_km",
+    "co2_kg_per_km",
+    "co2_kg_trip",
+    "co2_kg_per_passenger",
+]
+
+# Conteos de pasajeros -> int8 (caben sobradamente)
+SMALL_INT_COLUMNS = ["passenger_count", "passenger_count_safe"]
+
+# Almacén de columnas mapeado en memoria compartido entre workers (desactivar con UBER_COLUMN_STORE=0)
+COLUMN_STORE_MODE = os.environ.get("UBER_COLUMN_STORE", "1") != "0"
+
+
+def compact_dtypes(df):
+    """
+    Reduce la huella en memoria del DataFrame: texto de baja cardinalidad a
+    categórico, coordenadas/importes a float32 y conteos de pasajeros a int8.
+    Las columnas que no existan se ignoran.
+    """
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    for col in FLOAT32_COLUMNS:
+        if col in df.columns and pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype("float32")
+
+    for col in SMALL_INT_COLUMNS:
+        if col not in df.columns:
+            continue
+        if df[col].isna().any():
+            # Con nulos no se puede usar int8 sin máscara; float32 sigue siendo la mitad
+            df[col] = df[col].astype("float32")
+        elif df[col].between(-128, 127).all():
+            df[col] = df[col].astype("int8")
+
+    return df
+
+
+def print_memory_report(df):
+    """
+    Imprime la memoria ocupada por cada columna del DataFrame y el total.
+    """
+    usage = df.memory_usage(deep=True, index=True)
+    print("Memoria por columna:")
+    for col, nbytes in usage.items():
+        dtype = df.index.dtype if col == "Index" else df[col].dtype
+        print(f"  {col:<24} {str(dtype):<16} {nbytes / 2**20:9.2f} MB")
+    print(f"  {'TOTAL':<24} {'':<16} {usage.sum() / 2**20:9.2f} MB")
+
+
+def load_data(csv_path=CSV_PATH):
+    """
+    Carga el dataset de viajes, de la fuente más rápida disponible:
+      1. Almacén de columnas .npy mapeado en memoria (compartido entre workers).
+      2. Snapshot Parquet generado a partir del mismo contenido del CSV (mismo hash).
+      3. El propio CSV, que se parsea y a partir del cual se regeneran los anteriores.
+    Devuelve (DataFrame, hash del CSV).
+    """
+    t0 = time.perf_counter()
+    source_hash = file_hash(csv_path) if os.path.exists(csv_path) else None
+    options = {"compact": COMPACT_MODE}
+
+    store_dir = find_column_store(csv_path, source_hash, options) if COLUMN_STORE_MODE else None
+    df = open_column_store(store_dir) if store_dir else None
+    if df is not None:
+        origen = "almacén de columnas mmap"
+    else:
+        df = read_snapshot(csv_path, source_hash, options)
+        if df is not None:
+            origen = "snapshot Parquet"
+        elif source_hash is None:
+            raise FileNotFoundError(csv_path)
+        else:
+            print("Leyendo datos...")
+            df = pd.read_csv(csv_path)
+            print("Datos leidos!")
+            df["tpep_pickup_datetime"] = pd.to_datetime(df["tpep_pickup_datetime"])
+            df["tpep_dropoff_datetime"] = pd.to_datetime(df["tpep_dropoff_datetime"])
+            # Ordenar por hora de recogida (el índice conserva el id original del viaje)
+            df = df.sort_values("tpep_pickup_datetime", kind="stable")
+            if COMPACT_MODE:
+                df = compact_dtypes(df)
+            write_snapshot(df, csv_path, source_hash, options)
+            origen = "CSV"
+
+        if COLUMN_STORE_MODE and source_hash is not None:
+            # Publicar el almacén y reabrirlo: este proceso también pasa a usar
+            # las páginas compartidas en lugar de su copia privada
+            store_dir = write_column_store(df, csv_path, source_hash, options)
+            shared = open_column_store(store_dir) if store_dir else None
+            if shared is not None:
+                df = shared
+
+    print(f"Datos listos! ({origen}, {len(df):,} filas, {time.perf_counter() - t0:.2f} s)")
+    print_memory_report(df)
+    return df, source_hash
+
+
+def enrich_data(df):
+    """
+    Etapa de enriquecimiento tras la carga: materializa una sola vez las columnas
+    derivadas de la hora de recogida que usan los callbacks, con tipos compactos:
+      - pickup_hour (int8, 0-23) y pickup_weekday (int8, 0 = lunes)
+      - pickup_day (int16): días transcurridos desde el primer día del dataset
+      - avg_speed_kmh (float32), solo si no viene ya en el CSV
+    Devuelve el DataFrame y los extremos (mín, máx) de la hora de recogida.
+    """
+    if len(df) == 0 or "tpep_pickup_datetime" not in df.columns:
+        today = pd.Timestamp.now().normalize()
+        return df, today, today
+
+    pickup = df["tpep_pickup_datetime"]
+    pickup_min, pickup_max = pickup.min(), pickup.max()
+    df["pickup_hour"] = pickup.dt.hour.astype("int8")
+    df["pickup_weekday"] = pickup.dt.weekday.astype("int8")
+    df["pickup_day"] = (pickup.dt.normalize() - pickup_min.normalize()).dt.days.astype("int16")
+
+    if "avg_speed_kmh" not in df.columns and {"trip_distance_km", "trip_minutes"} <= set(df.columns):
+        hours = df["trip_minutes"].astype("float64") / 60
+        df["avg_speed_kmh"] = (df["trip_distance_km"] / hours.where(hours > 0)).astype("float32")
+
+    return df, pickup_min, pickup_max
+
+
+def _value_counts(df, column):
+    """
+    Valores observados de `column` (ordenados) con su nº de filas, como dict de
+    escalares de Python; None si la columna no existe.
+    """
+    if column not in df.columns:
+        return None
+    counts = df[column].value_counts(dropna=True, sort=False)
+    counts = counts[counts > 0].sort_index()
+    return {
+        (key.item() if hasattr(key, "item") else key): int(n) for key, n in counts.items()
+    }
+
+
+def dataset_metadata(df, version, pickup_min, pickup_max):
+    """
+    Metadatos del dataset calculados una sola vez al cargar (y ligados a su
+    versión): diccionarios de distritos, tipos de pago y tarifas con su nº de
+    viajes, rango de fechas, nº de filas y centro del mapa. El layout y los
+    callbacks que rellenan opciones leen de aquí en lugar de recorrer la tabla.
+    """
+    pickup_boroughs = _value_counts(df, "pickup_borough")
+    dropoff_boroughs = _value_counts(df, "dropoff_borough")
+    boroughs = sorted(set(pickup_boroughs or {}) | set(dropoff_boroughs or {}))
+    if len(df) and {"pickup_latitude", "pickup_longitude"} <= set(df.columns):
+        center = (float(df["pickup_latitude"].median()), float(df["pickup_longitude"].median()))
+    else:
+        center = (40.7128, -74.0060)  # Coordenadas de NYC como fallback
+    return {
+        "version": version,
+        "rows": len(df),
+        "boroughs": boroughs,
+        "pickup_boroughs": pickup_boroughs,
+        "dropoff_boroughs": dropoff_boroughs,
+        "payment_types": _value_counts(df, "payment_type"),
+        "ratecodes": _value_counts(df, "RatecodeID"),
+        "pickup_min": pickup_min,
+        "pickup_max": pickup_max,
+        "min_date": pickup_min.strftime("%Y-%m-%d"),
+        "max_date": pickup_max.strftime("%Y-%m-%d"),
+        "n_days": (pickup_max.normalize() - pickup_min.normalize()).days + 1,
+        "center": center,
+    }
+
+
 # --- Cargar datos ---
 try:
-    print("Leyendo datos...")
-    data = pd.read_csv("uber_dataset_con_distritos.csv")
-    print("Datos leidos!")
-    data["tpep_pickup_datetime"] = pd.to_datetime(data["tpep_pickup_datetime"])
-    data["tpep_dropoff_datetime"] = pd.to_datetime(data["tpep_dropoff_datetime"])
+    data, _source_hash = load_data()
     #data = data.sample(1_000)
-    print("Datos listos!")
 except FileNotFoundError:
-    print("Error: El archivo 'uber_dataset_procesado.csv' no se encontró.")
+    print(f"Error: El archivo '{CSV_PATH}' no se encontró.")
+    _source_hash = None
     # Crear un DataFrame vacío para evitar que la app falle al importar
     data = pd.DataFrame(
         columns=[
@@ -30,6 +235,54 @@ except FileNotFoundError:
         ]
     )
 
+# --- Columnas derivadas y extremos temporales del dataset (una sola vez) ---
+data, PICKUP_MIN, PICKUP_MAX = enrich_data(data)
+
+# --- Versión del dataset: forma parte de la clave de las cachés de figuras, así
+# que recargar un CSV distinto invalida automáticamente lo calculado antes ---
+DATASET_VERSION = (_source_hash or "vacio")[:16] + ("-compacto" if COMPACT_MODE else "")
+
+# --- Metadatos del dataset (opciones de los desplegables y defaults del layout) ---
+DATASET_META = dataset_metadata(data, DATASET_VERSION, PICKUP_MIN, PICKUP_MAX)
+
+# --- Índice temporal (la tabla está ordenada por hora de recogida) ---
+pickup_index = TimeIndex(data)
+
+# --- Posición de cada viaje por su id (selección de un viaje en el mapa) ---
+trip_lookup = TripLookup(data.index)
+
+# --- Cubo de agregados (distritos, pagos, evolución y CO2) ---
+_cube_start = time.perf_counter()
+cube = AggregateCube(data)
+print(
+    f"Cubo de agregados: {len(cube.frame):,} celdas, "
+    f"{cube.nbytes() / 2**20:.2f} MB ({time.perf_counter() - _cube_start:.2f} s)"
+)
+
+# --- Pirámide de agregados temporales (pestaña de evolución) ---
+_rollups_start = time.perf_counter()
+rollups = TimeRollups(data)
+print(
+    f"Agregados temporales: {rollups.n_days} días, 5 min a 1 día, "
+    f"{rollups.nbytes() / 2**20:.2f} MB ({time.perf_counter() - _rollups_start:.2f} s)"
+)
+
+# --- Flujos de pago por (día, hora, borough, tipo de pago) para el Sankey ---
+_flows_start = time.perf_counter()
+payment_flows = PaymentFlows(data)
+print(
+    f"Flujos de pago: {payment_flows.count.size:,} celdas, "
+    f"{payment_flows.nbytes() / 2**20:.2f} MB ({time.perf_counter() - _flows_start:.2f} s)"
+)
+
+# --- Matriz origen-destino por zonas de ~1 km (vistas por zonas de distritos) ---
+_zone_start = time.perf_counter()
+zone_od = ZoneODMatrix(data)
+print(
+    f"Matriz OD por zonas: {zone_od.n_zones:,} zonas, {len(zone_od.pairs):,} pares, "
+    f"{zone_od.nbytes() / 2**20:.2f} MB ({time.perf_counter() - _zone_start:.2f} s)"
+)
+
 # --- Íconos ---
 green_icon = {"iconUrl": "/assets/green_car.png", "iconSize": [25, 25]}
 red_icon = {"iconUrl": "/assets/red_car.png", "iconSize": [25, 25]}
@@ -42,26 +295,82 @@ ICON_MAP = {
 }
 
 # --- Marcadores ---
+# Los marcadores se construyen en los callbacks a partir de la ventana temporal activa.
 pickup_markers = []
 dropoff_markers = []
 
-if not data.empty:
-    for i, row in data.iterrows():
-        popup_content = html.Div(
-            [
-                html.H5("🚖 Información del viaje", className="text-dark"),
-                html.P(f"👤 Pasajeros: {row['passenger_count']}"),
-                html.P(f"💰 Total: ${row['total_amount']:.2f}"),
-                html.P(f"⏱️ Duración: {row['trip_minutes']:.1f} min"),
-                html.P(f"🛣️ Distancia: {row['trip_distance_km']:.2f} km"),
-            ],
-            className="text-secondary",
-        )
+
+def trip_popup_lines(trip_index):
+    """
+    Título y líneas de texto del popup de un único viaje, buscándolo en el
+    servidor por su índice. Se llama solo para el viaje que el usuario abre,
+    nunca en bloque.
+    """
+    row = data.loc[trip_index]
+    passengers = row["passenger_count"]
+    return "🚖 Información del viaje", [
+        f"👤 Pasajeros: {int(passengers) if pd.notna(passengers) else 'N/A'}",
+        f"💰 Total: ${float(row['total_amount']):.2f}",
+        f"⏱️ Duración: {float(row['trip_minutes']):.1f} min",
+        f"🛣️ Distancia: {float(row['trip_distance_km']):.2f} km",
+    ]
+
+
+def build_trip_popup(trip_index):
+    """
+    Popup de un viaje como componentes Dash (modo de marcadores individuales).
+    """
+    title, lines = trip_popup_lines(trip_index)
+    return html.Div(
+        [html.H5(title, className="text-dark")] + [html.P(line) for line in lines],
+        className="text-secondary",
+        style={"color": "black"},
+    )
+
+
+def trip_popup_html(trip_index):
+    """
+    Popup de un viaje como HTML (modo GeoJSON: lo enlaza la propia capa).
+    """
+    title, lines = trip_popup_lines(trip_index)
+    body = "".join(f"<p>{escape(line)}</p>" for line in lines)
+    return (
+        f'<div class="text-secondary" style="color: black">'
+        f'<h5 class="text-dark">{escape(title)}</h5>{body}</div>'
+    )
+
+
+def borough_dropdown():
+    """
+    Opciones y valor por defecto del desplegable de distritos de la pestaña de
+    CO2, a partir de DATASET_META.
+    """
+    if DATASET_META["rows"] == 0:
+        return [{"label": "Todos", "value": "ALL"}], ["ALL"]
+    boroughs = DATASET_META["pickup_boroughs"]
+    if boroughs is None:
+        return [{"label": "Unknown", "value": "Unknown"}], ["Unknown"]
+    options = [{"label": "Todos", "value": "ALL"}] + [
+        {"label": b, "value": b} for b in boroughs
+    ]
+    # por defecto seleccionar "ALL"
+    return options, ["ALL"]
+
+
+def pickup_borough_dropdown():
+    """
+    Opciones del desplegable de boroughs de pickup del Sankey (sin "Todos": vacío
+    significa todos), a partir de DATASET_META.
+    """
+    return [{"label": b, "value": b} for b in DATASET_META["pickup_boroughs"] or {}]
+
+
+def payment_dropdown():
+    """
+    Opciones del desplegable de tipos de pago del Sankey, a partir de DATASET_META.
+    """
+    return [{"label": p, "value": p} for p in DATASET_META["payment_types"] or {}]
+
 
 # --- Centro del mapa ---
-if not data.empty:
-    center_lat = data["pickup_latitude"].median()
-    center_lon = data["pickup_longitude"].median()
-else:
-    center_lat = 40.7128  # Coordenadas de NYC como fallback
-    center_lon = -74.0060
+center_lat, center_lon = DATASET_META["center"]
@@ -7,7 +7,15 @@ import dash_leaflet as dl
 import pandas as pd
 
 # Importar variables pre-calculadas del módulo de datos
-from data import data, pickup_markers, center_lat, center_lon
+from data import (
+    pickup_markers,
+    center_lat,
+    center_lon,
+    DATASET_META,
+    borough_dropdown,
+    pickup_borough_dropdown,
+    payment_dropdown,
+)
 
 
 def render_tag(tag, value):
@@ -64,10 +72,13 @@ def InfoIcon(id_prefix, content_dict):
 # ----------------------------------------------------------------------
 
 # El contenido del mapa y los gráficos para la pestaña "Viajes"
-min_dt = pd.to_datetime(data["tpep_pickup_datetime"].min())
-min_date_str = min_dt.strftime("%Y-%m-%d")
+# Defaults de fechas, horas y distritos a partir de los metadatos del dataset
+min_dt = DATASET_META["pickup_min"]
+min_date_str = DATASET_META["min_date"]
+max_date_str = DATASET_META["max_date"]
 default_start_time = min_dt.strftime("%H:%M")
 default_end_time = (min_dt + pd.Timedelta(hours=1)).strftime("%H:%M")
+borough_options, borough_value = borough_dropdown()
 
 viajes_content = html.Div(
     [
@@ -75,6 +86,7 @@ viajes_content = html.Div(
         dcc.Store(id="filtered-data-store", data=[]),
         dcc.Store(id="fixed-date-store", data=min_date_str),
         dcc.Store(id="filter-applied-flag", data="pickups"),
+        dcc.Store(id="selected-trip-store", data=None),  # viaje aislado en el mapa
         dbc.Row(
             [
                 # Columna Izquierda (Mapa - 2/3)
@@ -350,6 +362,18 @@ distritos_content = html.Div(
                                                     "label": "Comparar Tiempo vs Distancia (Pirámide)",
                                                     "value": "pyramid",
                                                 },
+                                                {
+                                                    "label": "Zonas ~1 km: Distancia Promedio de los Flujos Principales",
+                                                    "value": "zone_distance",
+                                                },
+                                                {
+                                                    "label": "Zonas ~1 km: Tiempo Promedio de los Flujos Principales",
+                                                    "value": "zone_time",
+                                                },
+                                                {
+                                                    "label": "Zonas ~1 km: Tiempo vs Distancia (Pirámide)",
+                                                    "value": "zone_pyramid",
+                                                },
                                             ],
                                             value="distance",
                                             clearable=False,
@@ -420,12 +444,52 @@ pagos_content = html.Div(
                                     className="fw-bold bg-dark text-light",
                                 ),
                                 dbc.CardBody(
-                                    dcc.Graph(
-                                        id="sankey-graph", 
-                                        # 'flex: 1' para que el dcc.Graph ocupe todo el CardBody
-                                        style={"flex": "1"},
-                                        responsive=True # Ayuda a que Plotly.js se ajuste al nuevo tamaño
-                                    ),
+                                    [
+                                        # Filtros del Sankey (altura natural, no crecen)
+                                        html.Div(
+                                            [
+                                                dcc.DatePickerRange(
+                                                    id="sankey-date-range",
+                                                    min_date_allowed=min_date_str,
+                                                    max_date_allowed=max_date_str,
+                                                    start_date=min_date_str,
+                                                    end_date=max_date_str,
+                                                    initial_visible_month=min_date_str,
+                                                    display_format="YYYY-MM-DD",
+                                                    className="mb-2",
+                                                ),
+                                                html.Label("Rango de horas (pickup)", className="small"),
+                                                dcc.RangeSlider(
+                                                    id="sankey-hour-range",
+                                                    min=0, max=23, step=1, value=[0, 23],
+                                                    marks={i: str(i) for i in range(0, 24, 6)},
+                                                    tooltip={"placement": "bottom", "always_visible": False},
+                                                ),
+                                                dcc.Dropdown(
+                                                    id="sankey-borough-dropdown",
+                                                    options=pickup_borough_dropdown(),
+                                                    value=[],
+                                                    multi=True,
+                                                    placeholder="Todos los boroughs (pickup)",
+                                                    className="mb-2",
+                                                ),
+                                                dcc.Dropdown(
+                                                    id="sankey-payment-dropdown",
+                                                    options=payment_dropdown(),
+                                                    value=[],
+                                                    multi=True,
+                                                    placeholder="Todos los tipos de pago",
+                                                ),
+                                            ],
+                                            className="mb-2",
+                                        ),
+                                        dcc.Graph(
+                                            id="sankey-graph", 
+                                            # 'flex: 1' para que el dcc.Graph ocupe todo el CardBody
+                                            style={"flex": "1"},
+                                            responsive=True # Ayuda a que Plotly.js se ajuste al nuevo tamaño
+                                        ),
+                                    ],
                                     # CardBody sin padding (p-0) debe ser un contenedor flex
                                     className="p-3 d-flex flex-column",
                                 ),
@@ -458,7 +522,7 @@ evolucion_content = html.Div(
                     dbc.Card(
                         [
                             dbc.CardHeader(
-                                "Evolución Temporal de Métricas por Hora",
+                                "Evolución Temporal de Métricas",
                                 className="fw-bold bg-dark text-light",
                             ),
                             dbc.CardBody(
@@ -474,7 +538,46 @@ evolucion_content = html.Div(
                                         ],
                                         value='passenger_count',
                                         inline=True,
-                                        className="mb-4", # <-- Esto toma su altura natural (flex-shrink: 0)
+                                        className="mb-3", # <-- Esto toma su altura natural (flex-shrink: 0)
+                                    ),
+                                    dbc.Row(
+                                        [
+                                            dbc.Col(
+                                                [
+                                                    dbc.Label("Granularidad:", className="fw-bold"),
+                                                    dbc.RadioItems(
+                                                        id="granularity-selector",
+                                                        options=[
+                                                            {'label': 'Hora del día', 'value': 'hour_of_day'},
+                                                            {'label': 'Hora de la semana', 'value': 'hour_of_week'},
+                                                            {'label': 'Día', 'value': 'day'},
+                                                            {'label': 'Hora', 'value': 'hour'},
+                                                            {'label': '15 min', 'value': '15min'},
+                                                            {'label': '5 min', 'value': '5min'},
+                                                        ],
+                                                        value='hour_of_day',
+                                                        inline=True,
+                                                    ),
+                                                ],
+                                                width="auto",
+                                            ),
+                                            dbc.Col(
+                                                [
+                                                    dbc.Label("Fechas:", className="fw-bold d-block"),
+                                                    dcc.DatePickerRange(
+                                                        id="evolucion-date-range",
+                                                        min_date_allowed=min_date_str,
+                                                        max_date_allowed=max_date_str,
+                                                        start_date=min_date_str,
+                                                        end_date=max_date_str,
+                                                        initial_visible_month=min_date_str,
+                                                        display_format="YYYY-MM-DD",
+                                                    ),
+                                                ],
+                                                width="auto",
+                                            ),
+                                        ],
+                                        className="mb-4 g-4",
                                     ),
                                     dcc.Graph(
                                         id="lollipop-chart",
@@ -523,8 +626,8 @@ emisiones_de_carbono_content = html.Div(
                                                 html.Label("Borough (Pickup)"),
                                                 dcc.Dropdown(
                                                     id="borough-dropdown",
-                                                    options=[{"label": "Todos", "value": "ALL"}],
-                                                    value=["ALL"],
+                                                    options=borough_options,
+                                                    value=borough_value,
                                                     multi=True,
                                                     placeholder="Selecciona borough(s)...",
                                                 ),
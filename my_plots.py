@@ -1,3 +1,4 @@
+import numpy as np
 import plotly.express as px
 import pandas as pd
 import plotly.graph_objs as go
@@ -51,23 +52,85 @@ plotly_style = {
 
 # Tab 1
 # Graficos a la izquierda del mapa
-def stylize_violin(fig, data, column_name, ylabel):
-    import numpy as np
+VIOLIN_HALF_WIDTH = 0.45  # semiancho del violín en unidades del eje x
+VIOLIN_BOX_HALF_WIDTH = 0.05  # semiancho de la caja central
 
-    vals = data[column_name].dropna().values
-    q1, q2, q3 = np.percentile(vals, [25, 50, 75])
-    vmin, vmax = vals.min(), vals.max()
-    median = np.median(vals)
 
-    # Hover limpio modern UI
-    fig.update_traces(
-        hovertemplate="<span style='font-size:13px'><b>%{y:.2f}</b> " + ylabel + "</span><extra></extra>",
-        line=dict(width=1.2, color=CONTRAST_COLOR),
-        hoveron="violins",
-        opacity=0.92
+def violin_from_summary(summary, title):
+    """
+    Dibuja un violín a partir del resumen de stats.violin_summary: la curva de
+    densidad (ya calculada en el servidor) como un polígono relleno y la caja
+    (Q1-Q3, mediana y bigotes) como trazos simples. El tamaño de la figura no
+    depende del número de viajes.
+    """
+    grid = summary["grid"]
+    density = summary["density"]
+    peak = density.max()
+    half_widths = density / peak * VIOLIN_HALF_WIDTH if peak > 0 else density
+
+    fig = go.Figure()
+    # Contorno del violín: lado derecho de abajo arriba y lado izquierdo de arriba abajo
+    fig.add_trace(
+        go.Scatter(
+            x=np.round(np.concatenate([half_widths, -half_widths[::-1]]), 4),
+            y=np.round(np.concatenate([grid, grid[::-1]]), 4),
+            mode="lines",
+            fill="toself",
+            fillcolor="rgba(90,156,231,0.5)",
+            line=dict(width=1.2, color=CONTRAST_COLOR),
+            opacity=0.92,
+            hoverinfo="skip",
+            showlegend=False,
+        )
     )
+    # Bigotes
+    fig.add_trace(
+        go.Scatter(
+            x=[0, 0],
+            y=[summary["whisker_low"], summary["whisker_high"]],
+            mode="lines",
+            line=dict(width=1.2, color=CONTRAST_COLOR),
+            hoverinfo="skip",
+            showlegend=False,
+        )
+    )
+    # Caja Q1-Q3
+    b = VIOLIN_BOX_HALF_WIDTH
+    fig.add_trace(
+        go.Scatter(
+            x=[-b, b, b, -b, -b],
+            y=[summary["q1"], summary["q1"], summary["q3"], summary["q3"], summary["q1"]],
+            mode="lines",
+            fill="toself",
+            fillcolor=CONTRAST_COLOR,
+            line=dict(width=1.2, color=CONTRAST_COLOR),
+            hoverinfo="skip",
+            showlegend=False,
+        )
+    )
+    # Mediana
+    fig.add_trace(
+        go.Scatter(
+            x=[-b, b],
+            y=[summary["median"], summary["median"]],
+            mode="lines",
+            line=dict(width=2, color="white"),
+            hoverinfo="skip",
+            showlegend=False,
+        )
+    )
+    fig.update_layout(title=title)
+    fig.update_xaxes(
+        range=[-0.5, 0.5], showticklabels=False, showgrid=False, zeroline=False
+    )
+    return fig
 
 
+def stylize_violin(fig, summary, ylabel):
+    q1, q3 = summary["q1"], summary["q3"]
+    vmin, vmax = summary["min"], summary["max"]
+    median = summary["median"]
+
     # Layout global brand-driven
     fig.update_layout(
         **plotly_style,
@@ -78,8 +141,9 @@ def stylize_violin(fig, data, column_name, ylabel):
         ),
         yaxis_title=ylabel,
         transition=dict(duration=250, easing="cubic-in-out"),
-        violinmode="overlay",
     )
+    # El estilo global activa la rejilla en x; en el violín no tiene sentido
+    fig.update_xaxes(showgrid=False, showticklabels=False)
 
     # Caja flotante UI-chip style
     x_pos = -0.25
@@ -109,31 +173,35 @@ def stylize_violin(fig, data, column_name, ylabel):
     add_box(f"Q3: {q3:.1f}", q3 + spacing * 3)
     add_box(f"Max: {vmax:.1f}", vmax + spacing)
 
+    # Cuantiles leídos de sketches: se indica su cota de error
+    if summary.get("error"):
+        fig.add_annotation(
+            x=0.5,
+            y=-0.08,
+            xref="paper",
+            yref="paper",
+            text=f"Cuantiles aproximados (error relativo ≤ {summary['error'] * 100:g}%)",
+            showarrow=False,
+            font=dict(color=TEXT_COLOR, size=10, family="Inter"),
+        )
+
     # Etiqueta responsiva
     fig.update_layout(uniformtext_minsize=12, uniformtext_mode="hide")
 
     return fig
-def tab1_violin_plot(filtered_data, num_trips):
-    fig = px.violin(
-        filtered_data,
-        y="trip_minutes",
-        box=True,
-        points=None,
-        title=f"<b>Distribución del Tiempo de Viaje</b><br><sup>{num_trips:,} viajes analizados</sup>",
-        color_discrete_sequence=[CONTRAST_COLOR],
-    )
-    fig = stylize_violin(fig, filtered_data, "trip_minutes", "Minutos de Viaje")
+def tab1_violin_plot(summary, num_trips):
+    fig = violin_from_summary(
+        summary,
+        f"<b>Distribución del Tiempo de Viaje</b><br><sup>{num_trips:,} viajes analizados</sup>",
+    )
+    fig = stylize_violin(fig, summary, "Minutos de Viaje")
     return fig
-def tab1_violin_distancia(filtered_data, num_trips):
-    fig = px.violin(
-        filtered_data,
-        y="trip_distance_km",
-        box=True,
-        points=None,
-        title=f"<b>Distribución de la Distancia de Viaje</b><br><sup>{num_trips:,} viajes analizados</sup>",
-        color_discrete_sequence=[CONTRAST_COLOR],
-    )
-    fig = stylize_violin(fig, filtered_data, "trip_distance_km", "Distancia (km)")
+def tab1_violin_distancia(summary, num_trips):
+    fig = violin_from_summary(
+        summary,
+        f"<b>Distribución de la Distancia de Viaje</b><br><sup>{num_trips:,} viajes analizados</sup>",
+    )
+    fig = stylize_violin(fig, summary, "Distancia (km)")
     return fig
 
 
@@ -435,6 +503,116 @@ def tab3_sankey_flujo(labels, sources, targets, values):
     )
     return fig
 
+
+# Waffle: una barra de 5x20 bloques por tramo de precio, dibujada como un único heatmap
+WAFFLE_COLS = 5
+WAFFLE_ROWS = 20
+PAYMENT_COLORS = {
+    "Credit card": CONTRAST_COLOR,
+    "Cash": "#2ecc71",
+    "No charge": "#95a5a6",
+    "Dispute": "#e74c3c",
+    "Otros": "#f1c40f",
+}
+
+
+def tab3_waffle_plot(blocks, shares, type_order, bin_labels, bin_totals, legend_types):
+    """
+    Waffle invertido de tipos de pago por tramo de precio, como un único
+    go.Heatmap: el tamaño de la figura solo depende del número de tramos.
+    `blocks` y `shares` son matrices (tramos x tipos, en el orden de
+    `type_order`) con el nº de bloques y la proporción de cada tipo. Cada barra
+    se llena en el orden de `type_order` y los bloques vacíos quedan arriba.
+    """
+    blocks = np.asarray(blocks, dtype=np.int64)
+    n_bins, n_types = blocks.shape
+    cells = WAFFLE_COLS * WAFFLE_ROWS
+
+    # Tipo de cada bloque (NaN = vacío), vectorizado para todos los tramos
+    start = cells - blocks.sum(axis=1)
+    rel = np.arange(cells)[None, :] - start[:, None]
+    ends = np.cumsum(blocks, axis=1)
+    codes = (rel[:, :, None] >= ends[:, None, :]).sum(axis=2).astype("float64")
+    codes[rel < 0] = np.nan
+
+    # Las barras van una al lado de otra con una columna vacía de separación
+    width = n_bins * (WAFFLE_COLS + 1) - 1
+    z = np.full((WAFFLE_ROWS, width), np.nan)
+    text = np.full((WAFFLE_ROWS, width), "", dtype=object)
+    labels = np.array(
+        [[f"{t}: {shares[b][i]:.1%}" for i, t in enumerate(type_order)] for b in range(n_bins)],
+        dtype=object,
+    ).reshape(n_bins, n_types)
+    for b in range(n_bins):
+        x0 = b * (WAFFLE_COLS + 1)
+        bar = codes[b].reshape(WAFFLE_ROWS, WAFFLE_COLS)
+        z[:, x0 : x0 + WAFFLE_COLS] = bar
+        filled = ~np.isnan(bar)
+        text[:, x0 : x0 + WAFFLE_COLS][filled] = labels[b][bar[filled].astype(np.int64)]
+
+    colors = [PAYMENT_COLORS.get(t, TEXT_COLOR) for t in type_order] or [TEXT_COLOR]
+    colorscale = []
+    for i, color in enumerate(colors):
+        colorscale += [[i / len(colors), color], [(i + 1) / len(colors), color]]
+
+    fig = go.Figure(
+        go.Heatmap(
+            z=z,
+            text=text,
+            zmin=-0.5,
+            zmax=len(colors) - 0.5,
+            colorscale=colorscale,
+            showscale=False,
+            xgap=2,
+            ygap=2,
+            hoverongaps=False,
+            hovertemplate="%{text}<extra></extra>",
+        )
+    )
+    # Leyenda: una traza vacía por tipo de pago
+    for t in legend_types:
+        fig.add_trace(
+            go.Scatter(
+                x=[None],
+                y=[None],
+                mode="markers",
+                marker=dict(symbol="square", size=14, color=PAYMENT_COLORS.get(t, TEXT_COLOR)),
+                name=t,
+            )
+        )
+
+    centers = [b * (WAFFLE_COLS + 1) + (WAFFLE_COLS - 1) / 2 for b in range(n_bins)]
+    fig.update_layout(
+        **{k: v for k, v in plotly_style.items() if k not in ("xaxis", "yaxis")},
+        height=560,
+        showlegend=True,
+        legend=dict(orientation="h", x=0.5, xanchor="center", y=1.08, bgcolor="rgba(0,0,0,0)"),
+        xaxis=dict(
+            tickvals=centers,
+            ticktext=[f"<b>{label}</b>" for label in bin_labels],
+            showgrid=False,
+            zeroline=False,
+            tickfont=dict(color=TEXT_COLOR),
+        ),
+        yaxis=dict(
+            range=[WAFFLE_ROWS - 0.5, -2],
+            visible=False,
+            showgrid=False,
+            zeroline=False,
+        ),
+        annotations=[
+            dict(
+                x=x,
+                y=-1.2,
+                text=f"<b>{int(total):,} viajes</b>",
+                showarrow=False,
+                font=dict(color=TEXT_COLOR, size=13),
+            )
+            for x, total in zip(centers, bin_totals)
+        ],
+    )
+    return fig
+
 # Tab 4
 def tab4_co2_horario(hourly, y_vals, y_label, metric_col, title_map):
     """
@@ -722,3 +900,85 @@ def tab5_stem_pop(x_values, y_values, y_label, chart_title):
     fig.update_layout(hoverlabel=plotly_style.get('hoverlabel'))
 
     return fig
+
+
+def tab5_timeline(x_values, y_values, y_label, chart_title, bucket_label):
+    """
+    Serie temporal (franjas de 5 min a 1 día) como área, con el máximo
+    destacado igual que en el stem & pop por hora.
+    """
+    y_values = np.asarray(y_values)
+    fig = go.Figure(
+        go.Scatter(
+            x=x_values,
+            y=y_values,
+            mode="lines",
+            line=dict(color=CONTRAST_COLOR, width=1.5),
+            fill="tozeroy",
+            fillcolor="rgba(90, 156, 231, 0.2)",
+            hovertemplate=f"<b>{bucket_label}:</b> %{{x}}<br><b>{y_label}:</b> %{{y:,.0f}}<extra></extra>",
+        )
+    )
+    if len(y_values) and y_values.max() > 0:
+        max_idx = int(np.argmax(y_values))
+        fig.add_annotation(
+            x=x_values[max_idx],
+            y=y_values[max_idx],
+            text=f"<b>Pico máximo:</b><br>{y_values[max_idx]:,.0f}",
+            showarrow=True,
+            arrowhead=2,
+            arrowcolor=CONTRAST_COLOR,
+            ax=40,
+            ay=-50,
+            font=dict(size=13, color=CONTRAST_COLOR),
+            align="left",
+            bordercolor=CONTRAST_COLOR,
+            borderwidth=1.5,
+            borderpad=4,
+            bgcolor=plotly_style.get("plot_bgcolor", "rgba(0,0,0,0.7)"),
+            opacity=0.9,
+        )
+    plotly_style_2 = copy.deepcopy(plotly_style)
+    plotly_style_2.pop("xaxis", None)
+    plotly_style_2.pop("yaxis", None)
+    fig.update_layout(
+        title=chart_title,
+        xaxis_title=bucket_label,
+        yaxis_title=y_label,
+        showlegend=False,
+        yaxis=dict(rangemode="tozero"),
+        **plotly_style_2,
+    )
+    return fig
+
+
+WEEKDAY_LABELS = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+
+
+def tab5_hour_of_week(table, y_label, chart_title):
+    """
+    Mapa de calor día de la semana x hora del día (matriz 7 x 24).
+    """
+    fig = go.Figure(
+        go.Heatmap(
+            z=table,
+            x=list(range(24)),
+            y=WEEKDAY_LABELS,
+            colorscale="Purples",
+            xgap=2,
+            ygap=2,
+            colorbar=dict(thickness=12, outlinewidth=0, tickfont=dict(size=11, color=TEXT_COLOR)),
+            hovertemplate=f"<b>%{{y}} %{{x}}:00</b><br><b>{y_label}:</b> %{{z:,.0f}}<extra></extra>",
+        )
+    )
+    plotly_style_2 = copy.deepcopy(plotly_style)
+    plotly_style_2.pop("xaxis", None)
+    plotly_style_2.pop("yaxis", None)
+    plotly_style_2.pop("coloraxis_showscale", None)
+    fig.update_layout(
+        title=chart_title,
+        xaxis=dict(title="Hora del Día (0-23)", tickmode="linear", dtick=1),
+        yaxis=dict(autorange="reversed"),
+        **plotly_style_2,
+    )
+    return fig
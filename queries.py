@@ -0,0 +1,433 @@
+# queries.py
+# Consultas sobre la tabla de viajes (sin dependencias de Dash): ventanas temporales,
+# índice espacial y agrupación de marcadores.
+
+import numpy as np
+import pandas as pd
+
+
+class TimeIndex:
+    """
+    Índice sobre la hora de recogida. La tabla debe estar ordenada por esa
+    columna: una ventana [inicio, fin] se resuelve con dos búsquedas binarias
+    y se devuelve como un slice posicional, sin copiar ni recorrer la tabla.
+    """
+
+    def __init__(self, df, column="tpep_pickup_datetime"):
+        self.df = df
+        if column in df.columns:
+            self.times = df[column].to_numpy(dtype="datetime64[ns]")
+        else:
+            self.times = np.array([], dtype="datetime64[ns]")
+
+    def bounds(self, start_ts, end_ts):
+        """
+        Posiciones [lo, hi) de los viajes con start_ts <= recogida <= end_ts.
+        """
+        start = pd.Timestamp(start_ts).to_datetime64()
+        end = pd.Timestamp(end_ts).to_datetime64()
+        lo = int(np.searchsorted(self.times, start, side="left"))
+        hi = int(np.searchsorted(self.times, end, side="right"))
+        return lo, max(lo, hi)
+
+    def window(self, start_ts, end_ts):
+        """
+        Vista (slice posicional) de los viajes dentro de la ventana.
+        """
+        lo, hi = self.bounds(start_ts, end_ts)
+        return self.df.iloc[lo:hi]
+
+
+class TripLookup:
+    """
+    Posición en la tabla de cada viaje a partir de su id (el índice del
+    DataFrame, que se conserva al ordenar por hora). Si los ids son enteros no
+    negativos razonablemente densos se usa un array inverso id -> posición;
+    si no, el índice hash de pandas. En ambos casos la consulta es O(1).
+    """
+
+    MAX_SPARSITY = 4  # tamaño máximo del array inverso respecto al nº de viajes
+
+    def __init__(self, index):
+        self.index = index
+        self.inverse = None
+        if len(index) and index.dtype.kind in "iu":
+            ids = index.to_numpy()
+            lo, hi = int(ids.min()), int(ids.max())
+            if lo >= 0 and hi < self.MAX_SPARSITY * len(ids) + 1024 and index.is_unique:
+                self.inverse = np.full(hi + 1, -1, dtype=np.int64)
+                self.inverse[ids] = np.arange(len(ids))
+
+    def position(self, trip_id):
+        """
+        Posición del viaje en la tabla, o None si no existe.
+        """
+        try:
+            trip_id = int(trip_id)
+        except (TypeError, ValueError):
+            return None
+        if self.inverse is not None:
+            if 0 <= trip_id < len(self.inverse) and self.inverse[trip_id] >= 0:
+                return int(self.inverse[trip_id])
+            return None
+        try:
+            pos = self.index.get_loc(trip_id)
+        except KeyError:
+            return None
+        return pos if isinstance(pos, int) else None
+
+
+# ----------------------------------------------------------------------
+# --- SERIALIZACIÓN DE LA VENTANA PARA EL NAVEGADOR ---
+# ----------------------------------------------------------------------
+
+# Campos que se envían por viaje (además de "index", el id del viaje)
+TRIP_FLOAT_FIELDS = [
+    "pickup_latitude",
+    "pickup_longitude",
+    "dropoff_latitude",
+    "dropoff_longitude",
+]
+TRIP_OPTIONAL_FIELDS = ["total_amount", "trip_minutes", "trip_distance_km"]
+
+
+def _to_json_list(values):
+    """
+    Convierte un array numérico a lista de Python, con NaN -> None.
+    Los enteros se devuelven como int y el resto como float.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in "iub":
+        return values.tolist()
+    values = values.astype("float64", copy=False)
+    nan_mask = np.isnan(values)
+    if not nan_mask.any():
+        return values.tolist()
+    out = values.astype(object)
+    out[nan_mask] = None
+    return out.tolist()
+
+
+def _column_or_none(df, col):
+    if col in df.columns:
+        return _to_json_list(df[col].to_numpy())
+    return [None] * len(df)
+
+
+def serialize_trips(df):
+    """
+    Serializa los viajes de `df` a una lista de dicts, con el mismo contenido que
+    el antiguo bucle por filas (iterrows), pero construyendo cada campo columna
+    a columna con NumPy. El índice del DataFrame se usa como "index" del viaje.
+    """
+    if len(df) == 0:
+        return []
+
+    times = df["tpep_pickup_datetime"].to_numpy(dtype="datetime64[ns]")
+    time_strings = np.char.replace(np.datetime_as_string(times, unit="s"), "T", " ")
+
+    keys = ["index"] + TRIP_FLOAT_FIELDS + ["passenger_count"] + TRIP_OPTIONAL_FIELDS
+    keys.append("tpep_pickup_datetime")
+    columns = [_to_json_list(df.index.to_numpy())]
+    columns += [_column_or_none(df, col) for col in TRIP_FLOAT_FIELDS]
+    columns.append(_column_or_none(df, "passenger_count"))
+    columns += [_column_or_none(df, col) for col in TRIP_OPTIONAL_FIELDS]
+    columns.append(time_strings.tolist())
+
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+
+# ----------------------------------------------------------------------
+# --- ÍNDICE ESPACIAL (REJILLA UNIFORME) ---
+# ----------------------------------------------------------------------
+
+GRID_CELL_DEG = 0.005  # ~500 m de lado en Nueva York
+GRID_MAX_CELLS = 1 << 20  # si hay puntos muy dispersos se agranda la celda
+
+
+def normalize_bounds(bounds):
+    """
+    Convierte los bounds de Leaflet [[lat1, lon1], [lat2, lon2]] en
+    (lat_min, lon_min, lat_max, lon_max). Devuelve None si no hay bounds
+    o tienen un formato inesperado (equivale a "sin filtro espacial").
+    """
+    if bounds is None:
+        return None
+    if isinstance(bounds, tuple) and len(bounds) == 4:
+        return bounds  # ya normalizados
+    try:
+        (lat1, lon1), (lat2, lon2) = bounds[0], bounds[1]
+        lat1, lon1, lat2, lon2 = float(lat1), float(lon1), float(lat2), float(lon2)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)
+
+
+class GridIndex:
+    """
+    Índice espacial de rejilla uniforme sobre un conjunto de puntos. Los puntos
+    se ordenan por celda (fila-mayor) y se guarda el offset de cada celda, así
+    que las celdas de una misma fila del bbox forman un único rango contiguo:
+    una consulta cuesta O(filas del bbox + puntos candidatos), no O(N).
+    """
+
+    def __init__(self, lat, lon, cell_deg=GRID_CELL_DEG):
+        lat = np.asarray(lat, dtype="float64")
+        lon = np.asarray(lon, dtype="float64")
+        self.lat = lat
+        self.lon = lon
+
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        if not valid.any():
+            self.n_rows = self.n_cols = 0
+            self.order = np.array([], dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+
+        self.lat0 = lat[valid].min()
+        self.lon0 = lon[valid].min()
+        lat_span = lat[valid].max() - self.lat0
+        lon_span = lon[valid].max() - self.lon0
+
+        # Agrandar la celda si la rejilla quedara demasiado grande
+        cell = cell_deg
+        while (lat_span / cell + 1) * (lon_span / cell + 1) > GRID_MAX_CELLS:
+            cell *= 2
+        self.cell = cell
+        self.n_rows = int(lat_span // cell) + 1
+        self.n_cols = int(lon_span // cell) + 1
+
+        positions = np.flatnonzero(valid)
+        rows = ((lat[positions] - self.lat0) // cell).astype(np.int64)
+        cols = ((lon[positions] - self.lon0) // cell).astype(np.int64)
+        cell_ids = rows * self.n_cols + cols
+
+        sort = np.argsort(cell_ids, kind="stable")
+        self.order = positions[sort]
+        counts = np.bincount(cell_ids, minlength=self.n_rows * self.n_cols)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def _cell_range(self, value, origin, n):
+        return int(np.clip((value - origin) // self.cell, 0, n - 1))
+
+    def query(self, bounds):
+        """
+        Posiciones (ordenadas) de los puntos dentro de `bounds`
+        (formato de normalize_bounds o bounds de Leaflet).
+        """
+        if self.n_rows == 0:
+            return np.array([], dtype=np.int64)
+        if bounds is not None and not isinstance(bounds, tuple):
+            bounds = normalize_bounds(bounds)
+        if bounds is None:
+            return np.sort(self.order)
+
+        lat_min, lon_min, lat_max, lon_max = bounds
+        if (
+            lat_max < self.lat0
+            or lon_max < self.lon0
+            or lat_min > self.lat0 + self.n_rows * self.cell
+            or lon_min > self.lon0 + self.n_cols * self.cell
+        ):
+            return np.array([], dtype=np.int64)
+
+        r0 = self._cell_range(lat_min, self.lat0, self.n_rows)
+        r1 = self._cell_range(lat_max, self.lat0, self.n_rows)
+        c0 = self._cell_range(lon_min, self.lon0, self.n_cols)
+        c1 = self._cell_range(lon_max, self.lon0, self.n_cols)
+
+        # Un rango contiguo de `order` por fila de la rejilla
+        row_starts = np.arange(r0, r1 + 1) * self.n_cols
+        starts = self.offsets[row_starts + c0]
+        ends = self.offsets[row_starts + c1 + 1]
+        if starts.size == 1:
+            candidates = self.order[starts[0]:ends[0]]
+        else:
+            candidates = np.concatenate([self.order[a:b] for a, b in zip(starts, ends)])
+
+        # Filtro exacto solo para los candidatos (celdas del borde)
+        lat = self.lat[candidates]
+        lon = self.lon[candidates]
+        inside = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        return np.sort(candidates[inside])
+
+
+# Columnas de coordenadas según el modo del mapa
+MODE_COLUMNS = {
+    "pickups": ("pickup_latitude", "pickup_longitude"),
+    "dropoffs": ("dropoff_latitude", "dropoff_longitude"),
+}
+
+
+# Tamaño aproximado en memoria por viaje de una ventana cacheada:
+# los dos índices espaciales (~24 B por punto cada uno)
+WINDOW_GRID_BYTES = 2 * 24
+
+
+class TripWindow:
+    """
+    Viajes de una ventana temporal: la vista sobre la tabla y un índice espacial
+    por modo ('pickups' / 'dropoffs'), que se construye la primera vez que se
+    consulta. Solo se serializan los viajes que se dibujan sueltos (ver records).
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._grids = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def nbytes(self):
+        """
+        Estimación de la memoria de la ventana (con ambos índices construidos).
+        La vista sobre la tabla no cuenta: no es una copia.
+        """
+        return len(self.df) * WINDOW_GRID_BYTES + 1024
+
+    def records(self, positions):
+        """
+        Viajes de `positions` (dentro de la ventana) serializados para el navegador.
+        """
+        return serialize_trips(self.df.iloc[positions])
+
+    def grid(self, mode):
+        mode = "dropoffs" if mode == "dropoffs" else "pickups"
+        grid = self._grids.get(mode)
+        if grid is None:
+            lat_col, lon_col = MODE_COLUMNS[mode]
+            grid = GridIndex(self.df[lat_col].to_numpy(), self.df[lon_col].to_numpy())
+            self._grids[mode] = grid
+        return grid
+
+    def visible_positions(self, mode, bounds):
+        """
+        Posiciones (dentro de la ventana) de los viajes visibles en `bounds`.
+        Sin bounds se devuelven todos.
+        """
+        bounds = normalize_bounds(bounds)
+        if bounds is None:
+            return np.arange(len(self.df))
+        return self.grid(mode).query(bounds)
+
+    def clusters(self, mode, bounds, zoom):
+        """
+        Agrupa los viajes del viewport (con un margen alrededor, para que un
+        desplazamiento corto no deje huecos) al zoom dado. Devuelve las
+        posiciones de los viajes sueltos dentro de la ventana y los grupos
+        (ver cluster_points).
+        """
+        mode = "dropoffs" if mode == "dropoffs" else "pickups"
+        positions = self.visible_positions(mode, pad_bounds(normalize_bounds(bounds)))
+        lat_col, lon_col = MODE_COLUMNS[mode]
+        lat = self.df[lat_col].to_numpy()[positions]
+        lon = self.df[lon_col].to_numpy()[positions]
+        singles, clusters = cluster_points(lat, lon, zoom)
+        return positions[singles], clusters
+
+
+# ----------------------------------------------------------------------
+# --- AGRUPACIÓN DE MARCADORES (CLUSTERING EN EL SERVIDOR) ---
+# ----------------------------------------------------------------------
+
+CLUSTER_CELL_PX = 64  # lado de la celda de agrupación en píxeles de pantalla
+CLUSTER_EXPAND_MAX = 3  # grupos con hasta este número de viajes se muestran sueltos
+CLUSTER_MAX_MARKERS = 300  # tope de marcadores individuales por respuesta
+CLUSTER_VIEW_PADDING = 0.5  # margen alrededor del viewport (fracción del tamaño)
+DEFAULT_ZOOM = 13
+MAP_WIDTH_PX = 900  # ancho aproximado del mapa, para estimar el zoom desde los bounds
+
+
+def zoom_from_bounds(bounds, default=DEFAULT_ZOOM):
+    """
+    Estima el nivel de zoom de Leaflet a partir del ancho en longitud de los
+    bounds (para cuando el mapa todavía no ha informado de su zoom).
+    """
+    bounds = normalize_bounds(bounds)
+    if bounds is None:
+        return default
+    lon_span = bounds[3] - bounds[1]
+    if lon_span <= 0:
+        return default
+    return float(np.clip(np.log2(360.0 * MAP_WIDTH_PX / (256.0 * lon_span)), 0, 20))
+
+
+def pad_bounds(bounds, fraction=CLUSTER_VIEW_PADDING):
+    """
+    Amplía unos bounds normalizados en `fraction` de su tamaño por cada lado.
+    """
+    if bounds is None:
+        return None
+    lat_min, lon_min, lat_max, lon_max = bounds
+    lat_pad = (lat_max - lat_min) * fraction
+    lon_pad = (lon_max - lon_min) * fraction
+    return lat_min - lat_pad, lon_min - lon_pad, lat_max + lat_pad, lon_max + lon_pad
+
+
+def cluster_points(
+    lat,
+    lon,
+    zoom,
+    expand_max=CLUSTER_EXPAND_MAX,
+    max_markers=CLUSTER_MAX_MARKERS,
+):
+    """
+    Agrupa los puntos en celdas de CLUSTER_CELL_PX píxeles al zoom dado.
+
+    Devuelve (sueltos, grupos):
+      - sueltos: posiciones de los puntos que se pintan como marcador individual
+        (los de grupos con <= expand_max viajes, hasta max_markers en total).
+      - grupos: dict de arrays con "count", "lat", "lon" (centroide) y
+        "lat_min", "lon_min", "lat_max", "lon_max" (caja del grupo), uno por
+        grupo que se pinta como burbuja con contador.
+    Cada punto aparece exactamente una vez, suelto o dentro de un grupo.
+    """
+    lat = np.asarray(lat, dtype="float64")
+    lon = np.asarray(lon, dtype="float64")
+    positions = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    empty = {key: np.array([]) for key in
+             ("count", "lat", "lon", "lat_min", "lon_min", "lat_max", "lon_max")}
+    if positions.size == 0:
+        return np.array([], dtype=np.int64), empty
+
+    lat = lat[positions]
+    lon = lon[positions]
+
+    # Tamaño de la celda en grados: en Web Mercator un píxel mide 360 / (256 * 2^zoom)
+    # grados de longitud; en latitud se corrige por el coseno de la latitud media.
+    cell_lon = CLUSTER_CELL_PX * 360.0 / (256.0 * 2.0 ** float(zoom))
+    cell_lat = cell_lon * np.cos(np.radians(np.median(lat)))
+    rows = np.floor(lat / cell_lat).astype(np.int64)
+    cols = np.floor(lon / cell_lon).astype(np.int64)
+    rows -= rows.min()
+    cols -= cols.min()
+    keys = rows * (int(cols.max()) + 1) + cols
+
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    # Grupos pequeños -> marcadores sueltos, mientras quepan en max_markers
+    small = counts <= expand_max
+    small_ids = np.flatnonzero(small)
+    fits = np.cumsum(counts[small_ids]) <= max_markers
+    expand = np.zeros(counts.size, dtype=bool)
+    expand[small_ids[fits]] = True
+
+    singles = positions[expand[inverse]]
+
+    # Agregados de los grupos que no se expanden
+    order = np.argsort(inverse, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sorted_lat = lat[order]
+    sorted_lon = lon[order]
+    kept = ~expand
+    clusters = {
+        "count": counts[kept],
+        "lat": (np.add.reduceat(sorted_lat, starts) / counts)[kept],
+        "lon": (np.add.reduceat(sorted_lon, starts) / counts)[kept],
+        "lat_min": np.minimum.reduceat(sorted_lat, starts)[kept],
+        "lon_min": np.minimum.reduceat(sorted_lon, starts)[kept],
+        "lat_max": np.maximum.reduceat(sorted_lat, starts)[kept],
+        "lon_max": np.maximum.reduceat(sorted_lon, starts)[kept],
+    }
+    return singles, clusters
@@ -0,0 +1,242 @@
+# sketches.py
+# Sketches de cuantiles precalculados por celda espacial y franja de tiempo, para
+# responder las estadísticas del viewport fusionando histogramas en lugar de
+# recorrer los viajes visibles.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from queries import GRID_MAX_CELLS, MODE_COLUMNS, normalize_bounds
+from stats import sketch_keys, sketch_values
+
+# Error relativo máximo de los cuantiles (se muestra en los gráficos)
+SKETCH_ALPHA = float(os.environ.get("UBER_SKETCH_ALPHA", "0.01"))
+# Franja y celda de cada sketch: lo bastante grandes para que cada sketch junte
+# muchos viajes (con celdas de ~1 km y franjas de 15 min había casi un bin por viaje)
+SKETCH_BUCKET_MINUTES = 60  # franja de tiempo de cada sketch
+SKETCH_CELL_DEG = 0.05  # celda espacial de cada sketch (~5 km en Nueva York)
+SKETCH_METRICS = ["trip_minutes", "trip_distance_km", "total_amount"]
+
+
+def _index_dtype(max_value):
+    """
+    Tipo entero más pequeño (int32 / int64) para guardar valores hasta `max_value`.
+    """
+    return np.int32 if max_value < np.iinfo(np.int32).max else np.int64
+
+
+class SketchIndex:
+    """
+    Sketches de cuantiles de las métricas de SKETCH_METRICS para un modo del mapa
+    ('pickups' / 'dropoffs'), uno por (franja de tiempo, celda de la rejilla).
+
+    Se guardan como tablas dispersas ordenadas por (franja, celda): clave de la
+    celda, bin del sketch y nº de viajes. Una consulta [inicio, fin] x bounds suma:
+      - los sketches de las franjas completas y celdas completamente dentro de
+        los bounds (sin tocar los viajes);
+      - los viajes de las celdas del borde (a partir de un orden por celda y
+        tiempo, sin recorrer la ventana) y de los trozos de franja de los
+        extremos, que se filtran con exactitud.
+    El resultado es el mismo conjunto de viajes que la consulta exacta; solo los
+    valores se aproximan (error relativo <= alpha).
+    """
+
+    def __init__(
+        self,
+        df,
+        mode,
+        metrics=SKETCH_METRICS,
+        alpha=SKETCH_ALPHA,
+        bucket_minutes=SKETCH_BUCKET_MINUTES,
+        cell_deg=SKETCH_CELL_DEG,
+    ):
+        self.alpha = alpha
+        self.metrics = [m for m in metrics if m in df.columns]
+        lat_col, lon_col = MODE_COLUMNS["dropoffs" if mode == "dropoffs" else "pickups"]
+        # Coordenadas leídas de la tabla sin copiarlas (float32 en modo compacto)
+        self.lat = df[lat_col].to_numpy()
+        self.lon = df[lon_col].to_numpy()
+        self.times = df["tpep_pickup_datetime"].to_numpy(dtype="datetime64[ns]").view("int64")
+        self.columns = {m: df[m].to_numpy() for m in self.metrics}
+
+        valid = np.isfinite(self.lat) & np.isfinite(self.lon)
+        self.n_buckets = 0
+        if len(df) == 0 or not valid.any():
+            return
+
+        # Franjas de tiempo (la tabla está ordenada por hora de recogida)
+        self.t0 = int(self.times[0])
+        self.bucket_ns = int(bucket_minutes * 60 * 1e9)
+        buckets = (self.times - self.t0) // self.bucket_ns
+        self.n_buckets = int(buckets[-1]) + 1
+
+        # Rejilla espacial global (se agranda la celda si quedara demasiado grande)
+        self.lat0 = float(self.lat[valid].min())
+        self.lon0 = float(self.lon[valid].min())
+        lat_span = float(self.lat[valid].max()) - self.lat0
+        lon_span = float(self.lon[valid].max()) - self.lon0
+        cell = cell_deg
+        while (lat_span / cell + 1) * (lon_span / cell + 1) > GRID_MAX_CELLS:
+            cell *= 2
+        self.cell = cell
+        self.n_rows = int(lat_span // cell) + 1
+        self.n_cols = int(lon_span // cell) + 1
+        self.n_cells = self.n_rows * self.n_cols
+
+        positions = np.flatnonzero(valid)
+        rows = ((self.lat[positions].astype("float64") - self.lat0) // cell).astype(np.int64)
+        cols = ((self.lon[positions].astype("float64") - self.lon0) // cell).astype(np.int64)
+        cells = rows * self.n_cols + cols
+        buckets = buckets[positions]
+
+        # Viajes ordenados por (celda, franja): para leer las celdas del borde
+        cell_keys = cells * self.n_buckets + buckets
+        order = np.argsort(cell_keys, kind="stable")
+        slot_dtype = _index_dtype(self.n_cells * self.n_buckets)
+        self.by_cell = positions[order].astype(_index_dtype(len(df)))
+        self.by_cell_keys = cell_keys[order].astype(slot_dtype)
+
+        # Sketches por (franja, celda) y métrica, como tablas dispersas
+        slot_keys = buckets * self.n_cells + cells
+        self.key_offset = {}
+        self.n_bins = {}
+        self.sketches = {}
+        for metric in self.metrics:
+            values = self.columns[metric][positions].astype("float64")
+            finite = np.isfinite(values)
+            keys = sketch_keys(values[finite], alpha)
+            offset = int(np.abs(keys).max()) if len(keys) else 0
+            n_bins = 2 * offset + 1
+            combined = slot_keys[finite] * n_bins + (keys + offset)
+            unique, counts = np.unique(combined, return_counts=True)
+            slots = unique // n_bins
+            self.key_offset[metric] = offset
+            self.n_bins[metric] = n_bins
+            self.sketches[metric] = {
+                "slots": slots.astype(slot_dtype),
+                "bins": (unique % n_bins).astype(np.int32),
+                "counts": counts.astype(np.int32),
+                # Inicio de cada franja en la tabla (ordenada por franja y celda)
+                "bucket_offsets": np.searchsorted(
+                    slots, np.arange(self.n_buckets + 1, dtype=np.int64) * self.n_cells
+                ),
+            }
+
+    def nbytes(self):
+        total = self.lat.nbytes + self.lon.nbytes
+        if self.n_buckets:
+            total += self.by_cell.nbytes + self.by_cell_keys.nbytes
+        for sketch in getattr(self, "sketches", {}).values():
+            total += sum(array.nbytes for array in sketch.values())
+        return total
+
+    def bin_values(self, metric):
+        """
+        Valor representativo de cada bin del sketch de `metric`, en orden creciente.
+        """
+        offset = self.key_offset[metric]
+        return sketch_values(np.arange(-offset, offset + 1), self.alpha)
+
+    def _add_rows(self, hist, metric, positions, bounds):
+        """
+        Suma al histograma los viajes de `positions` que caen dentro de los bounds.
+        """
+        if len(positions) == 0:
+            return
+        if bounds is not None:
+            lat_min, lon_min, lat_max, lon_max = bounds
+            # En float64, como GridIndex: en float32 los bounds se redondearían y
+            # se colarían viajes que están justo fuera
+            lat = self.lat[positions].astype("float64")
+            lon = self.lon[positions].astype("float64")
+            positions = positions[
+                (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+            ]
+        else:
+            positions = positions[np.isfinite(self.lat[positions]) & np.isfinite(self.lon[positions])]
+        values = self.columns[metric][positions].astype("float64")
+        values = values[np.isfinite(values)]
+        keys = sketch_keys(values, self.alpha) + self.key_offset[metric]
+        hist += np.bincount(np.clip(keys, 0, len(hist) - 1), minlength=len(hist))
+
+    def query(self, metric, start_ts, end_ts, bounds=None):
+        """
+        Histograma fusionado (nº de viajes por bin, ver bin_values) de `metric`
+        para los viajes con recogida en [start_ts, end_ts] dentro de `bounds`.
+        """
+        hist = np.zeros(self.n_bins.get(metric, 1), dtype=np.int64)
+        if self.n_buckets == 0 or metric not in self.sketches:
+            return hist
+
+        bounds = normalize_bounds(bounds)
+        start = pd.Timestamp(start_ts).value
+        end = pd.Timestamp(end_ts).value
+        lo = int(np.searchsorted(self.times, start, side="left"))
+        hi = int(np.searchsorted(self.times, end, side="right"))
+        if hi <= lo:
+            return hist
+
+        # Franjas completamente dentro de [start, end]
+        first = max(0, -(-(start - self.t0) // self.bucket_ns))
+        last = min(self.n_buckets - 1, (end + 1 - self.t0) // self.bucket_ns - 1)
+        if first > last:
+            self._add_rows(hist, metric, np.arange(lo, hi), bounds)
+            return hist
+
+        # Trozos de franja en los extremos: viajes uno a uno
+        edge_lo = int(np.searchsorted(self.times, self.t0 + first * self.bucket_ns, side="left"))
+        edge_hi = int(np.searchsorted(self.times, self.t0 + (last + 1) * self.bucket_ns, side="left"))
+        self._add_rows(hist, metric, np.arange(lo, edge_lo), bounds)
+        self._add_rows(hist, metric, np.arange(edge_hi, hi), bounds)
+
+        # Franjas completas: sketches de las celdas interiores
+        sketch = self.sketches[metric]
+        a, b = sketch["bucket_offsets"][first], sketch["bucket_offsets"][last + 1]
+        bins = sketch["bins"][a:b]
+        counts = sketch["counts"][a:b]
+        if bounds is None:
+            hist += np.bincount(bins, weights=counts, minlength=len(hist)).astype(np.int64)
+            return hist
+
+        lat_min, lon_min, lat_max, lon_max = bounds
+        # Filas/columnas de celdas que tocan los bounds y las que están enteras dentro
+        r0 = int(np.floor((lat_min - self.lat0) / self.cell))
+        r1 = int(np.floor((lat_max - self.lat0) / self.cell))
+        c0 = int(np.floor((lon_min - self.lon0) / self.cell))
+        c1 = int(np.floor((lon_max - self.lon0) / self.cell))
+        ri0 = int(np.ceil((lat_min - self.lat0) / self.cell))
+        ri1 = int(np.floor((lat_max - self.lat0) / self.cell)) - 1
+        ci0 = int(np.ceil((lon_min - self.lon0) / self.cell))
+        ci1 = int(np.floor((lon_max - self.lon0) / self.cell)) - 1
+        r0, r1 = max(r0, 0), min(r1, self.n_rows - 1)
+        c0, c1 = max(c0, 0), min(c1, self.n_cols - 1)
+        if r0 > r1 or c0 > c1:
+            return hist
+
+        cells = sketch["slots"][a:b] % self.n_cells
+        rows = cells // self.n_cols
+        cols = cells % self.n_cols
+        inside = (rows >= ri0) & (rows <= ri1) & (cols >= ci0) & (cols <= ci1)
+        hist += np.bincount(bins[inside], weights=counts[inside], minlength=len(hist)).astype(
+            np.int64
+        )
+
+        # Celdas del borde: sus viajes de las franjas completas, filtrados exactamente
+        grid_rows, grid_cols = np.meshgrid(
+            np.arange(r0, r1 + 1), np.arange(c0, c1 + 1), indexing="ij"
+        )
+        border = ~(
+            (grid_rows >= ri0) & (grid_rows <= ri1) & (grid_cols >= ci0) & (grid_cols <= ci1)
+        )
+        border_cells = (grid_rows * self.n_cols + grid_cols)[border]
+        starts = np.searchsorted(self.by_cell_keys, border_cells * self.n_buckets + first)
+        ends = np.searchsorted(self.by_cell_keys, border_cells * self.n_buckets + last + 1)
+        keep = ends > starts
+        if keep.any():
+            positions = np.concatenate(
+                [self.by_cell[s:e] for s, e in zip(starts[keep], ends[keep])]
+            )
+            self._add_rows(hist, metric, positions, bounds)
+        return hist
@@ -0,0 +1,191 @@
+# stats.py
+# Resúmenes estadísticos calculados en el servidor para los gráficos: el navegador
+# recibe solo arrays de tamaño fijo, nunca los valores crudos de cada viaje.
+
+import numpy as np
+
+KDE_GRID_POINTS = 256  # puntos de la curva de densidad del violín
+KDE_KERNEL_SPAN = 4.0  # el kernel gaussiano se trunca a ±4 anchos de banda
+KDE_SOFT_SPAN = 2.0  # la curva se extiende 2 anchos de banda más allá de min/max
+
+
+def silverman_bandwidth(n, std, iqr, center):
+    """
+    Ancho de banda de Silverman (el mismo criterio que usa Plotly para los violines).
+    Si no hay dispersión se usa un 10% de `center` (o 1).
+    """
+    spread = min(std, iqr / 1.349) if iqr > 0 else std
+    if not spread > 0:
+        spread = abs(float(center)) * 0.1 or 1.0
+    return 1.059 * spread * n ** (-1 / 5)
+
+
+def binned_kde(sorted_values, bandwidth, lo, hi, grid_points=KDE_GRID_POINTS, weights=None):
+    """
+    Estimación de densidad gaussiana sobre una rejilla regular [lo, hi].
+    Cada valor se reparte linealmente entre sus dos nodos vecinos (np.bincount)
+    y el histograma resultante se convoluciona con el kernel muestreado, así que
+    el coste es O(N + G·K) en lugar de O(N·G). `weights` permite pasar valores
+    ya agregados (p. ej. los bins de un sketch con su número de viajes).
+    Devuelve (rejilla, densidad).
+    """
+    grid = np.linspace(lo, hi, grid_points)
+    step = grid[1] - grid[0]
+
+    # Binning lineal
+    pos = (sorted_values - lo) / step
+    left = np.clip(np.floor(pos).astype(np.int64), 0, grid_points - 2)
+    frac = np.clip(pos - left, 0.0, 1.0)
+    if weights is None:
+        weights = np.ones(len(sorted_values))
+    counts = np.bincount(left, weights=weights * (1.0 - frac), minlength=grid_points)
+    counts += np.bincount(left + 1, weights=weights * frac, minlength=grid_points)
+
+    # Kernel gaussiano muestreado en la misma rejilla
+    half = max(1, min(grid_points - 1, int(np.ceil(KDE_KERNEL_SPAN * bandwidth / step))))
+    offsets = np.arange(-half, half + 1) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+
+    density = np.convolve(counts, kernel)[half : half + grid_points] / weights.sum()
+    return grid, density
+
+
+def violin_summary(values, grid_points=KDE_GRID_POINTS):
+    """
+    Resumen de una distribución para dibujar un violín: cuartiles, bigotes
+    (1.5·IQR, como Plotly) y la curva de densidad. Se ordenan los valores una sola
+    vez y de ahí salen cuantiles, bigotes y el binning del KDE.
+    Devuelve None si no hay valores válidos.
+    """
+    values = np.asarray(values, dtype="float64")
+    values = np.sort(values[np.isfinite(values)])
+    n = len(values)
+    if n == 0:
+        return None
+
+    vmin, q1, median, q3, vmax = np.quantile(values, [0, 0.25, 0.5, 0.75, 1])
+    iqr = q3 - q1
+
+    # Bigotes: valores extremos dentro de 1.5·IQR
+    low = values[np.searchsorted(values, q1 - 1.5 * iqr, side="left")]
+    high = values[np.searchsorted(values, q3 + 1.5 * iqr, side="right") - 1]
+
+    bandwidth = silverman_bandwidth(n, float(values.std()), float(iqr), values[0])
+    grid, density = binned_kde(
+        values,
+        bandwidth,
+        vmin - KDE_SOFT_SPAN * bandwidth,
+        vmax + KDE_SOFT_SPAN * bandwidth,
+        grid_points,
+    )
+
+    return {
+        "n": n,
+        "min": float(vmin),
+        "q1": float(q1),
+        "median": float(median),
+        "q3": float(q3),
+        "max": float(vmax),
+        "whisker_low": float(low),
+        "whisker_high": float(high),
+        "grid": grid,
+        "density": density,
+        "error": 0.0,  # cuantiles exactos
+    }
+
+
+# ----------------------------------------------------------------------
+# --- SKETCHES DE CUANTILES (ESTILO DDSKETCH) ---
+# ----------------------------------------------------------------------
+# Un sketch es un histograma sobre bins logarítmicos: el bin de un valor v es
+# ceil(log_gamma(|v|)), con gamma = (1 + alpha) / (1 - alpha). Cualquier
+# cuantil leído del sketch tiene un error relativo <= alpha y dos sketches se
+# fusionan sumando sus contadores, así que se pueden precalcular por celda y
+# franja horaria y combinar después.
+
+SKETCH_MIN_VALUE = 1e-3  # |v| por debajo de este valor cuenta como 0
+
+
+def sketch_gamma(alpha):
+    return (1 + alpha) / (1 - alpha)
+
+
+def sketch_keys(values, alpha):
+    """
+    Clave entera (con signo) del bin de cada valor: 0 si |v| < SKETCH_MIN_VALUE
+    y ±k en otro caso. Las claves conservan el orden de los valores.
+    Los valores deben ser finitos.
+    """
+    values = np.asarray(values, dtype="float64")
+    magnitude = np.abs(values)
+    keys = np.zeros(len(values), dtype=np.int64)
+    big = magnitude >= SKETCH_MIN_VALUE
+    keys[big] = (
+        np.ceil(np.log(magnitude[big] / SKETCH_MIN_VALUE) / np.log(sketch_gamma(alpha)))
+        .astype(np.int64)
+        + 1
+    )
+    return np.where(values < 0, -keys, keys)
+
+
+def sketch_values(keys, alpha):
+    """
+    Valor representativo de cada clave: el punto del bin cuyo error relativo
+    frente a cualquier valor del bin es como mucho alpha.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    gamma = sketch_gamma(alpha)
+    k = np.abs(keys)
+    values = SKETCH_MIN_VALUE * gamma ** (k - 1.0) * 2 / (gamma + 1)
+    values[k == 0] = 0.0
+    return np.where(keys < 0, -values, values)
+
+
+def sketch_violin_summary(counts, bin_values, alpha, grid_points=KDE_GRID_POINTS):
+    """
+    Igual que violin_summary pero a partir de un sketch ya fusionado: `counts`
+    es el nº de viajes de cada bin y `bin_values` su valor representativo
+    (ambos en orden creciente de valor). No se lee ningún viaje.
+    """
+    counts = np.asarray(counts)
+    present = counts > 0
+    values = bin_values[present]
+    weights = counts[present].astype("float64")
+    n = int(weights.sum())
+    if n == 0:
+        return None
+
+    # Cuantiles por rango sobre el acumulado de los contadores
+    cumulative = np.cumsum(weights)
+    ranks = np.array([0, 0.25, 0.5, 0.75, 1]) * (n - 1)
+    vmin, q1, median, q3, vmax = values[np.searchsorted(cumulative, ranks, side="right")]
+    iqr = q3 - q1
+
+    low = values[np.searchsorted(values, q1 - 1.5 * iqr, side="left")]
+    high = values[np.searchsorted(values, q3 + 1.5 * iqr, side="right") - 1]
+
+    mean = np.average(values, weights=weights)
+    std = float(np.sqrt(np.average((values - mean) ** 2, weights=weights)))
+    bandwidth = silverman_bandwidth(n, std, float(iqr), values[0])
+    grid, density = binned_kde(
+        values,
+        bandwidth,
+        vmin - KDE_SOFT_SPAN * bandwidth,
+        vmax + KDE_SOFT_SPAN * bandwidth,
+        grid_points,
+        weights=weights,
+    )
+
+    return {
+        "n": n,
+        "min": float(vmin),
+        "q1": float(q1),
+        "median": float(median),
+        "q3": float(q3),
+        "max": float(vmax),
+        "whisker_low": float(low),
+        "whisker_high": float(high),
+        "grid": grid,
+        "density": density,
+        "error": float(alpha),
+    }
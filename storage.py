@@ -0,0 +1,271 @@
+# storage.py
+# Persistencia columnar del dataset: snapshot Parquet con los tipos ya resueltos
+# y almacén de columnas .npy mapeado en memoria, compartido entre procesos.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (solo comprobamos que el motor Parquet está disponible)
+
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+HASH_CHUNK_SIZE = 1 << 20  # 1 MiB por lectura al calcular el hash
+SNAPSHOT_FORMAT = 2  # subir si cambia la forma en que se prepara el DataFrame
+COLUMN_STORE_FORMAT = 2  # idem para el almacén de columnas
+
+
+def file_hash(path):
+    """
+    Devuelve el hash SHA-256 del contenido de un fichero, leyéndolo por bloques.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_paths(csv_path):
+    """
+    Rutas del snapshot Parquet y de su fichero de metadatos para un CSV dado.
+    """
+    base, _ = os.path.splitext(csv_path)
+    return base + ".parquet", base + ".parquet.json"
+
+
+def read_snapshot(csv_path, source_hash, options=None):
+    """
+    Lee el snapshot asociado al CSV si existe y fue generado a partir del mismo
+    contenido (mismo hash) y con las mismas opciones de carga. Si `source_hash`
+    es None (no hay CSV), se acepta cualquier snapshot existente con esas
+    opciones. Devuelve None si no se puede usar.
+    """
+    if not PARQUET_AVAILABLE:
+        return None
+
+    parquet_path, meta_path = snapshot_paths(csv_path)
+    if not (os.path.exists(parquet_path) and os.path.exists(meta_path)):
+        return None
+
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        return None
+    if meta.get("options", {}) != (options or {}):
+        return None
+    if source_hash is not None and meta.get("source_hash") != source_hash:
+        return None
+
+    return pd.read_parquet(parquet_path)
+
+
+def write_snapshot(df, csv_path, source_hash, options=None):
+    """
+    Escribe el snapshot Parquet (y sus metadatos) de forma atómica: primero a
+    ficheros temporales y después se renombran, para que otro proceso nunca lea
+    un snapshot a medio escribir.
+    """
+    if not PARQUET_AVAILABLE:
+        print("Aviso: pyarrow no está instalado, no se genera el snapshot Parquet.")
+        return False
+
+    parquet_path, meta_path = snapshot_paths(csv_path)
+    tmp_suffix = f".tmp-{os.getpid()}"
+    try:
+        df.to_parquet(parquet_path + tmp_suffix, index=True)
+        with open(meta_path + tmp_suffix, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "format": SNAPSHOT_FORMAT,
+                    "source_hash": source_hash,
+                    "options": options or {},
+                    "rows": int(len(df)),
+                },
+                f,
+            )
+        os.replace(parquet_path + tmp_suffix, parquet_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+    except OSError as e:
+        print(f"Aviso: no se pudo escribir el snapshot Parquet ({e}).")
+        for path in (parquet_path + tmp_suffix, meta_path + tmp_suffix):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+    return True
+
+
+# ----------------------------------------------------------------------
+# --- ALMACÉN DE COLUMNAS MAPEADO EN MEMORIA ---
+# ----------------------------------------------------------------------
+# Cada columna se guarda como un .npy independiente y se abre con
+# np.load(mmap_mode="r"): todos los workers mapean los mismos ficheros de solo
+# lectura y la única copia en RAM es la caché de páginas del sistema operativo.
+
+
+def column_store_root(csv_path):
+    """
+    Directorio que contiene las versiones del almacén de columnas de un CSV.
+    """
+    base, _ = os.path.splitext(csv_path)
+    return base + ".columns"
+
+
+def _store_key(source_hash, options):
+    raw = json.dumps(
+        {"source_hash": source_hash, "options": options or {}, "format": COLUMN_STORE_FORMAT},
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _read_store_meta(store_dir):
+    try:
+        with open(os.path.join(store_dir, "meta.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def find_column_store(csv_path, source_hash, options=None):
+    """
+    Devuelve la ruta de un almacén válido para ese contenido y opciones de carga,
+    o None. Si `source_hash` es None (no hay CSV) vale cualquiera con las mismas
+    opciones.
+    """
+    root = column_store_root(csv_path)
+    if not os.path.isdir(root):
+        return None
+
+    if source_hash is not None:
+        candidates = [os.path.join(root, _store_key(source_hash, options))]
+    else:
+        candidates = [
+            os.path.join(root, name)
+            for name in sorted(os.listdir(root))
+            if ".tmp-" not in name
+        ]
+
+    for store_dir in candidates:
+        meta = _read_store_meta(store_dir)
+        if (
+            meta is not None
+            and meta.get("format") == COLUMN_STORE_FORMAT
+            and meta.get("options", {}) == (options or {})
+        ):
+            return store_dir
+    return None
+
+
+def write_column_store(df, csv_path, source_hash, options=None):
+    """
+    Vuelca el DataFrame a un almacén de columnas .npy. Las columnas de texto se
+    guardan como códigos categóricos (las categorías van en meta.json). Se escribe
+    en un directorio temporal que se renombra al final; si otro worker ha ganado
+    la carrera se descarta el nuestro. Se eliminan las versiones antiguas escritas
+    con las mismas opciones de carga (las de otras opciones pueden ser de otro
+    despliegue que comparte el directorio).
+    Devuelve la ruta del almacén o None si no se pudo escribir.
+    """
+    root = column_store_root(csv_path)
+    store_dir = os.path.join(root, _store_key(source_hash, options))
+    tmp_dir = f"{store_dir}.tmp-{os.getpid()}"
+
+    columns = []
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "index.npy"), df.index.to_numpy())
+
+        for i, col in enumerate(df.columns):
+            series = df[col]
+            if series.dtype == object:
+                series = series.astype("category")
+
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                values = series.cat.codes.to_numpy()
+                entry = {
+                    "name": col,
+                    "kind": "category",
+                    "categories": series.cat.categories.tolist(),
+                    "ordered": bool(series.cat.ordered),
+                }
+            else:
+                values = series.to_numpy()
+                entry = {"name": col, "kind": "numpy"}
+
+            entry["file"] = f"col_{i:03d}.npy"
+            np.save(os.path.join(tmp_dir, entry["file"]), values, allow_pickle=False)
+            columns.append(entry)
+
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "format": COLUMN_STORE_FORMAT,
+                    "source_hash": source_hash,
+                    "options": options or {},
+                    "rows": int(len(df)),
+                    "columns": columns,
+                },
+                f,
+            )
+
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # Otro proceso ya publicó el mismo almacén
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if _read_store_meta(store_dir) is None:
+                return None
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Aviso: no se pudo escribir el almacén de columnas ({e}).")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return None
+
+    # Limpiar versiones antiguas con las mismas opciones (en Linux los procesos que
+    # aún las mapean no se ven afectados)
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if path == store_dir or ".tmp-" in name:
+            continue
+        meta = _read_store_meta(path)
+        if meta is not None and meta.get("options", {}) == (options or {}):
+            shutil.rmtree(path, ignore_errors=True)
+
+    return store_dir
+
+
+def open_column_store(store_dir):
+    """
+    Abre un almacén de columnas como DataFrame de solo lectura. Los arrays son
+    vistas sobre ficheros mapeados en memoria (sin copia); las categóricas se
+    reconstruyen a partir de sus códigos.
+    """
+    meta = _read_store_meta(store_dir)
+    if meta is None:
+        return None
+
+    def load(name):
+        return np.load(os.path.join(store_dir, name), mmap_mode="r", allow_pickle=False)
+
+    columns = {}
+    for entry in meta["columns"]:
+        values = load(entry["file"])
+        if entry["kind"] == "category":
+            dtype = pd.CategoricalDtype(entry["categories"], ordered=entry["ordered"])
+            columns[entry["name"]] = pd.Categorical.from_codes(values, dtype=dtype, validate=False)
+        else:
+            columns[entry["name"]] = values
+
+    index = pd.Index(load("index.npy"), copy=False)
+    return pd.DataFrame(columns, index=index, copy=False)
@@ -0,0 +1,50 @@
+# tests/test_sketches.py
+# Los sketches del viewport deben contar los mismos viajes que la consulta exacta.
+
+import numpy as np
+import pandas as pd
+
+from queries import TripWindow
+from sketches import SketchIndex
+
+START = pd.Timestamp("2015-01-01")
+# float32(40.7) es 40.70000076...: queda justo fuera de un bound de 40.7 en
+# float64, pero en float32 el bound se redondea al mismo valor
+BOUNDS = [[40.6, -74.05], [40.7, -73.9]]
+
+
+def make_trips(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    times = START + pd.to_timedelta(np.sort(rng.integers(0, 3 * 3600, n)), unit="s")
+    df = pd.DataFrame(
+        {
+            "tpep_pickup_datetime": times,
+            "pickup_latitude": rng.uniform(40.55, 40.75, n).astype("float32"),
+            "pickup_longitude": rng.uniform(-74.1, -73.85, n).astype("float32"),
+            "trip_minutes": rng.gamma(2, 6, n),
+            "trip_distance_km": rng.gamma(2, 2, n),
+            "total_amount": rng.gamma(3, 4, n),
+        }
+    )
+    # Viajes con la latitud en float32 exactamente sobre el bound (en franjas
+    # completas y en el trozo de franja del extremo de la consulta)
+    df.loc[::50, "pickup_latitude"] = np.float32(40.7)
+    df.loc[::50, "pickup_longitude"] = np.float32(-74.0)
+    return df
+
+
+def exact_count(df, start, end):
+    times = df["tpep_pickup_datetime"]
+    window = TripWindow(df[(times >= start) & (times <= end)])
+    return len(window.visible_positions("pickups", BOUNDS))
+
+
+def test_sketch_count_matches_exact_on_float32_bound():
+    df = make_trips()
+    index = SketchIndex(df, "pickups")
+    for start, end in [
+        (START, START + pd.Timedelta(hours=1)),
+        (START + pd.Timedelta(minutes=10), START + pd.Timedelta(minutes=130)),
+    ]:
+        hist = index.query("total_amount", start, end, BOUNDS)
+        assert hist.sum() == exact_count(df, start, end)